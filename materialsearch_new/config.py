@@ -47,9 +47,16 @@ else:
     IMAGE_EXTENSIONS = tuple(os.getenv('IMAGE_EXTENSIONS', '.jpg,.jpeg,.png,.gif,.heic,.webp,.bmp').split(','))  # 支持的图片拓展名，逗号分隔，请填小写
     VIDEO_EXTENSIONS = tuple(os.getenv('VIDEO_EXTENSIONS', '.mp4,.flv,.mov,.mkv,.webm,.avi').split(','))  # 支持的视频拓展名，逗号分隔，请填小写
     FRAME_INTERVAL = int(os.getenv('FRAME_INTERVAL', 2))  # 视频每隔多少秒取一帧
+    VIDEO_FRAME_SAMPLING = os.getenv('VIDEO_FRAME_SAMPLING', 'auto').lower()  # 视频抽帧方式：auto（按GOP结构和抽帧密度逐个文件选择）、grab（顺序跳帧）、seek（按帧号跳转）、keyframe（ffmpeg只解码关键帧，取到的帧与设定间隔略有偏差）
+    VIDEO_DEDUP = os.getenv('VIDEO_DEDUP', 'False').lower() == 'true'  # 扫描视频时跳过与上一帧几乎相同的帧，并把特征几乎相同的连续帧合并为一行（记录起止时间），减少推理量和存储，搜索得到的片段范围不变
+    VIDEO_DEDUP_PIXEL_THRESHOLD = float(os.getenv('VIDEO_DEDUP_PIXEL_THRESHOLD', 2))  # 缩小为16x16灰度图后，与上一个推理过的帧平均每像素相差不超过此值（0~255）的帧视为重复，不做推理
+    VIDEO_DEDUP_FEATURE_EPSILON = float(os.getenv('VIDEO_DEDUP_FEATURE_EPSILON', 0.02))  # 与当前行第一帧特征的余弦距离不超过此值的连续帧合并为一行
     SCAN_PROCESS_BATCH_SIZE = int(os.getenv('SCAN_PROCESS_BATCH_SIZE', 512))  # 批处理大小，默认值调整为512以更好地利用内存
+    SCAN_DECODE_WORKERS = int(os.getenv('SCAN_DECODE_WORKERS', os.cpu_count() or 4))  # 扫描时解码图片的进程数，解码结果经共享内存交给模型，缓冲区约为 (2*SCAN_PROCESS_BATCH_SIZE+进程数) 张输入尺寸的图片
+    SCAN_VIDEO_WORKERS = int(os.getenv('SCAN_VIDEO_WORKERS', 4))  # 扫描时同时解码的视频数量，多个视频的帧拼成满批推理
     IMAGE_MIN_WIDTH = int(os.getenv('IMAGE_MIN_WIDTH', 64))  # 图片最小宽度，小于此宽度则忽略
     IMAGE_MIN_HEIGHT = int(os.getenv('IMAGE_MIN_HEIGHT', 64))  # 图片最小高度，小于此高度则忽略
+    IMAGE_DRAFT_DECODE = os.getenv('IMAGE_DRAFT_DECODE', 'True').lower() == 'true'  # 扫描时JPEG直接按模型输入尺寸缩小解码、HEIC使用内嵌缩略图，大幅减少解码耗时，特征与完整解码略有差别
     AUTO_SCAN = os.getenv('AUTO_SCAN', 'False').lower() == 'true'  # 是否自动扫描
     AUTO_SCAN_START_TIME = tuple(map(int, os.getenv('AUTO_SCAN_START_TIME', '22:30').split(':')))  # 自动扫描开始时间
     AUTO_SCAN_END_TIME = tuple(map(int, os.getenv('AUTO_SCAN_END_TIME', '8:00').split(':')))  # 自动扫描结束时间
@@ -97,16 +104,33 @@ else:
     INPUT_RESOLUTION = int(os.getenv('INPUT_RESOLUTION', 224))  # 输入分辨率
 
     # *****搜索配置*****
-    CACHE_SIZE = int(os.getenv('CACHE_SIZE', 1000))  # LRU缓存大小
+    CACHE_SIZE = int(os.getenv('CACHE_SIZE', 1000))  # 上传图片特征的LRU缓存大小
+    RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', 64))  # 搜索结果缓存的内存上限，单位MB，扫描后按变化修补而不是整体清空，0表示不缓存
+    TEXT_CACHE_SIZE = int(os.getenv('TEXT_CACHE_SIZE', 4096))  # 文字特征缓存的提示词数量，按模型和提示词缓存，重启和切换模型后仍然有效，0表示不缓存
     POSITIVE_THRESHOLD = int(os.getenv('POSITIVE_THRESHOLD', 36))  # 正向搜索词阈值
     NEGATIVE_THRESHOLD = int(os.getenv('NEGATIVE_THRESHOLD', 36))  # 反向搜索词阈值
     IMAGE_THRESHOLD = int(os.getenv('IMAGE_THRESHOLD', 85))  # 图片搜索阈值
+    ENABLE_IVF_INDEX = os.getenv('ENABLE_IVF_INDEX', 'False').lower() == 'true'  # 是否使用IVF近似索引搜图，需要先执行 python vector_index.py build 建立索引
+    IVF_NLIST = int(os.getenv('IVF_NLIST', 1024))  # IVF聚类中心数量，建议约为图片数量的平方根
+    IVF_NPROBE = int(os.getenv('IVF_NPROBE', 32))  # 搜索时探查的聚类数量，越大召回率越高，速度越慢
+    ENABLE_HNSW_INDEX = os.getenv('ENABLE_HNSW_INDEX', 'False').lower() == 'true'  # 以图搜图是否使用HNSW图索引，需要先执行 python vector_index.py build --type hnsw 建立索引
+    HNSW_M = int(os.getenv('HNSW_M', 16))  # HNSW每个节点的邻居数量
+    HNSW_EF_CONSTRUCTION = int(os.getenv('HNSW_EF_CONSTRUCTION', 100))  # HNSW建图时的候选集大小
+    HNSW_EF_SEARCH = int(os.getenv('HNSW_EF_SEARCH', 64))  # HNSW搜索时的候选集大小，越大召回率越高，速度越慢
+
+    VIDEO_SUMMARY_SIZE = int(os.getenv('VIDEO_SUMMARY_SIZE', 4))  # 每个视频的镜头摘要向量数量，视频搜索先用摘要排除不可能达到阈值的视频，0表示不计算摘要
+    FEATURE_ENCODING = os.getenv('FEATURE_ENCODING', 'float32')  # 数据库中特征的编码：float32/float16/int8，float16 体积减半，int8 约为四分之一。只对新数据库生效，已有数据库用 python database.py convert 转换
+    FEATURE_STORE_MODE = os.getenv('FEATURE_STORE_MODE', 'float')  # 常驻内存特征的存储方式：float 为原始特征；pq 为乘积量化压缩编码，同时用于图片和视频帧，需要先执行 python quantization.py train
+    PQ_SUBVECTORS = int(os.getenv('PQ_SUBVECTORS', 64))  # PQ子向量数量，即每个特征压缩后的字节数，建议32~64
+    PQ_RERANK_SIZE = int(os.getenv('PQ_RERANK_SIZE', 200))  # PQ模式下，从数据库读取原始特征精确重排的候选数量，0表示不重排
 
     # *****日志配置*****
     LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG')  # 日志等级：NOTSET/DEBUG/INFO/WARNING/ERROR/CRITICAL
 
     # *****其它配置*****
     SQLALCHEMY_DATABASE_URL = os.getenv('SQLALCHEMY_DATABASE_URL', 'sqlite:///./instance/assets.db')  # 数据库保存路径
+    INDEX_PATH = os.getenv('INDEX_PATH', os.path.dirname(SQLALCHEMY_DATABASE_URL.replace("sqlite:///", "")))  # 向量索引保存目录，默认和数据库放在一起
+    TEXT_CACHE_PATH = os.getenv('TEXT_CACHE_PATH', os.path.join(INDEX_PATH, 'text_cache.npz'))  # 文字特征缓存文件，不能放在启动时会被清空的临时目录中
     TEMP_PATH = os.getenv('TEMP_PATH', './tmp')  # 临时目录路径
     VIDEO_EXTENSION_LENGTH = int(os.getenv('VIDEO_EXTENSION_LENGTH', 0))  # 下载视频片段时，视频前后增加的时长，单位为秒
     ENABLE_LOGIN = os.getenv('ENABLE_LOGIN', 'False').lower() == 'true'  # 是否启用登录
@@ -1,13 +1,21 @@
 import datetime
 import logging
 
-from sqlalchemy import asc
+import numpy as np
+from sqlalchemy import asc, func
 from sqlalchemy.orm import Session
 
-from models import Image, Video, PexelsVideo
+from models import Image, Video, VideoSummary, PexelsVideo, Meta, PexelsVideoMeta
 
 logger = logging.getLogger(__name__)
 
+# 特征归一化约定：Image / Video / PexelsVideo 表中的特征写入时均已L2归一化，搜索时不再归一化
+FEATURES_NORMALIZED_KEY = "features_normalized"
+# 特征编码：float32 为原始特征；float16 为半精度；int8 为一个 float32 缩放系数加 d 个 int8。编码方式记录在元数据表中，没有记录的为 float32
+FEATURE_ENCODING_KEY = "feature_encoding"
+FEATURE_ENCODINGS = ("float32", "float16", "int8")
+_feature_encodings = {}  # 按元数据表缓存数据库中特征的编码方式
+
 #总的来说有四个get
 #根据id查特征
 #根据id查路径
@@ -39,58 +47,62 @@ def get_image_count(session: Session):
     return session.query(Image).count()
 
 
-def delete_image_if_outdated(session: Session, path: str, modify_time: datetime.datetime, checksum: str = None) -> bool:
+def get_image_states(session: Session) -> dict[str, tuple[datetime.datetime, str, int]]:
     """
-    判断图片是否修改，若修改则删除
-    :param session: Session, 数据库 session
-    :param path: str, 图片路径
-    :param modify_time: datetime.datetime, 图片修改时间
-    :param checksum: str, 图片hash
-    :return: bool, 若文件未修改返回 True
+    一次性读取全部图片的修改时间、hash和id，扫描时在内存中判断文件是否修改，不再逐个文件查询数据库
+    :return: dict, {图片路径: (修改时间, hash, id)}
     """
-    record = session.query(Image).filter_by(path=path).first()
-    if not record:
-        return False
-    # 如果有checksum，则判断checksum
-    if checksum and record.checksum:
-        if record.checksum == checksum:
-            logger.debug(f"文件无变更，跳过：{path}")
-            return True
-    else:  # 否则判断modify_time
-        if record.modify_time == modify_time:
-            logger.debug(f"文件无变更，跳过：{path}")
-            return True
-    logger.info(f"文件有更新：{path}")
-    session.delete(record)
-    session.commit()
-    return False
+    query = session.query(Image.path, Image.modify_time, Image.checksum, Image.id)
+    return {path: (modify_time, checksum, id) for path, modify_time, checksum, id in query}
 
 
-def delete_video_if_outdated(session: Session, path: str, modify_time: datetime.datetime, checksum: str = None) -> bool:
+def get_video_states(session: Session) -> dict[str, tuple[datetime.datetime, str]]:
     """
-    判断视频是否修改，若修改则删除
-    :param session: Session, 数据库 session
-    :param path: str, 视频路径
-    :param modify_time: datetime.datetime, 视频修改时间
-    :param checksum: str, 视频hash
-    :return: bool, 若文件未修改返回 True
+    一次性读取全部视频的修改时间和hash，同一视频的帧这两项相同
+    :return: dict, {视频路径: (修改时间, hash)}
     """
-    record = session.query(Video).filter_by(path=path).first()
-    if not record:
-        return False
-    # 如果有checksum，则判断checksum
-    if checksum and record.checksum:
-        if record.checksum == checksum:
-            logger.debug(f"文件无变更，跳过：{path}")
-            return True
-    else:  # 否则判断modify_time
-        if record.modify_time == modify_time:
-            logger.debug(f"文件无变更，跳过：{path}")
-            return True
-    logger.info(f"文件有更新：{path}")
-    session.query(Video).filter_by(path=path).delete()
+    query = session.query(Video.path, func.min(Video.modify_time), func.min(Video.checksum)).group_by(Video.path)
+    return {path: (modify_time, checksum) for path, modify_time, checksum in query}
+
+
+def is_file_modified(path: str, record_modify_time: datetime.datetime, record_checksum: str, modify_time: datetime.datetime,
+                     checksum: str = None) -> bool:
+    """
+    比较文件与数据库记录，判断文件是否修改
+    :param path: str, 文件路径，用于日志
+    :param record_modify_time: datetime.datetime, 数据库中的修改时间
+    :param record_checksum: str, 数据库中的hash
+    :param modify_time: datetime.datetime, 文件修改时间
+    :param checksum: str, 文件hash
+    :return: bool, 若文件已修改返回 True
+    """
+    # 如果有checksum，则判断checksum，否则判断modify_time
+    if checksum and record_checksum:
+        modified = record_checksum != checksum
+    else:
+        modified = record_modify_time != modify_time
+    if modified:
+        logger.info(f"文件有更新：{path}")
+    else:
+        logger.debug(f"文件无变更，跳过：{path}")
+    return modified
+
+
+def delete_images_by_ids(session: Session, ids: list[int]):
+    """批量删除图片，在同一个事务中提交"""
+    ids = list(ids)
+    for i in range(0, len(ids), 500):  # 分批删除，避免超过SQLite的参数数量限制
+        session.query(Image).filter(Image.id.in_(ids[i:i + 500])).delete(synchronize_session=False)
+    session.commit()
+
+
+def delete_videos_by_paths(session: Session, paths: list[str]):
+    """批量删除视频的帧和摘要，在同一个事务中提交"""
+    paths = list(paths)
+    for i in range(0, len(paths), 500):  # 分批删除，避免超过SQLite的参数数量限制
+        session.query(Video).filter(Video.path.in_(paths[i:i + 500])).delete(synchronize_session=False)
+        session.query(VideoSummary).filter(VideoSummary.path.in_(paths[i:i + 500])).delete(synchronize_session=False)
     session.commit()
-    return False
 
 
 def get_video_paths(session: Session, filter_path: str = None, start_time: int = None, end_time: int = None):
@@ -128,6 +140,15 @@ def get_pexels_video_count(session: Session):
     return session.query(PexelsVideo).count()
 
 
+def get_pexels_video_version(session: Session):
+    """
+    获取pexels视频库的版本，爬虫在另一个进程中增删视频后会变化，用于使缓存的搜索结果失效
+    :return: tuple, (视频数量, 最大id)
+    """
+    count, max_id = session.query(func.count(PexelsVideo.id), func.max(PexelsVideo.id)).one()
+    return count, max_id
+
+
 def get_video_frame_count(session: Session):
     """获取视频帧总数"""
     return session.query(Video).count()
@@ -136,12 +157,93 @@ def get_video_frame_count(session: Session):
 def delete_video_by_path(session: Session, path: str):
     """删除路径对应的视频数据"""
     session.query(Video).filter_by(path=path).delete()
+    session.query(VideoSummary).filter_by(path=path).delete()
     session.commit()
 
 
+def get_normalized_feature_bytes(features, encoding: str = "float32") -> bytes:
+    """
+    将特征L2归一化后按编码方式转为字节，所有特征写入数据库前都要经过这里
+    :param features: bytes 或 np.ndarray, 单个特征向量，bytes 视为 float32
+    :param encoding: str, 特征编码，见 FEATURE_ENCODINGS
+    :return: bytes, 归一化后的特征
+    """
+    if isinstance(features, (bytes, bytearray, memoryview)):
+        features = np.frombuffer(features, dtype=np.float32)
+    features = np.asarray(features, dtype=np.float32).reshape(-1)
+    norm = np.linalg.norm(features)
+    if norm > 0:
+        features = features / norm
+    return encode_feature(features, encoding)
+
+
+def encode_feature(features, encoding: str = "float32") -> bytes:
+    """
+    按编码方式把单个特征转为字节
+    :param features: np.ndarray, 单个特征向量
+    :param encoding: str, 特征编码，见 FEATURE_ENCODINGS
+    :return: bytes
+    """
+    features = np.asarray(features, dtype=np.float32).reshape(-1)
+    if encoding == "float32":
+        return features.tobytes()
+    if encoding == "float16":
+        return features.astype(np.float16).tobytes()
+    if encoding == "int8":
+        max_value = np.abs(features).max() if len(features) else 0
+        if max_value == 0:
+            return np.float32(0).tobytes() + np.zeros(len(features), dtype=np.int8).tobytes()
+        codes = np.rint(features * (127 / max_value)).astype(np.int8)
+        # 缩放系数取 ||x|| / ||codes||，解码后的向量与原向量模长相同，归一化特征解码后仍是单位向量
+        scale = np.linalg.norm(features) / np.linalg.norm(codes.astype(np.float32))
+        return np.float32(scale).tobytes() + codes.tobytes()
+    raise ValueError(f"不支持的特征编码：{encoding}")
+
+
+def decode_features(features_list, encoding: str = "float32") -> np.ndarray:
+    """
+    把数据库中同一编码的特征批量解码为 float32 矩阵
+    :param features_list: list[bytes], 特征
+    :param encoding: str, 特征编码，见 FEATURE_ENCODINGS
+    :return: np.ndarray, shape=(n, d)
+    """
+    n = len(features_list)
+    if n == 0:
+        return np.empty((0, 0), dtype=np.float32)
+    buffer = b"".join(features_list)
+    if encoding == "float32":
+        return np.frombuffer(buffer, dtype=np.float32).reshape(n, -1)
+    if encoding == "float16":
+        return np.frombuffer(buffer, dtype=np.float16).reshape(n, -1).astype(np.float32)
+    if encoding == "int8":
+        rows = np.frombuffer(buffer, dtype=np.uint8).reshape(n, -1)
+        scales = rows[:, :4].copy().view(np.float32)  # shape=(n, 1)
+        return rows[:, 4:].view(np.int8).astype(np.float32) * scales
+    raise ValueError(f"不支持的特征编码：{encoding}")
+
+
+def get_feature_encoding(session: Session, meta_model=Meta) -> str:
+    """
+    获取数据库中特征的编码方式，没有记录的旧数据库为 float32
+    :param meta_model: 元数据表，PexelsVideo 数据库为 PexelsVideoMeta
+    """
+    if meta_model not in _feature_encodings:
+        _feature_encodings[meta_model] = get_meta(session, FEATURE_ENCODING_KEY, meta_model) or "float32"
+    return _feature_encodings[meta_model]
+
+
+def set_feature_encoding(session: Session, encoding: str, meta_model=Meta):
+    """记录数据库中特征的编码方式"""
+    if encoding not in FEATURE_ENCODINGS:
+        raise ValueError(f"不支持的特征编码：{encoding}")
+    set_meta(session, FEATURE_ENCODING_KEY, encoding, meta_model)
+    _feature_encodings[meta_model] = encoding
+
+
 def add_image(session: Session, path: str, modify_time: datetime.datetime, checksum: str, features: bytes):
     """添加图片到数据库"""
     logger.info(f"新增文件：{path}")
+    features = get_normalized_feature_bytes(features, get_feature_encoding(session))
     image = Image(path=path, modify_time=modify_time, features=features, checksum=checksum)
     session.add(image)
     session.commit()
@@ -154,18 +256,55 @@ def add_video(session: Session, path: str, modify_time: datetime.datetime, check
     :param path: str, 视频路径
     :param modify_time: datetime, 文件修改时间
     :param checksum: str, 文件hash
-    :param frame_time_features_generator: 返回(帧序列号,特征)元组的迭代器
+    :param frame_time_features_generator: 返回(帧时间, 结束帧时间, 特征)元组的迭代器，结束帧时间大于帧时间表示合并了这段时间内的连续相似帧
+    :return: list[bytes], 写入的特征，已归一化并按数据库的编码方式编码，可直接用 decode_features 解码
     """
     # 使用 bulk_save_objects 一次性提交，因此处理至一半中断不会导致下次扫描时跳过
     logger.info(f"新增文件：{path}")
-    video_list = (
+    encoding = get_feature_encoding(session)
+    video_list = [
         Video(
-            path=path, modify_time=modify_time, frame_time=frame_time, features=features, checksum=checksum
+            path=path, modify_time=modify_time, frame_time=frame_time,
+            end_frame_time=end_frame_time if end_frame_time != frame_time else None,
+            features=get_normalized_feature_bytes(features, encoding), checksum=checksum
         )
-        for frame_time, features in frame_time_features_generator
-    )
+        for frame_time, end_frame_time, features in frame_time_features_generator
+    ]
     session.bulk_save_objects(video_list)
     session.commit()
+    return [i.features for i in video_list]
+
+
+def add_video_summary(session: Session, path: str, features: np.ndarray, radii: np.ndarray):
+    """
+    写入视频的摘要向量和覆盖半径，已存在时覆盖
+    :param features: np.ndarray, 摘要向量，shape=(k, d)
+    :param radii: np.ndarray, 覆盖半径，shape=(k, )
+    """
+    session.query(VideoSummary).filter_by(path=path).delete()
+    session.add(VideoSummary(
+        path=path, features=np.asarray(features, dtype=np.float32).tobytes(), radii=np.asarray(radii, dtype=np.float32).tobytes()
+    ))
+    session.commit()
+
+
+def get_video_summaries(session: Session) -> dict[str, tuple[bytes, bytes]]:
+    """
+    返回全部视频的摘要
+    :return: dict, {视频路径: (摘要向量, 覆盖半径)}
+    """
+    return {path: (features, radii) for path, features, radii in session.query(VideoSummary.path, VideoSummary.features, VideoSummary.radii)}
+
+
+def get_video_paths_without_summary(session: Session) -> list[str]:
+    """返回还没有摘要的视频路径，如旧版本扫描的视频"""
+    query = (
+        session.query(Video.path)
+        .distinct()
+        .outerjoin(VideoSummary, Video.path == VideoSummary.path)
+        .filter(VideoSummary.id.is_(None))
+    )
+    return [path for path, in query]
 
 
 def add_pexels_video(session: Session, content_loc: str, duration: int, view_count: int, thumbnail_loc: str, title: str, description: str,
@@ -173,26 +312,30 @@ def add_pexels_video(session: Session, content_loc: str, duration: int, view_cou
     """添加pexels视频到数据库"""
     pexels_video = PexelsVideo(
         content_loc=content_loc, duration=duration, view_count=view_count, thumbnail_loc=thumbnail_loc, title=title, description=description,
-        thumbnail_feature=thumbnail_feature
+        thumbnail_feature=get_normalized_feature_bytes(thumbnail_feature, get_feature_encoding(session, PexelsVideoMeta))
     )
     session.add(pexels_video)
     session.commit()
 
 
-def delete_record_if_not_exist(session: Session, assets: set):
+def delete_record_if_not_exist(session: Session, assets: set) -> tuple[list[int], list[str]]:
     """
-    删除不存在于 assets 集合中的图片 / 视频的数据库记录
+    删除不存在于 assets 集合中的图片 / 视频的数据库记录，只读取id和路径，删除分批执行
+    :return: (被删除的图片id列表, 被删除的视频路径列表)，用于同步更新内存中的特征库
     """
-    for file in session.query(Image):
-        if file.path not in assets:
-            logger.info(f"文件已删除：{file.path}")
-            session.delete(file)
-    for path in session.query(Video.path).distinct():
-        path = path[0]
+    deleted_image_ids = []
+    deleted_video_paths = []
+    for id, path in session.query(Image.id, Image.path):
         if path not in assets:
             logger.info(f"文件已删除：{path}")
-            session.query(Video).filter_by(path=path).delete()
-    session.commit()
+            deleted_image_ids.append(id)
+    for path, in session.query(Video.path).distinct():
+        if path not in assets:
+            logger.info(f"文件已删除：{path}")
+            deleted_video_paths.append(path)
+    delete_images_by_ids(session, deleted_image_ids)
+    delete_videos_by_paths(session, deleted_video_paths)
+    return deleted_image_ids, deleted_video_paths
 
 
 def is_video_exist(session: Session, path: str):
@@ -225,6 +368,76 @@ def get_image_id_path_features(session: Session) -> tuple[list[int], list[str],
         return [], [], []
 
 
+def get_image_id_path_modify_time_features(session: Session):
+    """
+    按 id 升序逐行返回全部图片的 id, 路径, 修改时间, 特征，用于加载常驻内存的特征库
+    """
+    session.query(Image).filter(Image.features.is_(None)).delete()
+    session.commit()
+    return (
+        session.query(Image.id, Image.path, Image.modify_time, Image.features)
+        .order_by(Image.id)
+        .yield_per(1000)
+    )
+
+
+def get_image_features_by_ids(session: Session, ids: list[int]) -> dict[int, bytes]:
+    """
+    批量返回id对应的图片特征
+    :return: dict, {图片id: 特征}
+    """
+    result = {}
+    ids = list(ids)
+    for i in range(0, len(ids), 500):  # 分批查询，避免超过SQLite的参数数量限制
+        query = session.query(Image.id, Image.features).filter(Image.id.in_(ids[i:i + 500]))
+        result.update(query)
+    return result
+
+
+def get_end_frame_time():
+    """结束帧时间，没有合并其他帧的行为 NULL，取帧时间"""
+    return func.coalesce(Video.end_frame_time, Video.frame_time)
+
+
+def get_frame_times_features_by_paths(session: Session, paths: list[str]):
+    """
+    批量返回多个视频的帧，按路径、帧时间排序，同一视频的帧相邻
+    :return: (路径列表, 帧时间列表, 结束帧时间列表, 特征列表)，每行一项
+    """
+    rows = []
+    paths = sorted(paths)
+    for i in range(0, len(paths), 500):  # 分批查询，避免超过SQLite的参数数量限制
+        query = (
+            session.query(Video.path, Video.frame_time, get_end_frame_time(), Video.features)
+            .filter(Video.path.in_(paths[i:i + 500]))
+            .order_by(Video.path, Video.frame_time)
+        )
+        rows += query.all()
+    if not rows:
+        return [], [], [], []
+    return tuple(map(list, zip(*rows)))
+
+
+def get_video_path_modify_time_frame_time_features(session: Session):
+    """
+    按路径、帧时间排序逐行返回全部视频帧的路径, 修改时间, 帧时间, 结束帧时间, 特征，同一视频的帧相邻，用于加载常驻内存的视频帧特征库
+    """
+    return (
+        session.query(Video.path, Video.modify_time, Video.frame_time, get_end_frame_time(), Video.features)
+        .order_by(Video.path, Video.frame_time)
+        .yield_per(1000)
+    )
+
+
+def get_random_features(session: Session, count: int) -> list[bytes]:
+    """
+    随机抽取图片和视频帧特征各一半，用于训练量化码本
+    """
+    image_features = session.query(Image.features).filter(Image.features.isnot(None)).order_by(func.random()).limit(count // 2).all()
+    video_features = session.query(Video.features).filter(Video.features.isnot(None)).order_by(func.random()).limit(count - len(image_features)).all()
+    return [i[0] for i in image_features + video_features]
+
+
 def get_image_id_path_features_filter_by_path_time(session: Session, path: str, start_time: int, end_time: int) -> tuple[
     list[int], list[str], list[bytes]]:
     """
@@ -288,3 +501,160 @@ def get_pexels_video_features(session: Session):
 def get_pexels_video_by_id(session: Session, uuid: str):
     """根据id搜索单个pexels视频"""
     return session.query(PexelsVideo).filter_by(id=uuid).first()
+
+
+def get_meta(session: Session, key: str, meta_model=Meta):
+    """读取元数据，不存在时返回 None"""
+    record = session.query(meta_model).filter_by(key=key).first()
+    if not record:
+        return None
+    return record.value
+
+
+def set_meta(session: Session, key: str, value: str, meta_model=Meta):
+    """写入元数据"""
+    session.merge(meta_model(key=key, value=value))
+    session.commit()
+
+
+def normalize_table_features(session: Session, model, column, batch_size: int = 1000) -> int:
+    """
+    按id分批将表中未归一化的特征改写为归一化后的特征
+    :param model: 数据库模型，如 Image
+    :param column: 特征列，如 Image.features
+    :return: int, 被改写的行数
+    """
+    last_id = 0
+    updated = 0
+    while True:
+        rows = (
+            session.query(model.id, column)
+            .filter(model.id > last_id)
+            .order_by(model.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+        mappings = []
+        for id, features in rows:
+            if features is None:
+                continue
+            vector = np.frombuffer(features, dtype=np.float32)
+            if abs(np.linalg.norm(vector) - 1) > 1e-4:
+                mappings.append({"id": id, column.key: get_normalized_feature_bytes(vector)})
+        if mappings:
+            session.bulk_update_mappings(model, mappings)
+        session.commit()
+        updated += len(mappings)
+        last_id = rows[-1][0]
+    return updated
+
+
+def normalize_legacy_features(session: Session):
+    """
+    一次性迁移：把旧数据库中未归一化的图片和视频帧特征改写为归一化特征，完成后写入标记，之后不再执行
+    """
+    if get_meta(session, FEATURES_NORMALIZED_KEY) == "1":
+        return
+    logger.info("开始迁移：归一化已有的图片和视频特征")
+    updated = normalize_table_features(session, Image, Image.features)
+    updated += normalize_table_features(session, Video, Video.features)
+    set_meta(session, FEATURES_NORMALIZED_KEY, "1")
+    logger.info(f"迁移完成，共改写{updated}条特征")
+
+
+def normalize_legacy_pexels_features(session: Session):
+    """
+    一次性迁移：把pexels视频缩略图特征改写为归一化特征
+    """
+    if get_meta(session, FEATURES_NORMALIZED_KEY, PexelsVideoMeta) == "1":
+        return
+    logger.info("开始迁移：归一化已有的pexels视频特征")
+    updated = normalize_table_features(session, PexelsVideo, PexelsVideo.thumbnail_feature)
+    set_meta(session, FEATURES_NORMALIZED_KEY, "1", PexelsVideoMeta)
+    logger.info(f"迁移完成，共改写{updated}条特征")
+
+
+def init_feature_encoding(session: Session, encoding: str, models, meta_model=Meta):
+    """
+    新数据库记录配置的特征编码；已有数据的数据库编码不同时只给出提示，需要用 python database.py convert 离线转换
+    :param encoding: str, 配置的特征编码
+    :param models: 该数据库中有特征的表，用于判断是否为空库
+    :param meta_model: 元数据表
+    """
+    current = get_meta(session, FEATURE_ENCODING_KEY, meta_model)
+    if current is None:
+        if any(session.query(model.id).first() for model in models):
+            current = "float32"  # 旧数据库的特征都是 float32
+        else:
+            current = encoding
+        set_feature_encoding(session, current, meta_model)
+    if current != encoding:
+        logger.warning(f"数据库特征编码为{current}，与配置的{encoding}不同，将继续使用{current}。如需转换请执行 python database.py convert --encoding {encoding}")
+    _feature_encodings[meta_model] = current
+
+
+def convert_table_features(session: Session, model, column, from_encoding: str, to_encoding: str, batch_size: int = 1000) -> int:
+    """
+    按id分批把表中的特征从一种编码转换为另一种编码
+    :param model: 数据库模型，如 Image
+    :param column: 特征列，如 Image.features
+    :return: int, 被改写的行数
+    """
+    last_id = None
+    updated = 0
+    while True:
+        query = session.query(model.id, column)
+        if last_id is not None:
+            query = query.filter(model.id > last_id)
+        rows = query.order_by(model.id).limit(batch_size).all()
+        if not rows:
+            break
+        rows_with_features = [(id, features) for id, features in rows if features is not None]
+        if rows_with_features:
+            vectors = decode_features([features for _, features in rows_with_features], from_encoding)
+            mappings = [
+                {"id": id, column.key: encode_feature(vector, to_encoding)}
+                for (id, _), vector in zip(rows_with_features, vectors)
+            ]
+            session.bulk_update_mappings(model, mappings)
+            updated += len(mappings)
+        session.flush()  # 不提交，由调用方在全部转换完成后与编码记录一起提交
+        last_id = rows[-1][0]
+    return updated
+
+
+def convert_feature_encoding(session: Session, encoding: str, tables, meta_model=Meta) -> int:
+    """
+    把一个数据库中全部特征转换为指定编码并记录，所有改写与编码记录在同一个事务中提交，中断不会留下编码混杂的数据
+    :param tables: list[(模型, 特征列)]
+    :return: int, 被改写的行数
+    """
+    current = get_meta(session, FEATURE_ENCODING_KEY, meta_model) or "float32"
+    if current == encoding:
+        logger.info(f"特征编码已经是{encoding}，无需转换")
+        return 0
+    logger.info(f"开始转换特征编码：{current} -> {encoding}")
+    updated = 0
+    for model, column in tables:
+        updated += convert_table_features(session, model, column, current, encoding)
+    set_feature_encoding(session, encoding, meta_model)
+    logger.info(f"转换完成，共改写{updated}条特征")
+    return updated
+
+
+if __name__ == '__main__':
+    import argparse
+    from models import DatabaseSession, DatabaseSessionPexelsVideo
+
+    parser = argparse.ArgumentParser(description='Convert the feature encoding of existing databases. Stop the server before converting.')
+    parser.add_argument('command', metavar='<command>', choices=['convert'], help='convert: re-encode all features in the databases.')
+    parser.add_argument('--encoding', choices=FEATURE_ENCODINGS, required=True, help='target feature encoding.')
+    args = parser.parse_args()
+
+    with DatabaseSession() as session:
+        convert_feature_encoding(session, args.encoding, [(Image, Image.features), (Video, Video.features)])
+    with DatabaseSessionPexelsVideo() as session:
+        convert_feature_encoding(session, args.encoding, [(PexelsVideo, PexelsVideo.thumbnail_feature)], PexelsVideoMeta)
+    print("转换完成。SQLite 文件不会自动变小，可执行 VACUUM 回收空间；PQ码本和向量索引建议重新训练")
@@ -0,0 +1,632 @@
+# 常驻内存的特征库，启动时从数据库加载一次，扫描时增量更新，搜索时不再逐次读取数据库
+import logging
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from config import *
+from database import (
+    get_image_id_path_modify_time_features,
+    get_video_path_modify_time_frame_time_features,
+    get_video_summaries,
+    get_feature_encoding,
+    decode_features,
+)
+from models import DatabaseSession
+from path_index import PathIndex
+from quantization import feature_quantizer, DecodedFeatures
+from time_index import TimeIndex
+
+logger = logging.getLogger(__name__)
+
+LOAD_CHUNK_SIZE = 65536  # 加载时每次拼接/编码的行数，PQ模式下避免一次生成全部原始特征
+CHANGE_LOG_ROWS = 16384  # 变化记录中最多保留的新增特征行数，超过后丢弃最早的记录
+
+
+def get_store_quantizer():
+    """
+    根据 FEATURE_STORE_MODE 返回特征库使用的量化器
+    :return: ProductQuantizer，原始特征模式或码本未训练时返回 None
+    """
+    if FEATURE_STORE_MODE != "pq":
+        return None
+    if feature_quantizer.load():
+        return feature_quantizer
+    logger.warning("PQ码本未训练，特征库使用原始特征")
+    return None
+
+
+class ChangeLog:
+    """
+    特征库的变化记录，供结果缓存修补旧的搜索结果
+    generation 每次增删加1；entries 中保存 start 之后每次变化的 (generation, 新增内容, 删除内容)，
+    新增的特征行数超过 max_rows 时丢弃最早的记录，更早的结果只能重新搜索。调用方需持有特征库的锁。
+    """
+
+    def __init__(self, max_rows=CHANGE_LOG_ROWS):
+        self.max_rows = max_rows
+        self.generation = 0
+        self.start = 0
+        self.entries = deque()
+        self.rows = 0
+
+    def reset(self):
+        """重新加载后之前的结果都不能修补"""
+        self.generation += 1
+        self.start = self.generation
+        self.entries.clear()
+        self.rows = 0
+
+    def record(self, added=None, removed=None, rows=0):
+        """
+        记录一次变化
+        :param added: 新增的内容，格式由特征库决定
+        :param removed: 删除的id或路径
+        :param rows: 新增的特征行数
+        """
+        self.generation += 1
+        self.entries.append((self.generation, added, removed))
+        self.rows += rows
+        while self.rows > self.max_rows and self.entries:
+            generation, added, _ = self.entries.popleft()
+            self.rows -= 0 if added is None else len(added[-1])
+            self.start = generation
+
+    def since(self, generation):
+        """
+        :param generation: int, 旧结果对应的 generation
+        :return: list, 之后的全部变化，记录已被丢弃时返回 None
+        """
+        if generation < self.start:
+            return None
+        return [i for i in self.entries if i[0] > generation]
+
+
+class ImageFeatureStore:
+    """
+    图片特征库
+    features 为连续的 float32 矩阵（PQ模式下为 uint8 编码矩阵），ids / paths / modify_times 为与其逐行对应的并行数组，ids 保持升序。
+    追加时写入预留的空间，删除时生成新数组，因此 snapshot() 返回的数组不会被后续修改影响。
+    挂载的向量索引（见 attach_index）会随特征库的增删同步更新。
+    每次增删记录在 changes 中，新增内容为 (ids, paths, modify_times, features)，删除内容为 ids。
+    path_index / time_index 为以图片id为键的路径子串索引和修改时间索引，按路径和时间筛选时用 get_filter_mask 代替逐行检查。
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.quantizer = None
+        self.indexes = []
+        self.changes = ChangeLog()
+        self.path_index = PathIndex()
+        self.time_index = TimeIndex()
+        self._reset()
+
+    @property
+    def generation(self):
+        return self.changes.generation
+
+    def get_changes(self, generation):
+        """获取 generation 之后的变化，见 ChangeLog.since"""
+        with self.lock:
+            return self.changes.since(generation)
+
+    def _reset(self):
+        """清空特征库，换成新的数组而不是原地修改"""
+        self.size = 0
+        self._features = np.empty((0, 0), dtype=np.float32)
+        self._ids = np.empty(0, dtype=np.int64)
+        self._paths = np.empty(0, dtype=object)
+        self._modify_times = np.empty(0, dtype=np.float64)  # 时间戳，单位秒，无修改时间的记为NaN
+
+    @property
+    def dim(self):
+        return self._features.shape[1]
+
+    def snapshot(self):
+        """
+        获取当前特征库的只读视图
+        :return: (features, ids, paths, modify_times) 元组，PQ模式下 features 为编码
+        """
+        with self.lock:
+            n = self.size
+            return self._features[:n], self._ids[:n], self._paths[:n], self._modify_times[:n]
+
+    def get_filter_mask(self, path="", start_time=None, end_time=None):
+        """
+        用路径索引和修改时间索引筛选图片，需要与 snapshot() 一致时在 lock 内同时调用，参数见 get_path_time_mask
+        :return: np.ndarray[bool], 与 snapshot() 逐行对应的掩码；没有筛选条件时返回 None
+        """
+        with self.lock:
+            n = self.size
+            return get_filter_mask(
+                self._ids[:n], self._paths[:n], self._modify_times[:n], self.path_index, self.time_index, path, start_time, end_time
+            )
+
+    def load(self, force=False):
+        """
+        从数据库加载全部图片特征
+        :param force: bool, 已经加载过时是否重新加载
+        """
+        with self.lock:
+            if self.loaded and not force:
+                return
+            t0 = time.time()
+            self.quantizer = get_store_quantizer()
+            self._reset()
+            with DatabaseSession() as session:
+                encoding = get_feature_encoding(session)
+                ids, paths, modify_times, features = [], [], [], []
+                for id, path, modify_time, feature in get_image_id_path_modify_time_features(session):
+                    ids.append(id)
+                    paths.append(path)
+                    modify_times.append(_to_timestamp(modify_time))
+                    features.append(feature)
+                    if len(ids) == LOAD_CHUNK_SIZE:
+                        self._append_rows(ids, paths, modify_times, decode_features(features, encoding))
+                        ids, paths, modify_times, features = [], [], [], []
+                if ids:
+                    self._append_rows(ids, paths, modify_times, decode_features(features, encoding))
+            self.loaded = True
+            self.changes.reset()
+            self.path_index.build(self._ids[:self.size], self._paths[:self.size])
+            self.time_index.build(self._ids[:self.size], self._modify_times[:self.size])
+            logger.info(f"图片特征库加载完成，共{self.size}张图片，用时{time.time() - t0:.2f}秒")
+            for index in self.indexes:
+                index.sync(self._ids[:self.size], self._index_features())
+
+    def _append_rows(self, ids, paths, modify_times, features):
+        """追加从数据库读到的一批行"""
+        self._append(np.asarray(ids, dtype=np.int64), paths, np.asarray(modify_times, dtype=np.float64), self._encode(features))
+
+    def _encode(self, features):
+        """PQ模式下把原始特征编码后再保存"""
+        if self.quantizer is None:
+            return features
+        return self.quantizer.encode(features)
+
+    def _index_features(self):
+        """给向量索引同步用的原始特征，PQ模式下按需解码"""
+        if self.quantizer is None:
+            return self._features[:self.size]
+        return DecodedFeatures(self.quantizer, self._features[:self.size])
+
+    def attach_index(self, index):
+        """
+        挂载向量索引，之后特征库的增删会同步到索引。索引需要实现 add(ids, features) / remove(ids) / sync(ids, features) / save()
+        :param index: 向量索引，如 IVFIndex
+        """
+        with self.lock:
+            if index in self.indexes:
+                return
+            self.indexes.append(index)
+            if self.loaded:
+                index.sync(self._ids[:self.size], self._index_features())
+
+    def save_indexes(self):
+        """保存有改动的向量索引"""
+        for index in self.indexes:
+            if index.dirty:
+                index.save()
+
+    def add(self, ids, paths, modify_times, features):
+        """
+        增量添加图片
+        :param ids: list[int], 图片id
+        :param paths: list[str], 图片路径
+        :param modify_times: list[datetime.datetime], 修改时间
+        :param features: np.ndarray, 特征矩阵，shape=(n, d)
+        """
+        if len(ids) == 0:
+            return
+        ids = np.asarray(ids, dtype=np.int64)
+        modify_times = np.asarray([_to_timestamp(i) for i in modify_times], dtype=np.float64)
+        features = np.asarray(features, dtype=np.float32).reshape(len(ids), -1)
+        with self.lock:
+            if not self.loaded:  # 还没加载时不需要增量更新，加载时会从数据库读到
+                return
+            stored_features = self._encode(features)
+            if self.size and ids.min() <= self._ids[self.size - 1]:
+                # 新id不在末尾（一般不会发生），先删除重复id再整体排序，保证ids升序
+                self.remove_ids(ids)
+                order = np.argsort(np.concatenate([self._ids[:self.size], ids]), kind="stable")
+                all_features = np.concatenate([self._features[:self.size], stored_features])[order]
+                all_ids = np.concatenate([self._ids[:self.size], ids])[order]
+                all_paths = np.concatenate([self._paths[:self.size], np.asarray(paths, dtype=object)])[order]
+                all_times = np.concatenate([self._modify_times[:self.size], modify_times])[order]
+                self._reset()
+                self._append(all_ids, all_paths, all_times, all_features)
+            else:
+                self._append(ids, paths, modify_times, stored_features)
+            self.changes.record(added=(ids, np.asarray(paths, dtype=object), modify_times, features), rows=len(ids))
+            self.path_index.add(ids, paths)
+            self.time_index.add(ids, modify_times)
+            indexes = list(self.indexes)
+        # 向量索引有自己的锁，HNSW插入较慢，在特征库的锁外更新，不阻塞扫描期间的搜索；索引暂时缺少的图片只是不会作为候选
+        for index in indexes:
+            index.add(ids, features)
+
+    def remove_ids(self, ids):
+        """
+        删除指定id的图片
+        :param ids: list[int], 图片id
+        :return: np.ndarray, 实际被删除的图片id
+        """
+        if len(ids) == 0:
+            return np.empty(0, dtype=np.int64)
+        with self.lock:
+            keep = ~np.isin(self._ids[:self.size], np.asarray(ids, dtype=np.int64))
+            return self._compact(keep)
+
+    def remove_paths(self, paths):
+        """
+        删除指定路径的图片
+        :param paths: list[str], 图片路径
+        :return: np.ndarray, 实际被删除的图片id
+        """
+        if len(paths) == 0:
+            return np.empty(0, dtype=np.int64)
+        with self.lock:
+            keep = ~np.isin(self._paths[:self.size], np.asarray(list(paths), dtype=object))
+            return self._compact(keep)
+
+    def _compact(self, keep):
+        """按掩码保留行，生成新的数组，避免修改正在被搜索使用的快照，返回被删除的id"""
+        if keep.all():
+            return np.empty(0, dtype=np.int64)
+        n = self.size
+        removed_ids = self._ids[:n][~keep]
+        self._features = np.ascontiguousarray(self._features[:n][keep])
+        self._ids = self._ids[:n][keep]
+        self._paths = self._paths[:n][keep]
+        self._modify_times = self._modify_times[:n][keep]
+        self.size = len(self._ids)
+        self.changes.record(removed=removed_ids)
+        self.path_index.remove(removed_ids)
+        self.time_index.remove(removed_ids)
+        for index in self.indexes:
+            index.remove(removed_ids)
+        return removed_ids
+
+    def _append(self, ids, paths, modify_times, features):
+        """追加到末尾，容量不足时按倍数扩容"""
+        n, new_n = self.size, self.size + len(ids)
+        if n == 0 and (self._features.shape[1] != features.shape[1] or self._features.dtype != features.dtype):
+            self._features = np.empty((0, features.shape[1]), dtype=features.dtype)
+        if new_n > len(self._ids):
+            capacity = max(new_n, len(self._ids) * 2, 1024)
+            self._features = _grow(self._features, n, capacity)
+            self._ids = _grow(self._ids, n, capacity)
+            self._paths = _grow(self._paths, n, capacity)
+            self._modify_times = _grow(self._modify_times, n, capacity)
+        self._features[n:new_n] = features
+        self._ids[n:new_n] = ids
+        self._paths[n:new_n] = paths
+        self._modify_times[n:new_n] = modify_times
+        self.size = new_n
+
+
+class VideoFeatureStore:
+    """
+    视频帧特征库
+    features 为全部视频帧特征组成的连续矩阵（PQ模式下为编码），同一视频的帧连续存放，frame_times / frame_end_times 与其逐行对应，
+    一行可以代表一段连续的相似帧，frame_end_times 为其中最后一帧的时间，只有一帧时与 frame_times 相同；
+    paths / modify_times / offsets 每个视频一项，第 i 个视频的帧为 features[offsets[i]:offsets[i + 1]]。
+    搜索时对整个矩阵做一次矩阵乘法，再按 offsets 切分为各个视频。
+    每个视频另有若干摘要向量及其覆盖半径（见 vector_index.get_video_summary），第 i 个视频的摘要为
+    summaries[summary_offsets[i]:summary_offsets[i + 1]]，用于在逐帧打分前排除不可能达到阈值的视频。
+    每次增删记录在 changes 中，新增内容为 (path, modify_time, frame_times, frame_end_times, features)，删除内容为路径列表。
+    每个视频有一个递增的序号 keys，path_index / time_index 为以序号为键的路径子串索引和修改时间索引，按路径和时间筛选时用 get_filter_mask 代替逐个检查。
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.quantizer = None
+        self.changes = ChangeLog()
+        self.path_index = PathIndex()
+        self.time_index = TimeIndex()
+        self._reset()
+
+    @property
+    def generation(self):
+        return self.changes.generation
+
+    def get_changes(self, generation):
+        """获取 generation 之后的变化，见 ChangeLog.since"""
+        with self.lock:
+            return self.changes.since(generation)
+
+    def _reset(self):
+        """清空特征库，换成新的数组而不是原地修改"""
+        self.size = 0  # 帧数量
+        self.count = 0  # 视频数量
+        self._features = np.empty((0, 0), dtype=np.float32)
+        self._frame_times = np.empty(0, dtype=np.int64)
+        self._frame_end_times = np.empty(0, dtype=np.int64)
+        self._paths = np.empty(0, dtype=object)
+        self._modify_times = np.empty(0, dtype=np.float64)
+        self._keys = np.empty(0, dtype=np.int64)  # 视频序号，升序
+        self._next_key = 0
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self.summary_size = 0  # 摘要向量数量
+        self._summaries = np.empty((0, 0), dtype=np.float32)
+        self._summary_radii = np.empty(0, dtype=np.float32)
+        self._summary_offsets = np.zeros(1, dtype=np.int64)
+
+    def snapshot(self):
+        """
+        获取当前特征库的只读视图
+        :return: (features, frame_times, frame_end_times, paths, modify_times, offsets) 元组
+        """
+        with self.lock:
+            return (
+                self._features[:self.size], self._frame_times[:self.size], self._frame_end_times[:self.size],
+                self._paths[:self.count], self._modify_times[:self.count], self._offsets[:self.count + 1],
+            )
+
+    def get_filter_mask(self, path="", start_time=None, end_time=None):
+        """
+        用路径索引和修改时间索引筛选视频，需要与 snapshot() 一致时在 lock 内同时调用，参数见 get_path_time_mask
+        :return: np.ndarray[bool], 与 snapshot() 中 paths 逐个对应的掩码；没有筛选条件时返回 None
+        """
+        with self.lock:
+            n = self.count
+            return get_filter_mask(
+                self._keys[:n], self._paths[:n], self._modify_times[:n], self.path_index, self.time_index, path, start_time, end_time
+            )
+
+    def snapshot_summaries(self):
+        """
+        获取当前视频摘要的只读视图，需要与 snapshot() 一致时在 lock 内同时调用
+        :return: (summaries, summary_radii, summary_offsets) 元组
+        """
+        with self.lock:
+            return (
+                self._summaries[:self.summary_size], self._summary_radii[:self.summary_size],
+                self._summary_offsets[:self.count + 1],
+            )
+
+    def load(self, force=False):
+        """
+        从数据库加载全部视频帧特征
+        :param force: bool, 已经加载过时是否重新加载
+        """
+        with self.lock:
+            if self.loaded and not force:
+                return
+            t0 = time.time()
+            self.quantizer = get_store_quantizer()
+            self._reset()
+            with DatabaseSession() as session:
+                encoding = get_feature_encoding(session)
+                stored_summaries = get_video_summaries(session)
+                paths, modify_times, counts, frame_times, frame_end_times, features = [], [], [], [], [], []
+                for path, modify_time, frame_time, frame_end_time, feature in get_video_path_modify_time_frame_time_features(session):
+                    if not paths or paths[-1] != path:
+                        if len(frame_times) >= LOAD_CHUNK_SIZE:  # 在视频边界分块，保证同一视频的帧连续
+                            self._append_rows(
+                                paths, modify_times, counts, frame_times, frame_end_times, decode_features(features, encoding), stored_summaries
+                            )
+                            paths, modify_times, counts, frame_times, frame_end_times, features = [], [], [], [], [], []
+                        paths.append(path)
+                        modify_times.append(_to_timestamp(modify_time))
+                        counts.append(0)
+                    counts[-1] += 1
+                    frame_times.append(frame_time)
+                    frame_end_times.append(frame_end_time)
+                    features.append(feature)
+                if paths:
+                    self._append_rows(
+                        paths, modify_times, counts, frame_times, frame_end_times, decode_features(features, encoding), stored_summaries
+                    )
+            self.loaded = True
+            self.changes.reset()
+            self.path_index.build(self._keys[:self.count], self._paths[:self.count])
+            self.time_index.build(self._keys[:self.count], self._modify_times[:self.count])
+            logger.info(f"视频帧特征库加载完成，共{self.count}个视频{self.size}帧，用时{time.time() - t0:.2f}秒")
+
+    def _append_rows(self, paths, modify_times, counts, frame_times, frame_end_times, features, stored_summaries):
+        """追加从数据库读到的一批视频，stored_summaries 为数据库中的视频摘要 {路径: (摘要向量, 覆盖半径)}"""
+        summaries = []
+        for path in paths:
+            if path in stored_summaries:
+                summary_features, summary_radii = stored_summaries[path]
+                summary_radii = np.frombuffer(summary_radii, dtype=np.float32)
+                summaries.append((np.frombuffer(summary_features, dtype=np.float32).reshape(len(summary_radii), -1), summary_radii))
+            else:
+                summaries.append(None)
+        self._append(paths, modify_times, counts, frame_times, frame_end_times, self._encode(features), summaries)
+
+    def _encode(self, features):
+        """PQ模式下把原始特征编码后再保存"""
+        if self.quantizer is None:
+            return features
+        return self.quantizer.encode(features)
+
+    def add(self, path, modify_time, frame_times, frame_end_times, features, summary=None):
+        """
+        增量添加一个视频，已存在的同路径视频会被替换
+        :param path: string, 视频路径
+        :param modify_time: datetime.datetime, 修改时间
+        :param frame_times: list[int], 帧时间
+        :param frame_end_times: list[int], 每行合并的最后一帧的时间
+        :param features: np.ndarray, 帧特征，shape=(n, d)
+        :param summary: (摘要向量, 覆盖半径)，None 表示没有摘要，搜索时不剪枝
+        """
+        if len(frame_times) == 0:
+            return
+        with self.lock:
+            if not self.loaded:
+                return
+            self.remove_paths([path])
+            features = np.asarray(features, dtype=np.float32).reshape(len(frame_times), -1)
+            self._append([path], [_to_timestamp(modify_time)], [len(frame_times)], frame_times, frame_end_times, self._encode(features), [summary])
+            self.changes.record(
+                added=(
+                    path, _to_timestamp(modify_time), np.asarray(frame_times, dtype=np.int64),
+                    np.asarray(frame_end_times, dtype=np.int64), features,
+                ),
+                rows=len(frame_times),
+            )
+            self.path_index.add(self._keys[self.count - 1:self.count], [path])
+            self.time_index.add(self._keys[self.count - 1:self.count], self._modify_times[self.count - 1:self.count])
+
+    def remove_paths(self, paths):
+        """
+        删除指定路径的视频
+        :param paths: list[str], 视频路径
+        """
+        if len(paths) == 0:
+            return
+        with self.lock:
+            keep = ~np.isin(self._paths[:self.count], np.asarray(list(paths), dtype=object))
+            if keep.all():
+                return
+            self.changes.record(removed=self._paths[:self.count][~keep].tolist())
+            self.path_index.remove(self._keys[:self.count][~keep])
+            self.time_index.remove(self._keys[:self.count][~keep])
+            counts = np.diff(self._offsets[:self.count + 1])
+            frame_keep = np.repeat(keep, counts)
+            self._features = np.ascontiguousarray(self._features[:self.size][frame_keep])
+            self._frame_times = self._frame_times[:self.size][frame_keep]
+            self._frame_end_times = self._frame_end_times[:self.size][frame_keep]
+            self._paths = self._paths[:self.count][keep]
+            self._modify_times = self._modify_times[:self.count][keep]
+            self._keys = self._keys[:self.count][keep]
+            self._offsets = np.concatenate([[0], np.cumsum(counts[keep])]).astype(np.int64)
+            summary_counts = np.diff(self._summary_offsets[:self.count + 1])
+            summary_keep = np.repeat(keep, summary_counts)
+            self._summaries = np.ascontiguousarray(self._summaries[:self.summary_size][summary_keep])
+            self._summary_radii = self._summary_radii[:self.summary_size][summary_keep]
+            self._summary_offsets = np.concatenate([[0], np.cumsum(summary_counts[keep])]).astype(np.int64)
+            self.size = len(self._frame_times)
+            self.count = len(self._paths)
+            self.summary_size = len(self._summary_radii)
+
+    def _append(self, paths, modify_times, counts, frame_times, frame_end_times, features, summaries):
+        """追加若干视频到末尾，容量不足时按倍数扩容"""
+        d = features.shape[1] if self.quantizer is None else self.quantizer.dim
+        # 没有摘要的视频用一个零向量加无穷大半径代替，上界为无穷大，不会被剪枝
+        summaries = [(np.zeros((1, d), dtype=np.float32), np.full(1, np.inf, dtype=np.float32)) if i is None else i for i in summaries]
+        summary_features = np.concatenate([i[0] for i in summaries])
+        summary_radii = np.concatenate([i[1] for i in summaries])
+        s, new_s = self.summary_size, self.summary_size + len(summary_radii)
+        n, new_n = self.size, self.size + len(frame_times)
+        v, new_v = self.count, self.count + len(paths)
+        if n == 0 and (self._features.shape[1] != features.shape[1] or self._features.dtype != features.dtype):
+            self._features = np.empty((0, features.shape[1]), dtype=features.dtype)
+        if new_n > len(self._frame_times):
+            capacity = max(new_n, len(self._frame_times) * 2, 4096)
+            self._features = _grow(self._features, n, capacity)
+            self._frame_times = _grow(self._frame_times, n, capacity)
+            self._frame_end_times = _grow(self._frame_end_times, n, capacity)
+        if new_v + 1 > len(self._offsets):
+            capacity = max(new_v, len(self._paths) * 2, 1024)
+            self._paths = _grow(self._paths, v, capacity)
+            self._modify_times = _grow(self._modify_times, v, capacity)
+            self._keys = _grow(self._keys, v, capacity)
+            self._offsets = _grow(self._offsets, v + 1, capacity + 1)
+            self._summary_offsets = _grow(self._summary_offsets, v + 1, capacity + 1)
+        if s == 0 and self._summaries.shape[1] != d:
+            self._summaries = np.empty((0, d), dtype=np.float32)
+        if new_s > len(self._summary_radii):
+            capacity = max(new_s, len(self._summary_radii) * 2, 4096)
+            self._summaries = _grow(self._summaries, s, capacity)
+            self._summary_radii = _grow(self._summary_radii, s, capacity)
+        self._summaries[s:new_s] = summary_features
+        self._summary_radii[s:new_s] = summary_radii
+        self._summary_offsets[v + 1:new_v + 1] = s + np.cumsum([len(i[1]) for i in summaries])
+        self.summary_size = new_s
+        self._features[n:new_n] = features
+        self._frame_times[n:new_n] = frame_times
+        self._frame_end_times[n:new_n] = frame_end_times
+        self._paths[v:new_v] = paths
+        self._modify_times[v:new_v] = modify_times
+        self._keys[v:new_v] = np.arange(self._next_key, self._next_key + len(paths))
+        self._next_key += len(paths)
+        self._offsets[v + 1:new_v + 1] = n + np.cumsum(counts)
+        self.size, self.count = new_n, new_v
+
+
+def get_path_time_mask(paths, modify_times, path="", start_time=None, end_time=None):
+    """
+    根据路径和修改时间逐行筛选，用于没有索引的少量数据
+    :param paths: np.ndarray, 路径数组
+    :param modify_times: np.ndarray, 修改时间戳数组
+    :param path: string, 路径需要包含的字符串
+    :param start_time: int, 开始时间戳，单位秒
+    :param end_time: int, 结束时间戳，单位秒
+    :return: np.ndarray[bool], 符合条件的行掩码；没有筛选条件时返回 None
+    """
+    if not (path or start_time or end_time):
+        return None
+    mask = np.ones(len(paths), dtype=bool)
+    if start_time:
+        mask &= modify_times >= start_time
+    if end_time:
+        mask &= modify_times <= end_time
+    if path:
+        path = path.casefold()  # 与 LIKE 一样不区分大小写
+        mask &= np.fromiter((path in p.casefold() for p in paths), dtype=bool, count=len(paths))
+    return mask
+
+
+def get_filter_mask(keys, paths, modify_times, path_index, time_index, path="", start_time=None, end_time=None):
+    """
+    用路径索引和修改时间索引筛选特征库中的行，两个条件的掩码按位与，在打分之前排除不符合的行
+    时间范围用二分查找得到一段键，范围较大时直接比较修改时间更快；路径子串太短不能使用索引时逐行检查
+    :param keys: np.ndarray, 升序排列的键，与 paths / modify_times 逐行对应
+    :param path_index: PathIndex, 路径子串索引
+    :param time_index: TimeIndex, 修改时间索引
+    :return: np.ndarray[bool], 符合条件的行掩码；没有筛选条件时返回 None
+    """
+    if not (path or start_time or end_time):
+        return None
+    mask = None
+    if start_time or end_time:
+        start, end = time_index.get_range(start_time, end_time)
+        if (end - start) * 8 < len(keys):
+            mask = get_key_mask(keys, time_index.keys[start:end])
+        else:
+            mask = get_path_time_mask(paths, modify_times, "", start_time, end_time)
+    if path:
+        matched = path_index.search(path)
+        if matched is None:
+            path_mask = get_path_time_mask(paths, modify_times, path)
+        else:
+            path_mask = get_key_mask(keys, matched)
+        mask = path_mask if mask is None else mask & path_mask
+    return mask
+
+
+def get_key_mask(keys, matched):
+    """
+    :param keys: np.ndarray, 升序排列的键
+    :param matched: np.ndarray, 命中的键，可以包含 keys 中没有的键
+    :return: np.ndarray[bool], keys 中每个键是否命中
+    """
+    mask = np.zeros(len(keys), dtype=bool)
+    rows = np.searchsorted(keys, matched)
+    valid = rows < len(keys)
+    rows, matched = rows[valid], matched[valid]
+    mask[rows[keys[rows] == matched]] = True
+    return mask
+
+
+def _grow(array, used, capacity):
+    new_array = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+    new_array[:used] = array[:used]
+    return new_array
+
+
+def _to_timestamp(modify_time):
+    if modify_time is None:
+        return np.nan
+    return modify_time.timestamp()
+
+
+image_feature_store = ImageFeatureStore()
+video_feature_store = VideoFeatureStore()
@@ -0,0 +1,104 @@
+# 图片解码：在工作进程中读取、解码并缩放裁剪图片，结果为模型输入尺寸的 uint8 像素，直接写入共享内存环形缓冲区。
+# 本模块不加载模型，工作进程只导入这里的代码；像素转为浮点数的 rescale / normalize 由推理阶段完成，见 process_assets.preprocess_pixels
+import logging
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+from pillow_heif import register_heif_opener
+
+from config import IMAGE_DRAFT_DECODE, IMAGE_MIN_WIDTH, IMAGE_MIN_HEIGHT
+
+logger = logging.getLogger(__name__)
+
+_worker = {}  # 工作进程中的环形缓冲区和 image_processor，由 init_worker 设置
+
+
+def get_image_data(path: str, ignore_small_images: bool = True, draft_size: int = None):
+    """
+    获取图片像素数据，如果出错返回 None
+    :param path: string, 图片路径
+    :param ignore_small_images: bool, 是否忽略尺寸过小的图片，按原图尺寸判断
+    :param draft_size: int, 只需要宽高都不小于此值的图片时，直接解码出缩小的版本：JPEG 在DCT域按1/2、1/4、1/8缩小解码，
+                       HEIC 使用内嵌的缩略图，原图不够大或其他格式仍完整解码。None 表示完整解码
+    :return: <class 'numpy.nparray'>, 图片数据，如果出错返回 None
+    """
+    try:
+        image = Image.open(path)
+        if ignore_small_images:
+            width, height = image.size
+            if width < IMAGE_MIN_WIDTH or height < IMAGE_MIN_HEIGHT:
+                return None
+                # processor 中也会这样预处理 Image
+        if draft_size:
+            image.draft("RGB", (draft_size, draft_size))
+        # 在这里提前转为 np.array 避免到时候抛出异常
+        image = image.convert('RGB')
+        image = np.array(image)
+        return image
+    except Exception as e:
+        logger.warning(f"打开图片报错：{path} {repr(e)}")
+        return None
+
+
+def get_image_pixels(image_processor, image):
+    """
+    用 image_processor 缩放裁剪单张图片，不做 rescale / normalize，保留 uint8
+    :param image_processor: processor.image_processor
+    :param image: PIL.Image 或 np.ndarray, RGB图片
+    :return: np.ndarray[uint8], shape=(h, w, 3)
+    """
+    return image_processor(
+        images=[image], do_rescale=False, do_normalize=False, data_format="channels_last", return_tensors="np"
+    )["pixel_values"][0]
+
+
+class PixelRing:
+    """
+    共享内存中的环形缓冲区，shape=(slots, h, w, 3)，uint8。
+    主进程创建并负责分配、归还槽位，工作进程按名字打开后把解码结果写入分配到的槽位，推理阶段直接从槽位读取。
+    """
+
+    def __init__(self, slots, shape, name=None):
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=slots * int(np.prod(shape)))
+        self.name = self.shm.name
+        self.array = np.ndarray((slots, *shape), dtype=np.uint8, buffer=self.shm.buf)
+
+    def close(self, unlink=False):
+        """
+        关闭共享内存
+        :param unlink: bool, 是否释放共享内存，由创建者在所有进程都不再使用后调用
+        """
+        self.array = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def init_worker(ring_name, slots, shape, image_processor):
+    """工作进程初始化：打开环形缓冲区，注册HEIC解码器"""
+    register_heif_opener()
+    _worker["ring"] = PixelRing(slots, shape, ring_name)
+    _worker["image_processor"] = image_processor
+
+
+def decode_to_slot(path, slot, ignore_small_images=True):
+    """
+    在工作进程中解码图片并写入环形缓冲区的指定槽位
+    :param path: string, 图片路径
+    :param slot: int, 槽位
+    :param ignore_small_images: bool, 是否忽略尺寸过小的图片
+    :return: (bool, 是否成功，无法读取或尺寸过小时为 False; float, 耗时秒数)
+    """
+    t0 = time.time()
+    ring = _worker["ring"]
+    image = get_image_data(path, ignore_small_images, max(ring.array.shape[1:3]) if IMAGE_DRAFT_DECODE else None)
+    if image is None:
+        return False, time.time() - t0
+    try:
+        ring.array[slot] = get_image_pixels(_worker["image_processor"], Image.fromarray(image))
+    except Exception as e:
+        logger.warning(f"预处理图片报错：{path} {repr(e)}")
+        return False, time.time() - t0
+    return True, time.time() - t0
@@ -0,0 +1,200 @@
+# 图片入库流水线：读取解码缩放 → 组批 → 模型推理 → 写入数据库，各阶段之间用有界的队列或槽位连接。
+# 解码在进程池中进行，不受GIL限制；工作进程把模型输入尺寸的 uint8 像素写入共享内存环形缓冲区，推理阶段直接从缓冲区读取。
+# 解码与推理互相重叠，模型每次都处理满 SCAN_PROCESS_BATCH_SIZE 张（只有最后一批可能不满）；空闲槽位用完时上游等待，内存占用有上限。
+import logging
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from queue import Queue
+
+import numpy as np
+
+from config import *
+from image_decode import PixelRing, decode_to_slot, init_worker
+from process_assets import get_image_processor, get_pixel_features, get_pixel_shape, preprocess_pixels
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("decode", "batch", "model", "write")
+
+
+class StageStats:
+    """
+    流水线单个阶段的统计：处理的图片数量和实际工作的时间（不含等待队列的时间）
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()  # 解码结果的回调和其他线程可能同时更新
+
+    def add(self, count, seconds):
+        with self.lock:
+            self.count += count
+            self.seconds += seconds
+
+    def to_dict(self):
+        """
+        :return: dict, 处理数量、工作时间和吞吐量（每个工作进程或线程每秒处理的图片数）
+        """
+        return {
+            "count": self.count,
+            "seconds": round(self.seconds, 3),
+            "throughput": round(self.count / self.seconds, 2) if self.seconds else 0,
+        }
+
+
+class ImagePipeline:
+    """
+    图片入库流水线
+    start() 后逐个 put(path, info)，全部放入后 close() 等待流水线处理完毕。
+    write(paths, infos, features, failed) 在单独的写入线程中被调用，每次一批：paths / infos 为提取到特征的图片及放入时附带的信息，
+    features 与 paths 逐行对应；failed 为无法读取或尺寸过小的 (path, info) 列表。
+    is_running 返回 False 后 put 不再接收图片，close 取消还没开始解码的图片，已经解码的图片照常写入。
+    """
+
+    def __init__(self, write, batch_size=SCAN_PROCESS_BATCH_SIZE, decode_workers=SCAN_DECODE_WORKERS,
+                 ignore_small_images=True, is_running=None):
+        self.write = write
+        self.batch_size = max(1, batch_size)
+        self.decode_workers = max(1, decode_workers)
+        self.ignore_small_images = ignore_small_images
+        self.is_running = is_running or (lambda: True)
+        # 一批在组批、一批在等待推理，其余供正在解码的图片使用；推理阶段把像素转为模型输入后即归还槽位
+        self.slots = 2 * self.batch_size + self.decode_workers
+        self.free_slots = Queue()
+        self.image_queue = Queue()  # 数量受槽位限制
+        self.batch_queue = Queue(maxsize=1)
+        self.result_queue = Queue(maxsize=2)
+        self.stats = {name: StageStats() for name in STAGES}
+        self.ring = None
+        self.pixel_values = None  # 预先分配的模型输入，每批复用
+        self.pool = None
+        self.threads = []
+        self.start_time = 0
+
+    def start(self):
+        """创建环形缓冲区和解码进程池，启动组批、推理和写入线程"""
+        self.start_time = time.time()
+        shape = get_pixel_shape()
+        self.ring = PixelRing(self.slots, shape)
+        self.pixel_values = np.empty((self.batch_size, 3, *shape[:2]), dtype=np.float32)
+        for slot in range(self.slots):
+            self.free_slots.put(slot)
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.decode_workers, initializer=init_worker,
+            initargs=(self.ring.name, self.slots, shape, get_image_processor()),
+        )
+        self.threads = [threading.Thread(target=target, daemon=True) for target in (self.assemble, self.infer, self.write_results)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, path, info=None):
+        """
+        放入一张图片，没有空闲槽位时等待
+        :param path: string, 图片路径
+        :param info: 附带的信息，原样传给 write
+        :return: bool, 流水线已停止时不再接收，返回 False
+        """
+        if not self.is_running():
+            return False
+        slot = self.free_slots.get()
+        future = self.pool.submit(decode_to_slot, path, slot, self.ignore_small_images)
+        future.add_done_callback(partial(self.on_decoded, path, info, slot))
+        return True
+
+    def on_decoded(self, path, info, slot, future):
+        """解码完成的回调：成功的图片送去组批，失败的图片只归还槽位"""
+        if future.cancelled():  # 停止扫描时取消的图片不写入，下次扫描时重新处理
+            self.free_slots.put(slot)
+            return
+        try:
+            success, seconds = future.result()
+        except Exception as e:  # 工作进程异常退出等，同样留到下次扫描
+            logger.error(f"解码图片失败：{path} {repr(e)}")
+            self.free_slots.put(slot)
+            return
+        self.stats["decode"].add(1, seconds)
+        if not success:
+            self.free_slots.put(slot)
+            slot = None
+        self.image_queue.put((path, info, slot))
+
+    def close(self):
+        """不再放入图片，等待已放入的图片全部写入；已停止时取消还没开始解码的图片"""
+        self.pool.shutdown(wait=True, cancel_futures=not self.is_running())
+        self.image_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.ring.close(unlink=True)
+        logger.info(f"图片流水线完成，用时{time.time() - self.start_time:.2f}秒，各阶段：{self.get_stats()}")
+
+    def get_stats(self):
+        """
+        :return: dict, 各阶段的处理数量、工作时间和吞吐量
+        """
+        return {name: stats.to_dict() for name, stats in self.stats.items()}
+
+    def assemble(self):
+        """组批阶段：把解码好的槽位凑成满批，全部解码完成后送出最后不满的一批"""
+        paths, infos, slots, failed = [], [], [], []
+        while True:
+            item = self.image_queue.get()
+            if item is None:
+                break
+            path, info, slot = item
+            if slot is None:
+                failed.append((path, info))
+            else:
+                paths.append(path)
+                infos.append(info)
+                slots.append(slot)
+            if len(paths) == self.batch_size or len(failed) == self.batch_size:
+                self.batch_queue.put((paths, infos, slots, failed))
+                paths, infos, slots, failed = [], [], [], []
+        if paths or failed:
+            self.batch_queue.put((paths, infos, slots, failed))
+        self.batch_queue.put(None)
+
+    def infer(self):
+        """推理阶段：从环形缓冲区读取一批像素转为预先分配的模型输入并归还槽位（出错时也归还），再做一次前向计算，预处理或推理出错时整批视为失败"""
+        while True:
+            item = self.batch_queue.get()
+            if item is None:
+                break
+            paths, infos, slots, failed = item
+            features = None
+            if paths:
+                t0 = t1 = time.time()
+                try:
+                    try:
+                        pixel_values = preprocess_pixels([self.ring.array[slot] for slot in slots], self.pixel_values[:len(slots)])
+                    finally:
+                        for slot in slots:
+                            self.free_slots.put(slot)
+                    t1 = time.time()
+                    self.stats["batch"].add(len(paths), t1 - t0)
+                    features = get_pixel_features(pixel_values)
+                except Exception as e:
+                    logger.error(f"批量提取图片特征失败：{repr(e)}")
+                    failed += list(zip(paths, infos))
+                    paths, infos = [], []
+                self.stats["model"].add(len(paths), time.time() - t1)
+            self.result_queue.put((paths, infos, features, failed))
+        self.result_queue.put(None)
+
+    def write_results(self):
+        """写入阶段：调用 write，出错只记录日志，不影响后续批次"""
+        while True:
+            item = self.result_queue.get()
+            if item is None:
+                break
+            paths, infos, features, failed = item
+            t0 = time.time()
+            try:
+                self.write(paths, infos, features, failed)
+            except Exception as e:
+                logger.error(f"写入图片失败：{repr(e)}")
+                logger.exception("Detailed error:")
+            self.stats["write"].add(len(paths) + len(failed), time.time() - t0)
@@ -84,6 +84,9 @@ def init():
         scanner.total_images = get_image_count(session)
         scanner.total_videos = get_video_count(session)
         scanner.total_video_frames = get_video_frame_count(session)
+    # 加载常驻内存的图片和视频帧特征库，之后搜索不再逐次读取数据库
+    image_feature_store.load()
+    video_feature_store.load()
     scanner.db_initialized = True
     
     # 启动自动扫描线程
@@ -280,6 +283,7 @@ def api_match():
     try:
         data = request.get_json()
         top_n = int(data["top_n"])
+        offset = int(data.get("offset", 0))
         search_type = data["search_type"]
         positive_threshold = data["positive_threshold"]
         negative_threshold = data["negative_threshold"]
@@ -300,41 +304,73 @@ def api_match():
         
         logger.debug(f"搜索参数: {data}")
         
-        # 进行匹配
+        # 进行匹配，top_n 和 offset 传入搜索函数，只对排名靠前的结果生成返回数据
         if search_type == 0:  # 文字搜图
             results = search_image_by_text_path_time(
                 data["positive"], data["negative"], 
                 positive_threshold, negative_threshold,
-                path, start_time, end_time
+                path, start_time, end_time, top_n, offset
             )
         elif search_type == 1:  # 以图搜图
-            results = search_image_by_image(upload_file_path, image_threshold)
+            results = search_image_by_image(upload_file_path, image_threshold, top_n, offset)
         elif search_type == 2:  # 文字搜视频
             results = search_video_by_text_path_time(
                 data["positive"], data["negative"], 
                 positive_threshold, negative_threshold,
-                path, start_time, end_time
+                path, start_time, end_time, top_n, offset
             )
         elif search_type == 3:  # 以图搜视频
-            results = search_video_by_image(upload_file_path, image_threshold)
+            results = search_video_by_image(upload_file_path, image_threshold, top_n, offset)
         elif search_type == 5:  # 以图搜图(图片是数据库中的)
-            results = search_image_by_image(img_id, image_threshold)
+            results = search_image_by_image(img_id, image_threshold, top_n, offset)
         elif search_type == 6:  # 以图搜视频(图片是数据库中的)
-            results = search_video_by_image(img_id, image_threshold)
+            results = search_video_by_image(img_id, image_threshold, top_n, offset)
         elif search_type == 9:  # 文字搜pexels视频
-            results = search_pexels_video_by_text(data["positive"], positive_threshold)
+            results = search_pexels_video_by_text(data["positive"], positive_threshold, top_n, offset)
         else:
             logger.warning(f"不支持的搜索类型：{search_type}")
             return jsonify({"error": "不支持的搜索类型"}), 400
             
         # 返回结果
-        return jsonify(results[:top_n])
+        return jsonify(results)
         
     except Exception as e:
         logger.error(f"搜索失败: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/api/match_batch", methods=["POST"])
+@login_required
+def api_match_batch():
+    """
+    批量匹配多个查询对应的素材，全部提示词一次编码，所有查询一起打分
+    请求体：{"search_type": "image" 或 "video", "queries": [{"positive": ..., "negative": ...} 或 {"img_id": ...}], "top_n": ...,
+    可选 positive_threshold, negative_threshold, image_threshold, path, start_time, end_time}
+    :return: json格式的素材信息列表的列表，与 queries 一一对应
+    """
+    try:
+        data = request.get_json()
+        queries = data["queries"]
+        if not isinstance(queries, list):
+            return jsonify({"error": "queries 必须是列表"}), 400
+        search_type = data.get("search_type", "image")
+        if search_type not in ("image", "video"):
+            return jsonify({"error": "不支持的搜索类型"}), 400
+        top_n = data.get("top_n")
+        results = search_batch(
+            queries, search_type,
+            data.get("positive_threshold", POSITIVE_THRESHOLD),
+            data.get("negative_threshold", NEGATIVE_THRESHOLD),
+            data.get("image_threshold", IMAGE_THRESHOLD),
+            data.get("path", ""), data.get("start_time"), data.get("end_time"),
+            None if top_n is None else int(top_n),
+        )
+        return jsonify(results)
+    except Exception as e:
+        logger.error(f"批量搜索失败: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route("/api/get_image/<int:image_id>", methods=["GET"])
 @login_required
 def api_get_image(image_id):
@@ -443,6 +479,7 @@ if __name__ == "__main__":
     # 首先导入不依赖于process_assets的模块
     from database import get_image_path_by_id, is_video_exist, get_pexels_video_count
     from init import *
+    from feature_store import image_feature_store, video_feature_store
     from models import DatabaseSession, DatabaseSessionPexelsVideo
     from utils import crop_video, get_hash, resize_image_with_aspect_ratio
     
@@ -458,6 +495,7 @@ if __name__ == "__main__":
     from scan import Scanner
     from search import (
         clean_cache,
+        search_batch,
         search_image_by_image,
         search_image_by_text_path_time,
         search_video_by_image,
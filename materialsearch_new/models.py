@@ -1,12 +1,15 @@
+import logging
 import os
 
 from sqlalchemy import BINARY, Column, DateTime, Integer, String, Index
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 from config import SQLALCHEMY_DATABASE_URL
 
+logger = logging.getLogger(__name__)
+
 # 数据库目录不存在的时候自动创建目录。TODO：如果是mysql之类的数据库，这里的代码估计是不兼容的
 folder_path = os.path.dirname(SQLALCHEMY_DATABASE_URL.replace("sqlite:///", ""))
 if not os.path.exists(folder_path):
@@ -29,11 +32,23 @@ engine_pexels_video = create_engine(
 DatabaseSessionPexelsVideo = sessionmaker(autocommit=False, autoflush=False, bind=engine_pexels_video)
 
 
+def add_missing_columns():
+    """
+    给旧版本创建的表补上新增的可为空的列
+    """
+    with engine.begin() as connection:
+        columns = {i["name"] for i in inspect(connection).get_columns("video")}
+        if "end_frame_time" not in columns:
+            logger.info("video 表新增 end_frame_time 列")
+            connection.execute(text("ALTER TABLE video ADD COLUMN end_frame_time INTEGER"))
+
+
 def create_tables():
     """
     创建数据库表
     """
     BaseModel.metadata.create_all(bind=engine)
+    add_missing_columns()
     BaseModelPexelsVideo.metadata.create_all(bind=engine_pexels_video)
 
 
@@ -54,11 +69,26 @@ class Video(BaseModel):
     id = Column(Integer, primary_key=True)
     path = Column(String(4096), index=True)  # 文件路径
     frame_time = Column(Integer, index=True)  # 这一帧所在的时间
+    end_frame_time = Column(Integer)  # 合并的连续相似帧中最后一帧的时间，NULL 表示只有这一帧
     modify_time = Column(DateTime)  # 文件修改时间
     features = Column(BINARY)  # 文件预处理后的二进制数据
     checksum = Column(String(40), index=True)  # 文件SHA1
 
 
+class VideoSummary(BaseModel):
+    __tablename__ = "video_summary"
+    id = Column(Integer, primary_key=True)
+    path = Column(String(4096), index=True, unique=True)  # 视频路径
+    features = Column(BINARY)  # 摘要向量，float32，第0行为全部帧的均值，其余为各镜头的聚类中心
+    radii = Column(BINARY)  # 每个摘要向量的覆盖半径，float32
+
+
+class Meta(BaseModel):
+    __tablename__ = "meta"
+    key = Column(String(64), primary_key=True)  # 键，如数据格式版本、迁移标记
+    value = Column(String(256))  # 值
+
+
 class PexelsVideo(BaseModelPexelsVideo):
     __tablename__ = "PexelsVideo"
     id = Column(Integer, primary_key=True)
@@ -69,3 +99,9 @@ class PexelsVideo(BaseModelPexelsVideo):
     thumbnail_loc = Column(String(256), index=True)  # 视频缩略图链接
     content_loc = Column(String(256))  # 视频链接
     thumbnail_feature = Column(BINARY)  # 视频缩略图特征
+
+
+class PexelsVideoMeta(BaseModelPexelsVideo):
+    __tablename__ = "PexelsVideoMeta"
+    key = Column(String(64), primary_key=True)  # 键，如数据格式版本、迁移标记
+    value = Column(String(256))  # 值
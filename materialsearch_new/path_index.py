@@ -0,0 +1,124 @@
+# 路径子串索引：常驻内存的 trigram 倒排索引，搜索时按路径筛选只需处理包含查询子串全部三元组的路径，而不是逐个检查全部路径
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PENDING_MIN_SIZE = 4096  # 新增路径先放在待合并区，超过此数量且超过已索引数量的 PENDING_RATIO 时合并进倒排表
+PENDING_RATIO = 0.1
+
+
+def get_trigrams(paths):
+    """
+    向量化地计算路径中的全部三元组，三个字符的码位各占21位拼成一个 int64
+    :param paths: list[str], 路径列表
+    :return: (三元组编码, 所属路径下标)，均为 np.ndarray，按编码和下标排序且不重复
+    """
+    lengths = np.fromiter((len(i) for i in paths), dtype=np.int64, count=len(paths))
+    if lengths.sum() < 3:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    codes = np.frombuffer("".join(paths).encode("utf-32-le", "surrogatepass"), dtype=np.uint32).astype(np.int64)
+    owners = np.repeat(np.arange(len(paths)), lengths)
+    grams = (codes[:-2] << 42) | (codes[1:-1] << 21) | codes[2:]
+    valid = owners[:-2] == owners[2:]  # 三个字符属于同一路径
+    grams, owners = grams[valid], owners[:-2][valid]
+    order = np.lexsort((owners, grams))
+    grams, owners = grams[order], owners[order]
+    unique = np.ones(len(grams), dtype=bool)
+    unique[1:] = (grams[1:] != grams[:-1]) | (owners[1:] != owners[:-1])
+    return grams[unique], owners[unique]
+
+
+class PathIndex:
+    """
+    路径的 trigram 倒排索引
+    keys 为每个路径对应的键（图片id或视频序号），grams 为排好序的不重复三元组，
+    第 i 个三元组出现在 docs[gram_offsets[i]:gram_offsets[i + 1]] 这些路径中。
+    路径和查询都先做 casefold，与 SQLite LIKE 一样不区分大小写。
+    删除只做标记，新增先放入待合并区，积累到一定数量后整体重建，重建时丢弃已删除的路径。调用方需持有特征库的锁。
+    """
+
+    def __init__(self):
+        self.keys = np.empty(0, dtype=np.int64)
+        self.paths = np.empty(0, dtype=object)
+        self.alive = np.empty(0, dtype=bool)
+        self.grams = np.empty(0, dtype=np.int64)
+        self.gram_offsets = np.zeros(1, dtype=np.int64)
+        self.docs = np.empty(0, dtype=np.int32)
+        self.pending_keys = []
+        self.pending_paths = []
+
+    def build(self, keys, paths):
+        """
+        用全部路径重建索引
+        :param keys: np.ndarray, 每个路径的键
+        :param paths: np.ndarray, 路径
+        """
+        self.keys = np.asarray(keys, dtype=np.int64).copy()
+        self.paths = np.asarray([str(i).casefold() for i in paths], dtype=object)
+        self.alive = np.ones(len(self.keys), dtype=bool)
+        self.pending_keys, self.pending_paths = [], []
+        grams, owners = get_trigrams(self.paths.tolist())
+        self.grams, starts = np.unique(grams, return_index=True)
+        self.gram_offsets = np.append(starts, len(grams)).astype(np.int64)
+        self.docs = owners.astype(np.int32)
+
+    def add(self, keys, paths):
+        """
+        新增路径
+        :param keys: list[int], 每个路径的键
+        :param paths: list[str], 路径
+        """
+        self.pending_keys.extend(int(i) for i in keys)
+        self.pending_paths.extend(i.casefold() for i in paths)
+        if len(self.pending_keys) > max(PENDING_MIN_SIZE, PENDING_RATIO * len(self.keys)):
+            alive = self.alive
+            self.build(
+                np.concatenate([self.keys[alive], self.pending_keys]),
+                np.concatenate([self.paths[alive], np.asarray(self.pending_paths, dtype=object)]),
+            )
+
+    def remove(self, keys):
+        """
+        删除路径
+        :param keys: list[int], 要删除的键
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if len(keys) == 0:
+            return
+        self.alive &= ~np.isin(self.keys, keys)
+        if self.pending_keys:
+            removed = set(keys.tolist())
+            pending = [(k, p) for k, p in zip(self.pending_keys, self.pending_paths) if k not in removed]
+            self.pending_keys = [i[0] for i in pending]
+            self.pending_paths = [i[1] for i in pending]
+
+    def search(self, substring):
+        """
+        查找包含子串的路径
+        :param substring: string, 路径需要包含的字符串
+        :return: np.ndarray, 升序排列的键；子串少于3个字符不能使用索引时返回 None
+        """
+        substring = substring.casefold()
+        if len(substring) < 3:
+            return None
+        docs = None
+        grams = np.unique(get_trigrams([substring])[0])
+        positions = np.searchsorted(self.grams, grams)
+        found = positions < len(self.grams)
+        found[found] = self.grams[positions[found]] == grams[found]
+        if found.all():
+            postings = [self.docs[self.gram_offsets[i]:self.gram_offsets[i + 1]] for i in positions]
+            for posting in sorted(postings, key=len):  # 从最短的倒排表开始求交集
+                docs = posting if docs is None else np.intersect1d(docs, posting, assume_unique=True)
+                if len(docs) == 0:
+                    break
+            docs = docs[self.alive[docs]]
+            # 三元组都出现不代表子串出现，只需再检查这些候选
+            docs = docs[np.fromiter((substring in p for p in self.paths[docs]), dtype=bool, count=len(docs))]
+            keys = self.keys[docs]
+        else:
+            keys = np.empty(0, dtype=np.int64)
+        pending = [k for k, p in zip(self.pending_keys, self.pending_paths) if substring in p]
+        return np.unique(np.concatenate([keys, np.asarray(pending, dtype=np.int64)]))
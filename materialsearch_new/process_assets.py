@@ -6,20 +6,24 @@ import time
 from pathlib import Path
 import os
 
-import cv2
 import numpy as np
 import requests
 import torch
 from PIL import Image
-from tqdm import trange
 from transformers import ChineseCLIPModel, ChineseCLIPProcessor
 from huggingface_hub import snapshot_download
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from config import *
+from image_decode import get_image_data, get_image_pixels
+from text_cache import text_feature_cache
+from video_decode import FrameRows, get_frames
 
 logger = logging.getLogger(__name__)
 
+SCORE_BLOCK_SIZE = 16384  # 按行号打分时每次取出的行数，限制临时矩阵的大小
+
+
 def load_model_with_retry(model_name=None, max_retries=3):
     """
     加载模型和处理器，支持重试机制
@@ -116,6 +120,21 @@ if model is None or processor is None:
 logger.info("Model loaded.")
 
 
+def get_model_id():
+    """
+    当前模型的标识，用于文字特征缓存。自定义模型带上权重文件的修改时间，重新训练覆盖权重后缓存自动失效
+    """
+    if CURRENT_CUSTOM_MODEL and CURRENT_CUSTOM_MODEL in CUSTOM_MODELS:
+        model_path = CUSTOM_MODELS[CURRENT_CUSTOM_MODEL]
+        if os.path.isfile(model_path):
+            return f"{CURRENT_CUSTOM_MODEL}@{int(os.path.getmtime(model_path))}"
+        return CURRENT_CUSTOM_MODEL
+    return MODEL_NAME
+
+
+MODEL_ID = get_model_id()
+
+
 def get_image_feature(images):
     """
     获取图片特征
@@ -127,10 +146,105 @@ def get_image_feature(images):
         # 确保images是列表
         if not isinstance(images, list):
             images = [images]
-            
-        # 使用processor处理图片
-        inputs = processor(images=images, return_tensors="pt")["pixel_values"].to(torch.device(DEVICE))
-        
+        feature = get_pixel_features(get_pixel_values(images))
+    except Exception as e:
+        logger.warning(f"处理图片报错：{repr(e)}")
+        traceback.print_stack()
+    return feature
+
+
+def get_pixel_values(images):
+    """
+    预处理一批图片：image_processor 逐张缩放为 uint8，中心裁剪、rescale、normalize 由 preprocess_pixels 对整批一次完成
+    :param images: list, 图片列表
+    :return: np.ndarray, 模型输入，shape=(n, 3, h, w)，与 processor 的结果逐位一致
+    """
+    resized = processor.image_processor(
+        images=images, do_center_crop=False, do_rescale=False, do_normalize=False, data_format="channels_last"
+    )["pixel_values"]
+    return preprocess_pixels(resized)
+
+
+def get_image_processor():
+    """当前模型的 image_processor，传给解码工作进程"""
+    return processor.image_processor
+
+
+def get_pixel_shape():
+    """
+    模型输入图片的 uint8 像素尺寸，由 image_processor 处理一张空白图片得到
+    :return: tuple, (h, w, 3)
+    """
+    return get_image_pixels(processor.image_processor, Image.new("RGB", (256, 256))).shape
+
+
+def get_pixel_tables():
+    """
+    每个通道 256 种取值的 rescale / normalize 结果，计算方式与 processor 相同：float64 乘以 rescale_factor 后转 float32，再减均值除以标准差
+    :return: np.ndarray[float32], shape=(3, 256)
+    """
+    image_processor = processor.image_processor
+    table = np.arange(256, dtype=np.float64)
+    if image_processor.do_rescale:
+        table = table * image_processor.rescale_factor
+    table = np.repeat(table.astype(np.float32)[None], 3, axis=0)
+    if image_processor.do_normalize:
+        mean = np.asarray(image_processor.image_mean, dtype=np.float32)[:, None]
+        std = np.asarray(image_processor.image_std, dtype=np.float32)[:, None]
+        table = (table - mean) / std
+    return table
+
+
+def center_crop_pixels(image, height, width):
+    """
+    与 processor 的 center_crop 相同地裁剪 uint8 图片，图片比裁剪尺寸小的一边两侧补0
+    :param image: np.ndarray[uint8], shape=(h, w, 3)
+    :return: np.ndarray[uint8], shape=(height, width, 3)，不需要补0时为原图的视图
+    """
+    image_height, image_width = image.shape[:2]
+    top, left = (image_height - height) // 2, (image_width - width) // 2
+    if top >= 0 and left >= 0:
+        return image[top:top + height, left:left + width]
+    padded_height, padded_width = max(height, image_height), max(width, image_width)
+    top_pad, left_pad = -(-(padded_height - image_height) // 2), -(-(padded_width - image_width) // 2)
+    padded = np.zeros((padded_height, padded_width, 3), dtype=image.dtype)
+    padded[top_pad:top_pad + image_height, left_pad:left_pad + image_width] = image
+    top, left = top + top_pad, left + left_pad
+    return padded[max(0, top):top + height, max(0, left):left + width]
+
+
+def preprocess_pixels(images, out=None):
+    """
+    把缩放后的 uint8 图片整批中心裁剪、rescale、normalize，写入 float32 的模型输入，结果与 processor 逐位一致：
+    裁剪只取视图，rescale / normalize 合并为查 get_pixel_tables 的表。逐张查表时数据留在缓存中，比整批一次查表更快
+    :param images: list[np.ndarray[uint8]], 每张 shape=(h, w, 3)，可以是共享内存环形缓冲区中槽位的视图
+    :param out: np.ndarray[float32], 预先分配的输出，shape=(len(images), 3, height, width)，None 时新建
+    :return: np.ndarray[float32], shape=(len(images), 3, height, width)
+    """
+    image_processor = processor.image_processor
+    if image_processor.do_center_crop:
+        height, width = image_processor.crop_size["height"], image_processor.crop_size["width"]
+    else:
+        height, width = images[0].shape[:2]
+    if out is None:
+        out = np.empty((len(images), 3, height, width), dtype=np.float32)
+    table = get_pixel_tables()
+    for i, image in enumerate(images):
+        if image_processor.do_center_crop:
+            image = center_crop_pixels(image, height, width)
+        for channel in range(3):
+            np.take(table[channel], image[:, :, channel], out=out[i, channel])
+    return out
+
+
+def get_pixel_features(pixel_values):
+    """
+    对预处理好的一批图片做一次前向计算，返回归一化的特征
+    :param pixel_values: np.ndarray, 模型输入，shape=(n, 3, h, w)
+    :return: np.ndarray, 图片特征，shape=(n, d)
+    """
+    with torch.no_grad():
+        inputs = torch.from_numpy(pixel_values).to(torch.device(DEVICE))
         # 根据输入类型选择不同的特征提取方法
         if hasattr(model, 'get_image_features'):
             # 使用标准方法
@@ -141,40 +255,9 @@ def get_image_feature(images):
         else:
             # 如果都没有，尝试直接使用vision_model
             features = model.vision_model(inputs)[1]
-            
         # 归一化特征
         features = features / features.norm(dim=-1, keepdim=True)
-        
-        # 转换为numpy数组
-        feature = features.detach().cpu().numpy()
-        
-    except Exception as e:
-        logger.warning(f"处理图片报错：{repr(e)}")
-        traceback.print_stack()
-    return feature
-
-
-def get_image_data(path: str, ignore_small_images: bool = True):
-    """
-    获取图片像素数据，如果出错返回 None
-    :param path: string, 图片路径
-    :param ignore_small_images: bool, 是否忽略尺寸过小的图片
-    :return: <class 'numpy.nparray'>, 图片数据，如果出错返回 None
-    """
-    try:
-        image = Image.open(path)
-        if ignore_small_images:
-            width, height = image.size
-            if width < IMAGE_MIN_WIDTH or height < IMAGE_MIN_HEIGHT:
-                return None
-                # processor 中也会这样预处理 Image
-        # 在这里提前转为 np.array 避免到时候抛出异常
-        image = image.convert('RGB')
-        image = np.array(image)
-        return image
-    except Exception as e:
-        logger.warning(f"打开图片报错：{path} {repr(e)}")
-        return None
+    return features.cpu().numpy()
 
 
 def process_image(path, ignore_small_images=True):
@@ -266,68 +349,35 @@ def process_web_image(url):
     return feature
 
 
-def get_frames(video: cv2.VideoCapture):
-    """ 
-    获取视频的帧数据
-    :return: (list[int], list[array]) (帧编号列表, 帧像素数据列表) 元组
-    """
-    frame_rate = round(video.get(cv2.CAP_PROP_FPS))
-    total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-    logger.debug(f"fps: {frame_rate} total: {total_frames}")
-    ids, frames = [], []
-    for current_frame in trange(
-            0, total_frames, FRAME_INTERVAL * frame_rate, desc="当前进度", unit="frame"
-    ):
-        # 在 FRAME_INTERVAL 为 2（默认值），frame_rate 为 24
-        # 即 FRAME_INTERVAL * frame_rate == 48 时测试
-        # 直接设置当前帧的运行效率低于使用 grab 跳帧
-        # 如果需要跳的帧足够多，也许直接设置效率更高
-        # video.set(cv2.CAP_PROP_POS_FRAMES, current_frame)
-        ret, frame = video.read()
-        if not ret:
-            break
-        ids.append(current_frame // frame_rate)
-        frames.append(frame)
-        if len(frames) == SCAN_PROCESS_BATCH_SIZE:
-            yield ids, frames
-            ids = []
-            frames = []
-        for _ in range(FRAME_INTERVAL * frame_rate - 1):
-            video.grab()  # 跳帧
-    yield ids, frames
-
-
 def process_video(path):
     """
     处理视频并返回处理完成的数据
-    返回一个生成器，每调用一次则返回视频下一个帧的数据
+    返回一个生成器，每调用一次则返回视频下一行的数据。开启 VIDEO_DEDUP 时跳过重复帧，连续的相似帧合并为一行
     :param path: string, 视频路径
-    :return: [int, <class 'numpy.nparray'>], [当前是第几帧（被采集的才算），图片特征]
+    :return: [int, int, <class 'numpy.nparray'>], [这一行第一帧的时间, 最后一帧的时间, 图片特征]
     """
     logger.info(f"处理视频中：{path}")
     try:
-        video = cv2.VideoCapture(path)
-        if not video.isOpened():
-            logger.error(f"无法打开视频文件: {path}")
-            return
-            
-        for ids, frames in get_frames(video):
-            # 转换BGR到RGB
-            rgb_frames = [cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) for frame in frames]
-            # 转换为PIL图像
-            pil_frames = [Image.fromarray(frame) for frame in rgb_frames]
-            # 提取特征
-            features = get_image_feature(pil_frames)
-            
-            if features is None:
-                logger.warning("特征提取失败")
+        shape = get_pixel_shape()
+        pixel_values = np.empty((SCAN_PROCESS_BATCH_SIZE, 3, *shape[:2]), dtype=np.float32)  # 预先分配的模型输入，每批复用
+        frame_rows = FrameRows() if VIDEO_DEDUP else None
+        for ids, pixels in get_frames(path, processor.image_processor, shape):
+            keep = frame_rows.select(pixels) if frame_rows else np.ones(len(ids), dtype=bool)
+            try:
+                features = get_pixel_features(preprocess_pixels(pixels[keep], pixel_values[:int(keep.sum())])) if keep.any() else []
+            except Exception as e:
+                logger.warning(f"特征提取失败：{repr(e)}")
+                if frame_rows:
+                    yield from frame_rows.flush()
                 continue
-                
-            for id, feature in zip(ids, features):
-                yield id, feature
-                
-        video.release()
-        
+            if frame_rows:
+                yield from frame_rows.add(ids, keep, features)
+            else:
+                for id, feature in zip(ids, features):
+                    yield id, id, feature
+        if frame_rows:
+            yield from frame_rows.flush()
+
     except Exception as e:
         logger.error(f"处理视频出错：{path} {repr(e)}")
         return
@@ -342,14 +392,46 @@ def process_text(input_text):
     feature = None
     if not input_text:
         return None
+    feature = text_feature_cache.get(MODEL_ID, input_text)
+    if feature is not None:
+        return feature
     try:
         text = processor(text=input_text, return_tensors="pt", padding=True)["input_ids"].to(torch.device(DEVICE))
         feature = model.get_text_features(text).detach().cpu().numpy()
+        text_feature_cache.put(MODEL_ID, input_text, feature)
     except Exception as e:
         logger.warning(f"处理文字报错：{repr(e)}")
         traceback.print_stack()
     return feature
 
+
+def process_texts(input_texts):
+    """
+    批量预处理文字，未缓存的文字每 SCAN_PROCESS_BATCH_SIZE 条做一次前向计算
+    补齐长度时同时传入 attention_mask，补齐的位置不影响结果，与逐条调用 process_text 得到的特征相同
+    :param input_texts: list[string], 被处理的字符串列表
+    :return: list[<class 'numpy.nparray'>], 与输入一一对应的文字特征，空字符串或出错时为 None
+    """
+    features = [text_feature_cache.get(MODEL_ID, text) if text else None for text in input_texts]
+    missing = list(dict.fromkeys(text for text, feature in zip(input_texts, features) if text and feature is None))
+    computed = {}
+    for start in range(0, len(missing), SCAN_PROCESS_BATCH_SIZE):
+        texts = missing[start:start + SCAN_PROCESS_BATCH_SIZE]
+        try:
+            inputs = processor(text=texts, return_tensors="pt", padding=True)
+            batch_features = model.get_text_features(
+                input_ids=inputs["input_ids"].to(torch.device(DEVICE)),
+                attention_mask=inputs["attention_mask"].to(torch.device(DEVICE)),
+            ).detach().cpu().numpy()
+        except Exception as e:
+            logger.warning(f"批量处理文字报错：{repr(e)}")
+            traceback.print_stack()
+            continue
+        for text, feature in zip(texts, batch_features):
+            computed[text] = feature.reshape(1, -1)
+            text_feature_cache.put(MODEL_ID, text, computed[text])
+    return [computed.get(text) if feature is None and text else feature for text, feature in zip(input_texts, features)]
+
 #对输出的向量特征进行归一化
 def normalize_features(features):
     """
@@ -378,6 +460,30 @@ def multithread_normalize(features):
     # 将处理后的特征重新合并
     return np.concatenate(list(normalized_chunks))
 
+def score_rows(features, vectors, rows=None):
+    """
+    计算特征矩阵中指定行与若干向量的内积，只处理选中的行，不复制整个特征矩阵
+    选中的行在所在区间内较密集时直接对该区间的切片做矩阵乘法（切片不复制），否则每次取出 SCORE_BLOCK_SIZE 行计算
+    :param features: np.ndarray, 特征矩阵，shape=(n, d)
+    :param vectors: np.ndarray, shape=(d, m)
+    :param rows: np.ndarray, 升序的行号，None 表示全部行
+    :return: np.ndarray, shape=(len(rows), m)
+    """
+    if rows is None:
+        return features @ vectors
+    if len(rows) == 0:
+        return np.empty((0, vectors.shape[1]), dtype=np.result_type(features.dtype, vectors.dtype))
+    first, last = int(rows[0]), int(rows[-1]) + 1
+    if last - first <= 2 * len(rows):
+        scores = features[first:last] @ vectors
+        return scores if last - first == len(rows) else scores[rows - first]
+    scores = np.empty((len(rows), vectors.shape[1]), dtype=np.result_type(features.dtype, vectors.dtype))
+    for start in range(0, len(rows), SCORE_BLOCK_SIZE):
+        block = rows[start:start + SCORE_BLOCK_SIZE]
+        scores[start:start + len(block)] = features[block] @ vectors
+    return scores
+
+
 #匹配image_feature列表并返回余弦相似度
 def match_batch(
         positive_feature,
@@ -385,6 +491,8 @@ def match_batch(
         image_features,
         positive_threshold,
         negative_threshold,
+        normalized=False,
+        rows=None,
 ):
     """
     匹配image_feature列表并返回余弦相似度
@@ -393,21 +501,27 @@ def match_batch(
     :param image_features: [<class 'numpy.ndarray'>], 图片特征列表
     :param positive_threshold: int/float, 正向提示分数阈值，高于此分数才显示
     :param negative_threshold: int/float, 反向提示分数阈值，低于此分数才显示
-    :return: <class 'numpy.nparray'>, 提示词和每个图片余弦相似度列表，shape=(n, )，如果小于正向提示分数阈值或大于反向提示分数阈值则会置0
+    :param normalized: bool, image_features 是否已经归一化。数据库中的特征写入时已归一化，传 True 可跳过归一化和矩阵拷贝
+    :param rows: np.ndarray, 升序的行号，只对这些行打分（如路径/时间筛选或向量索引给出的候选），None 表示全部行
+    :return: <class 'numpy.nparray'>, 提示词和每个图片余弦相似度列表，shape=(n, )（指定 rows 时与 rows 逐个对应），如果小于正向提示分数阈值或大于反向提示分数阈值则会置0
     """
+    if not normalized and rows is not None:  # 需要归一化时只归一化选中的行
+        image_features, rows = image_features[rows], None
     # 计算余弦相似度
-    if len(image_features) > 1024:  # 多线程只对大矩阵效果好
+    if normalized:
+        new_features = image_features
+    elif len(image_features) > 1024:  # 多线程只对大矩阵效果好
         new_features = multithread_normalize(image_features)
     else:
         new_features = normalize_features(image_features)
     if positive_feature is None: # 没有正向feature就把分数全部设成1
-        positive_scores = np.ones(len(new_features))
+        positive_scores = np.ones(len(new_features) if rows is None else len(rows))
     else:
         new_text_positive_feature = positive_feature / np.linalg.norm(positive_feature)
-        positive_scores = (new_features @ new_text_positive_feature.T).squeeze(-1)
+        positive_scores = score_rows(new_features, new_text_positive_feature.T, rows).squeeze(-1)
     if negative_feature is not None:
         new_text_negative_feature = negative_feature / np.linalg.norm(negative_feature)
-        negative_scores = (new_features @ new_text_negative_feature.T).squeeze(-1)
+        negative_scores = score_rows(new_features, new_text_negative_feature.T, rows).squeeze(-1)
     # 根据阈值进行过滤
     scores = np.where(positive_scores < positive_threshold / 100, 0, positive_scores)
     if negative_feature is not None:
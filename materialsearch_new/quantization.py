@@ -0,0 +1,215 @@
+# 特征压缩：乘积量化（PQ），用于特征库放不进内存时以压缩编码常驻内存并用查表法计算近似分数
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from config import *
+
+logger = logging.getLogger(__name__)
+
+
+def kmeans(features, k, iterations=20, seed=0):
+    """
+    欧氏距离k-means
+    :param features: np.ndarray, shape=(n, d)
+    :param k: int, 聚类数量
+    :return: np.ndarray, 聚类中心，shape=(k, d)
+    """
+    rng = np.random.default_rng(seed)
+    k = min(k, len(features))
+    centroids = features[rng.choice(len(features), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = assign_nearest_l2(features, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, features)
+        counts = np.bincount(assignments, minlength=k)
+        empty = counts == 0
+        if empty.any():  # 空聚类重新随机选点
+            sums[empty] = features[rng.choice(len(features), int(empty.sum()), replace=False)]
+            counts[empty] = 1
+        centroids = (sums / counts[:, None]).astype(np.float32)
+    return centroids
+
+
+def assign_nearest_l2(features, centroids, chunk_size=65536):
+    """分块计算每个向量欧氏距离最近的聚类中心"""
+    assignments = np.empty(len(features), dtype=np.int64)
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    for i in range(0, len(features), chunk_size):
+        # ||x-c||^2 = ||x||^2 - 2x·c + ||c||^2，||x||^2 对 argmin 没有影响
+        distances = centroid_norms - 2 * features[i:i + chunk_size] @ centroids.T
+        assignments[i:i + chunk_size] = np.argmin(distances, axis=1)
+    return assignments
+
+
+class ProductQuantizer:
+    """
+    乘积量化编码器
+    把 d 维特征切成 m 段子向量，每段用 256 个聚类中心（码本）量化为 1 个字节，一个特征压缩为 m 字节。
+    搜索时对查询向量的每一段预先算出与 256 个中心的内积（查找表），每个编码的近似分数就是 m 次查表之和（非对称距离计算）。
+    """
+
+    def __init__(self, path, m=PQ_SUBVECTORS, ksub=256):
+        self.path = path
+        self.m = m
+        self.ksub = ksub
+        self.lock = threading.Lock()
+        self.codebooks = None  # shape=(m, ksub, d/m)
+
+    @property
+    def trained(self):
+        return self.codebooks is not None
+
+    @property
+    def dim(self):
+        return self.codebooks.shape[0] * self.codebooks.shape[2]
+
+    def train(self, features, iterations=20):
+        """
+        训练每一段的码本
+        :param features: np.ndarray, 训练样本，shape=(n, d)，d 需要能被 m 整除
+        """
+        features = np.asarray(features, dtype=np.float32)
+        d = features.shape[1]
+        if d % self.m:
+            raise ValueError(f"特征维度{d}不能被PQ子向量数量{self.m}整除")
+        t0 = time.time()
+        dsub = d // self.m
+        codebooks = np.zeros((self.m, self.ksub, dsub), dtype=np.float32)
+        for j in range(self.m):
+            centroids = kmeans(features[:, j * dsub:(j + 1) * dsub], self.ksub, iterations, seed=j)
+            codebooks[j, :len(centroids)] = centroids
+        self.codebooks = codebooks
+        logger.info(f"PQ码本训练完成，{self.m}段，样本数量{len(features)}，用时{time.time() - t0:.2f}秒")
+
+    def encode(self, features, chunk_size=65536):
+        """
+        编码
+        :param features: np.ndarray, shape=(n, d)
+        :return: np.ndarray[uint8], shape=(n, m)
+        """
+        features = np.asarray(features, dtype=np.float32).reshape(-1, self.dim)
+        dsub = self.codebooks.shape[2]
+        codes = np.empty((len(features), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = assign_nearest_l2(features[:, j * dsub:(j + 1) * dsub], self.codebooks[j], chunk_size)
+        return codes
+
+    def decode(self, codes):
+        """
+        解码为近似特征
+        :param codes: np.ndarray[uint8], shape=(n, m)
+        :return: np.ndarray, shape=(n, d)
+        """
+        codes = np.asarray(codes)
+        return self.codebooks[np.arange(self.m), codes].reshape(len(codes), -1)
+
+    def lookup_table(self, query):
+        """
+        计算查询向量每一段与各段码本的内积
+        :param query: np.ndarray, shape=(1, d) 或 (d, )
+        :return: np.ndarray, shape=(m, ksub)
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(self.m, -1)
+        return np.einsum("mkd,md->mk", self.codebooks, query)
+
+    def adc_scores(self, query, codes, rows=None):
+        """
+        非对称距离计算：查询用原始向量，库中用编码，通过查表求近似内积
+        :param query: np.ndarray, 查询特征
+        :param codes: np.ndarray[uint8], shape=(n, m)
+        :param rows: np.ndarray, 只计算这些行，None 表示全部行
+        :return: np.ndarray, 近似内积，shape=(n, )，指定 rows 时与 rows 逐个对应
+        """
+        table = self.lookup_table(query)
+        scores = np.zeros(len(codes) if rows is None else len(rows), dtype=np.float32)
+        for j in range(self.m):  # 每段一次查表，不生成 n*m 的临时矩阵，也不复制选中的编码行
+            scores += table[j][codes[:, j] if rows is None else codes[rows, j]]
+        return scores
+
+    def save(self):
+        """保存码本"""
+        tmp_path = self.path + ".tmp.npz"
+        np.savez(tmp_path, codebooks=self.codebooks)
+        os.replace(tmp_path, self.path)
+        logger.info(f"PQ码本已保存：{self.path}")
+
+    def load(self):
+        """
+        加载码本
+        :return: bool, 是否加载成功
+        """
+        with self.lock:
+            if self.trained:
+                return True
+            if not os.path.isfile(self.path):
+                logger.warning(f"PQ码本文件不存在：{self.path}，请先执行 python quantization.py train")
+                return False
+            with np.load(self.path) as data:
+                self.codebooks = data["codebooks"]
+            self.m, self.ksub = self.codebooks.shape[:2]
+            logger.info(f"PQ码本加载完成，{self.m}段，每个特征{self.m}字节")
+            return True
+
+
+class DecodedFeatures:
+    """按行下标解码PQ编码，用于需要原始特征矩阵接口的地方（如向量索引同步），避免一次解码全部特征"""
+
+    def __init__(self, quantizer, codes):
+        self.quantizer = quantizer
+        self.codes = codes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, rows):
+        return self.quantizer.decode(self.codes[rows])
+
+
+def match_batch_pq(quantizer, positive_feature, negative_feature, codes, positive_threshold, negative_threshold, rows=None):
+    """
+    与 process_assets.match_batch 相同，但特征为PQ编码，分数为近似值
+    :param rows: np.ndarray, 只对这些行打分，None 表示全部行
+    :return: np.ndarray, shape=(n, )，指定 rows 时与 rows 逐个对应，不符合阈值的置0
+    """
+    if positive_feature is None:
+        positive_scores = np.ones(len(codes) if rows is None else len(rows), dtype=np.float32)
+    else:
+        positive_scores = quantizer.adc_scores(positive_feature / np.linalg.norm(positive_feature), codes, rows)
+    scores = np.where(positive_scores < positive_threshold / 100, 0, positive_scores)
+    if negative_feature is not None:
+        negative_scores = quantizer.adc_scores(negative_feature / np.linalg.norm(negative_feature), codes, rows)
+        scores = np.where(negative_scores > negative_threshold / 100, 0, scores)
+    return scores
+
+
+feature_quantizer = ProductQuantizer(os.path.join(INDEX_PATH, "feature_pq.npz"))
+
+
+if __name__ == '__main__':
+    import argparse
+    from database import get_random_features, get_feature_encoding, decode_features
+    from models import DatabaseSession
+
+    parser = argparse.ArgumentParser(description='Train the product quantization codebooks of image and video frame features.')
+    parser.add_argument('command', metavar='<command>', choices=['train'], help='train: sample features from the database and train codebooks.')
+    parser.add_argument('--m', type=int, default=PQ_SUBVECTORS, help='number of sub-vectors, i.e. bytes per code.')
+    parser.add_argument('--sample', type=int, default=100000, help='number of sampled features.')
+    args = parser.parse_args()
+
+    with DatabaseSession() as session:
+        samples = get_random_features(session, args.sample)
+        encoding = get_feature_encoding(session)
+    if not samples:
+        print("数据库中没有特征，请先扫描")
+        exit(1)
+    features = decode_features(samples, encoding)
+    feature_quantizer.m = args.m
+    feature_quantizer.train(features)
+    feature_quantizer.save()
+    codes = feature_quantizer.encode(features)
+    error = np.abs((feature_quantizer.decode(codes) * features).sum(axis=1) - 1).mean()
+    print(f'samples: {len(features)}  bytes/feature: {feature_quantizer.m}  mean |1 - cos(x, decode(encode(x)))|: {error:.4f}')
@@ -0,0 +1,114 @@
+# 搜索结果缓存：按查询条件缓存排名靠前的结果，并记录结果对应的特征库 generation，
+# 特征库变化后根据变化记录修补旧结果，而不是在每次扫描后清空全部缓存
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from config import *
+
+RESULT_OVERHEAD = 240  # 每条结果字典的大致内存占用，不含字符串内容
+
+
+def get_array_digest(array):
+    """
+    计算特征向量或id数组的摘要，用作缓存键
+    :param array: np.ndarray 或 None
+    :return: string
+    """
+    if array is None:
+        return None
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha1(array.tobytes())
+    digest.update(str((array.dtype.str, array.shape)).encode())
+    return digest.hexdigest()
+
+
+def estimate_size(results):
+    """
+    估算结果列表占用的内存
+    :param results: list[dict], 搜索结果
+    :return: int, 字节数
+    """
+    size = 64
+    for item in results:
+        size += RESULT_OVERHEAD + sum(len(v) for v in item.values() if isinstance(v, str))
+    return size
+
+
+class CachedResult:
+    """
+    一次查询缓存的结果
+    results 为按分数排序的前 limit 个结果，keys 为每条结果对应的图片id或视频路径，
+    generation 为计算结果时特征库的 generation。结果数量少于 limit 时说明全部符合条件的结果都在其中。
+    """
+
+    def __init__(self, generation, results, keys, limit):
+        self.generation = generation
+        self.results = results
+        self.keys = keys
+        self.limit = limit
+        self.size = estimate_size(results)
+
+    @property
+    def complete(self):
+        """是否包含全部符合条件的结果"""
+        return self.limit is None or len(self.results) < self.limit
+
+    def covers(self, limit):
+        """是否足以返回前 limit 个结果"""
+        if self.complete:
+            return True
+        return limit is not None and limit <= self.limit
+
+
+class ResultCache:
+    """
+    搜索结果缓存，按最近使用排序，总大小超过 max_bytes 时淘汰最久未使用的结果
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # {查询条件: CachedResult}
+        self.size = 0
+
+    def get(self, key):
+        """
+        :param key: tuple, 查询条件
+        :return: CachedResult，未命中时返回 None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        """
+        缓存结果；已有同一 generation 且能覆盖更多结果的缓存时保留原有的
+        :param key: tuple, 查询条件
+        :param entry: CachedResult
+        """
+        if entry.size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+                if old.generation == entry.generation and old.covers(entry.limit) and not entry.covers(old.limit):
+                    entry = old
+            self.entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+result_cache = ResultCache(RESULT_CACHE_SIZE * 1024 * 1024)
@@ -4,9 +4,8 @@ import pickle
 import time
 import os
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from queue import Queue
-from threading import Thread
+from threading import Lock, Thread
 
 import osxphotos
 
@@ -16,19 +15,30 @@ from database import (
     get_video_count,
     get_video_frame_count,
     delete_record_if_not_exist,
-    delete_image_if_outdated,
-    delete_video_if_outdated,
+    delete_images_by_ids,
+    delete_videos_by_paths,
+    get_image_states,
+    get_video_states,
+    is_file_modified,
     add_video,
+    add_video_summary,
     add_image,
+    get_frame_times_features_by_path,
+    get_video_paths_without_summary,
+    get_normalized_feature_bytes,
+    get_feature_encoding,
+    init_feature_encoding,
+    decode_features,
+    normalize_legacy_features,
+    normalize_legacy_pexels_features,
 )
-from models import create_tables, DatabaseSession
-from process_assets import process_images, process_video
-from search import clean_cache
+from feature_store import image_feature_store, video_feature_store
+from image_pipeline import ImagePipeline
+from models import create_tables, DatabaseSession, DatabaseSessionPexelsVideo, Image, Video, PexelsVideo, PexelsVideoMeta
 from utils import get_file_hash
+from video_pipeline import VideoPipeline, sampling_counts
+from vector_index import image_ivf_index, image_hnsw_index, get_video_summary
 
-# 获取CPU核心数，用于线程池大小
-CPU_COUNT = os.cpu_count()
-THREAD_POOL_SIZE = int(CPU_COUNT * 1.5)  # 动态调整线程池大小，根据CPU核心数计算
 PREFETCH_QUEUE_SIZE = 3  # 预读取队列大小
 
 class Scanner:
@@ -50,8 +60,9 @@ class Scanner:
         self.logger = logging.getLogger(__name__)
         self.temp_file = f"{TEMP_PATH}/assets.pickle"
         self.assets = set()
-        self.thread_pool = ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE)
-        self.logger.info(f"Initialized thread pool with {THREAD_POOL_SIZE} workers")
+        self.assets_lock = Lock()  # 图片和视频流水线的写入线程也会修改 assets
+        self.image_pipeline = None
+        self.video_pipeline = None
         self.db_initialized = False
         self.prefetch_queue = Queue(maxsize=PREFETCH_QUEUE_SIZE)
         self.prefetch_thread = None
@@ -67,9 +78,7 @@ class Scanner:
         self.extensions = IMAGE_EXTENSIONS + VIDEO_EXTENSIONS
 
     def __del__(self):
-        """清理线程池和预读取队列"""
-        if hasattr(self, 'thread_pool'):
-            self.thread_pool.shutdown(wait=True)
+        """清理预读取队列"""
         if hasattr(self, 'prefetch_thread') and self.prefetch_thread:
             self.prefetch_queue.put(None)  # 发送停止信号
             self.prefetch_thread.join()
@@ -78,14 +87,41 @@ class Scanner:
         """初始化数据库和表"""
         self.logger.info("Initializing database tables...")
         create_tables()
+        # 旧数据库中的特征可能未归一化，一次性迁移后搜索时不再归一化
+        with DatabaseSession() as session:
+            normalize_legacy_features(session)
+            init_feature_encoding(session, FEATURE_ENCODING, [Image, Video])
+        with DatabaseSessionPexelsVideo() as session:
+            normalize_legacy_pexels_features(session)
+            init_feature_encoding(session, FEATURE_ENCODING, [PexelsVideo], PexelsVideoMeta)
+        if VIDEO_SUMMARY_SIZE:  # 旧版本扫描的视频没有摘要向量，补算后视频搜索才能剪枝
+            with DatabaseSession() as session:
+                self.add_missing_video_summaries(session)
         #用SQL查询当前数据库中的信息
         with DatabaseSession() as session:
             self.total_images = get_image_count(session)
             self.total_videos = get_video_count(session)
             self.total_video_frames = get_video_frame_count(session)
+        image_feature_store.load()
+        video_feature_store.load()
+        if ENABLE_IVF_INDEX and image_ivf_index.load():
+            image_feature_store.attach_index(image_ivf_index)  # 之后扫描增删图片会同步更新索引
+        if ENABLE_HNSW_INDEX and image_hnsw_index.load():
+            image_feature_store.attach_index(image_hnsw_index)
         self.db_initialized = True
         self.logger.info("Database initialization completed.")
 
+    def add_missing_video_summaries(self, session):
+        """为没有摘要的视频补算摘要向量"""
+        paths = get_video_paths_without_summary(session)
+        if not paths:
+            return
+        self.logger.info(f"为{len(paths)}个视频补算摘要向量")
+        encoding = get_feature_encoding(session)
+        for path in paths:
+            frame_times, features = get_frame_times_features_by_path(session, path)
+            add_video_summary(session, path, *get_video_summary(decode_features(features, encoding), VIDEO_SUMMARY_SIZE))
+
     def get_status(self):
         """
         获取扫描状态信息
@@ -113,11 +149,15 @@ class Scanner:
             "progress": progress,
             "remain_time": int(remain_time),
             "enable_login": ENABLE_LOGIN,
+            "image_pipeline": self.image_pipeline.get_stats() if self.image_pipeline else {},
+            "video_pipeline": self.video_pipeline.get_stats() if self.video_pipeline else {},
+            "video_progress": self.video_pipeline.get_progress() if self.video_pipeline else {},
+            "video_sampling": dict(sampling_counts),
         }
 
     def save_assets(self):
         #保存assets到临时文件
-        with open(self.temp_file, "wb") as f:
+        with self.assets_lock, open(self.temp_file, "wb") as f:
             pickle.dump(self.assets, f)
 
     def filter_path(self, path) -> bool:
@@ -251,55 +291,73 @@ class Scanner:
         finally:
             self.prefetch_queue.put(None)  # 发送结束信号
 
-    def handle_image_batch(self, session, image_batch_dict):
-        """使用线程池处理图片批量"""
-        path_list = list(image_batch_dict.keys())
-        if not path_list:
-            return
-
-        # 使用线程池处理图片
-        future_to_path = {
-            self.thread_pool.submit(process_images, [path]): path 
-            for path in path_list
-        }
-
-        # 收集处理结果
-        batch_images = []  # 用于批量写入的图片列表
-        for future in as_completed(future_to_path):
-            path = future_to_path[future]
-            try:
-                path_list, features_list = future.result()
-                if path_list and features_list is not None:
-                    for p, features in zip(path_list, features_list):
-                        # 准备批量写入的数据
-                        modify_time, checksum = image_batch_dict[p]
-                        batch_images.append({
-                            'path': p,
-                            'modify_time': modify_time,
-                            'checksum': checksum,
-                            'features': features.tobytes()
-                        })
-                        if p in self.assets:  # 确保文件还在assets中
-                            self.assets.remove(p)
-            except Exception as e:
-                self.logger.error(f"Error processing image {path}: {e}")
-                self.logger.exception("Detailed error:")
-            finally:
-                if path in self.assets:  # 确保文件还在assets中
-                    self.assets.remove(path)
-
-        # 批量写入数据库
-        if batch_images:
-            try:
-                from database import Image
-                session.bulk_insert_mappings(Image, batch_images)
-                session.commit()
-                self.logger.info(f"批量写入 {len(batch_images)} 张图片到数据库")
-            except Exception as e:
-                self.logger.error(f"批量写入数据库失败: {e}")
-                session.rollback()
+    def write_image_batch(self, paths, infos, features, failed):
+        """
+        图片流水线的写入阶段，在写入线程中运行：删除修改过的图片的旧记录，批量写入新记录，并同步更新特征库
+        :param paths: list[str], 提取到特征的图片路径
+        :param infos: list[tuple], 每张图片的 (修改时间, hash, 旧记录id)，新文件的旧记录id为 None
+        :param features: np.ndarray, 图片特征，与 paths 逐行对应
+        :param failed: list[(str, tuple)], 无法读取或提取特征失败的图片，旧记录同样删除
+        """
+        outdated_ids = [info[2] for info in infos + [i[1] for i in failed] if info[2] is not None]
+        with DatabaseSession() as session:
+            if outdated_ids:
+                delete_images_by_ids(session, outdated_ids)
+                image_feature_store.remove_ids(outdated_ids)
+            if paths:
+                encoding = get_feature_encoding(session)
+                batch_images = [
+                    {
+                        'path': path,
+                        'modify_time': modify_time,
+                        'checksum': checksum,
+                        'features': get_normalized_feature_bytes(feature, encoding),
+                    }
+                    for path, (modify_time, checksum, _), feature in zip(paths, infos, features)
+                ]
+                try:
+                    # return_defaults=True 会回填自增id，用于增量更新特征库
+                    session.bulk_insert_mappings(Image, batch_images, return_defaults=True)
+                    session.commit()
+                    self.logger.info(f"批量写入 {len(batch_images)} 张图片到数据库")
+                    image_feature_store.add(
+                        [i['id'] for i in batch_images],
+                        paths,
+                        [i['modify_time'] for i in batch_images],
+                        decode_features([i['features'] for i in batch_images], encoding),
+                    )
+                except Exception as e:
+                    self.logger.error(f"批量写入数据库失败: {e}")
+                    session.rollback()
+            self.total_images = get_image_count(session)
+        with self.assets_lock:
+            self.assets.difference_update(paths)
+            self.assets.difference_update(i[0] for i in failed)
 
-        self.total_images = get_image_count(session)
+    def write_video(self, path, info, rows):
+        """
+        视频流水线的写入阶段，在写入线程中运行：删除修改过的视频的旧记录，一次提交新记录，并同步更新摘要和特征库
+        :param path: string, 视频路径
+        :param info: tuple, (修改时间, hash, 是否有旧记录)
+        :param rows: list[tuple], (帧时间, 结束帧时间, 特征) 列表，解码或提取特征出错时为 None，旧记录同样删除
+        """
+        modify_time, checksum, outdated = info
+        with DatabaseSession() as session:
+            if outdated:
+                delete_videos_by_paths(session, [path])
+            video_feature_store.remove_paths([path])
+            if rows:
+                feature_bytes = add_video(session, path, modify_time, checksum, rows)  # 与数据库中相同的归一化、编码后的特征
+                features = decode_features(feature_bytes, get_feature_encoding(session))
+                summary = None
+                if VIDEO_SUMMARY_SIZE:
+                    summary = get_video_summary(features, VIDEO_SUMMARY_SIZE)
+                    add_video_summary(session, path, *summary)
+                video_feature_store.add(path, modify_time, [i[0] for i in rows], [i[1] for i in rows], features, summary)
+            self.total_video_frames = get_video_frame_count(session)
+            self.total_videos = get_video_count(session)
+        with self.assets_lock:
+            self.assets.discard(path)
 
     def scan(self, auto=False):
         """
@@ -317,7 +375,13 @@ class Scanner:
         with DatabaseSession() as session:
             # 删除不存在的文件记录
             if not self.is_continue_scan:
-                delete_record_if_not_exist(session, self.assets)
+                deleted_image_ids, deleted_video_paths = delete_record_if_not_exist(session, self.assets)
+                image_feature_store.remove_ids(deleted_image_ids)
+                video_feature_store.remove_paths(deleted_video_paths)
+
+            # 一次性读取数据库中全部文件的修改时间和hash，之后在内存中比对，未修改的文件不再访问数据库
+            image_states = get_image_states(session)
+            video_states = get_video_states(session)
             
             # 获取所有图片路径
             image_paths = [p for p in self.assets if p.lower().endswith(IMAGE_EXTENSIONS)]
@@ -328,47 +392,46 @@ class Scanner:
             
             skipped_files = 0
             processed_files = 0
-            
-            # 处理预读取的批次
-            while True:
-                batch_dict = self.prefetch_queue.get()
-                if batch_dict is None:  # 收到结束信号
-                    break
-                    
-                # 处理当前批次
-                not_modified_paths = []
-                for path, (modify_time, checksum) in batch_dict.items():
-                    if delete_image_if_outdated(session, path, modify_time, checksum):
-                        not_modified_paths.append(path)
-                        skipped_files += 1
-                    else:
-                        processed_files += 1
-                
-                # 移除未修改的文件
-                for path in not_modified_paths:
-                    batch_dict.pop(path)
-                    if path in self.assets:
-                        self.assets.remove(path)
-                
-                # 处理修改过的文件
-                if batch_dict:
-                    self.handle_image_batch(session, batch_dict)
-                
-                self.scanned_files = processed_files + skipped_files
-                
-                # 自动保存
-                if self.scanned_files % AUTO_SAVE_INTERVAL == 0:
-                    self.save_assets()
-                
-                # 检查是否需要停止扫描
-                if auto and not self.is_current_auto_scan_time():
-                    self.logger.info("超出自动扫描时间，停止扫描")
-                    break
-            
+
+            # 未修改的文件直接跳过，其余放入图片流水线，由流水线的写入线程批量写入
+            self.image_pipeline = ImagePipeline(self.write_image_batch, is_running=lambda: self.is_scanning)
+            self.image_pipeline.start()
+            try:
+                while True:
+                    batch_dict = self.prefetch_queue.get()
+                    if batch_dict is None:  # 收到结束信号
+                        break
+
+                    for path, (modify_time, checksum) in batch_dict.items():
+                        state = image_states.get(path)
+                        if state is not None and not is_file_modified(path, state[0], state[1], modify_time, checksum):
+                            skipped_files += 1
+                            with self.assets_lock:
+                                self.assets.discard(path)
+                        elif self.image_pipeline.put(path, (modify_time, checksum, None if state is None else state[2])):
+                            processed_files += 1  # 修改过的文件由写入阶段删除旧记录
+
+                    self.scanned_files = processed_files + skipped_files
+
+                    # 自动保存
+                    if self.scanned_files % AUTO_SAVE_INTERVAL == 0:
+                        self.save_assets()
+
+                    # 检查是否需要停止扫描
+                    if auto and not self.is_current_auto_scan_time():
+                        self.logger.info("超出自动扫描时间，停止扫描")
+                        break
+            finally:
+                self.image_pipeline.close()  # 等待已放入的图片全部写入，停止扫描时取消还没开始解码的图片
+
             # 处理视频文件
-            # 一个视频通常会有多个帧特征，写入视频表和帧特征表
-            for path in list(self.assets):
-                if path.lower().endswith(VIDEO_EXTENSIONS):
+            # 一个视频通常会有多个帧特征，未修改的视频直接跳过，其余放入视频流水线，多个视频的帧拼成满批推理，由流水线的写入线程逐个视频写入
+            self.video_pipeline = VideoPipeline(self.write_video, is_running=lambda: self.is_scanning)
+            self.video_pipeline.start()
+            try:
+                for path in list(self.assets):
+                    if not path.lower().endswith(VIDEO_EXTENSIONS):
+                        continue
                     try:
                         modify_time = os.path.getmtime(path)
                         checksum = None
@@ -381,21 +444,26 @@ class Scanner:
                             modify_time = None
                             if not checksum:
                                 checksum = get_file_hash(path)
-                        
-                        if delete_video_if_outdated(session, path, modify_time, checksum):
-                            skipped_files += 1
-                        else:
-                            add_video(session, path, modify_time, checksum, process_video(path))
-                            processed_files += 1
-                            self.total_video_frames = get_video_frame_count(session)
-                            self.total_videos = get_video_count(session)
                     except Exception as e:
                         self.logger.error(f"Error processing video {path}: {e}")
                         self.logger.exception("Detailed error:")
-                    finally:
-                        if path in self.assets:
-                            self.assets.remove(path)
-            
+                        with self.assets_lock:
+                            self.assets.discard(path)
+                        continue
+
+                    state = video_states.get(path)
+                    if state is not None and not is_file_modified(path, *state, modify_time, checksum):
+                        skipped_files += 1
+                        with self.assets_lock:
+                            self.assets.discard(path)
+                    elif self.video_pipeline.put(path, (modify_time, checksum, state is not None)):
+                        processed_files += 1  # 修改过的文件由写入阶段删除旧记录
+                    else:
+                        break
+                    self.scanned_files = processed_files + skipped_files
+            finally:
+                self.video_pipeline.close()  # 等待已放入的视频全部写入，停止扫描时取消还没开始解码的视频
+
             # 最后重新统计一下数量
             self.total_images = get_image_count(session)
             self.total_videos = get_video_count(session)
@@ -410,7 +478,7 @@ class Scanner:
         self.scanning_files = 0
         self.scanned_files = 0
         os.remove(self.temp_file)
-        clean_cache()
+        image_feature_store.save_indexes()  # 搜索结果缓存会根据特征库的变化记录自行修补，不需要清空
         self.is_scanning = False
 
 
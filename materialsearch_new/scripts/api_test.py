@@ -128,6 +128,35 @@ def test_api_match():
     # TODO：get_video
 
 
+def test_api_match_batch():
+    payload = {
+        "search_type": "image",
+        "queries": [{"positive": "white", "negative": ""}, {"positive": "white"}, {"positive": "black", "negative": "white"}],
+        "top_n": 6,
+        "positive_threshold": 10,
+        "negative_threshold": 10,
+        "path": "test.png",
+    }
+    response = requests.post('http://127.0.0.1:8085/api/match_batch', json=payload)
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data) == 3
+    assert data[0] == data[1]
+    assert len(data[0]) == 1
+    assert data[0][0]["path"] == "test.png"
+    assert data[0][0]["score"] != 0
+    # 批量结果与单条搜索相同
+    response = requests.post('http://127.0.0.1:8085/api/match', json={
+        "positive": "white", "negative": "", "top_n": "6", "search_type": 0, "positive_threshold": 10,
+        "negative_threshold": 10, "image_threshold": 85, "img_id": -1, "path": "test.png", "start_time": None, "end_time": None,
+    })
+    assert response.json() == data[0]
+    # 不支持的搜索类型
+    payload["search_type"] = "pexels"
+    response = requests.post('http://127.0.0.1:8085/api/match_batch', json=payload)
+    assert response.status_code == 400
+
+
 # 运行测试
 if __name__ == '__main__':
     pytest.main()
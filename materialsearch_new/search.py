@@ -1,33 +1,117 @@
 import logging
 import time
 import base64
-from functools import lru_cache
+from functools import lru_cache, partial
 
 import numpy as np
 
 from config import *
 from database import (
-    get_image_id_path_features_filter_by_path_time,
     get_image_features_by_id,
-    get_video_paths,
-    get_frame_times_features_by_path,
+    get_image_features_by_ids,
+    get_frame_times_features_by_paths,
     get_pexels_video_features,
+    get_pexels_video_version,
+    get_feature_encoding,
+    decode_features,
 )
-from models import DatabaseSession, DatabaseSessionPexelsVideo
-from process_assets import match_batch, process_image, process_text
+from feature_store import image_feature_store, video_feature_store, get_path_time_mask
+from models import DatabaseSession, DatabaseSessionPexelsVideo, PexelsVideoMeta
+from process_assets import match_batch, process_image, process_text, process_texts, score_rows
+from quantization import match_batch_pq
+from result_cache import CachedResult, result_cache, get_array_digest
+from vector_index import image_ivf_index, image_hnsw_index, get_candidate_rows, get_video_upper_bounds
 
 logger = logging.getLogger(__name__)
 
+BATCH_SCORE_SIZE = 1 << 24  # 批量搜索时每块分数矩阵的元素数量上限，限制内存占用
+HNSW_FILTER_SCAN_RATIO = 64  # 筛选后剩下的图片不超过 max(HNSW_EF_SEARCH, 需要的数量) 的这么多倍时，不用图索引，直接精确打分
+
 
 def clean_cache():
     """
     清空搜索缓存
     """
-    search_image_by_text_path_time.cache_clear()
-    search_image_by_image.cache_clear()
-    search_video_by_image.cache_clear()
-    search_video_by_text_path_time.cache_clear()
-    search_pexels_video_by_text.cache_clear()
+    result_cache.clear()
+    process_upload_image.cache_clear()
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def process_upload_image(img_path):
+    """上传的图片以文件哈希命名，同一路径的内容不会变化，可以直接缓存特征"""
+    return process_image(img_path)
+
+
+def get_cached_results(key, store, limit, patch=None):
+    """
+    获取缓存的前 limit 个结果，特征库在缓存之后有变化时用变化记录修补
+    :param key: tuple, 查询条件
+    :param store: 特征库，None 表示结果不随特征库变化
+    :param limit: int, 需要的结果数量，None 表示全部
+    :param patch: function(entry, changes), 返回修补后的 CachedResult，无法修补时返回 None
+    :return: list[dict]，未命中或无法修补时返回 None
+    """
+    entry = result_cache.get(key)
+    if entry is None or not entry.covers(limit):
+        return None
+    if store is not None and entry.generation != store.generation:
+        changes = store.get_changes(entry.generation)
+        if changes is None:  # 变化记录已被丢弃
+            return None
+        entry = patch(entry, changes)
+        if entry is None:
+            return None
+        result_cache.put(key, entry)
+        logger.debug(f"根据{len(changes)}次变化修补了缓存的搜索结果")
+    return entry.results[:limit]
+
+
+def merge_results(entry, stale, results, keys, generation):
+    """
+    去掉缓存结果中失效的项，与新增素材的结果合并后按分数重新排序
+    :param entry: CachedResult, 缓存的结果
+    :param stale: np.ndarray[bool], 失效的缓存结果
+    :param results: list[dict], 新增素材的结果
+    :param keys: list, 新增结果对应的图片id或视频路径
+    :param generation: int, 修补后的 generation
+    :return: CachedResult，失效的结果之后的排名未知时返回 None
+    """
+    if stale.any() and not entry.complete:
+        return None
+    merged = [(item, key) for item, key, is_stale in zip(entry.results, entry.keys, stale) if not is_stale]
+    merged += list(zip(results, keys))
+    merged.sort(key=lambda x: -x[0]["score"])
+    merged = merged[:entry.limit]
+    return CachedResult(generation, [i[0] for i in merged], [i[1] for i in merged], entry.limit)
+
+
+def get_top_indexes(scores, top_n=None, offset=0):
+    """
+    用部分排序（argpartition）选出分数排名第 offset ~ offset+top_n 的非零项，避免对全部结果排序
+    :param scores: np.ndarray, 分数，不符合阈值的为0
+    :param top_n: int, 返回数量，None 表示全部
+    :param offset: int, 跳过排名靠前的数量，用于分页
+    :return: np.ndarray, 按分数从高到低排列的下标
+    """
+    candidates = np.flatnonzero(scores)
+    k = len(candidates) if top_n is None else min(offset + top_n, len(candidates))
+    if k <= offset:
+        return candidates[:0]
+    candidate_scores = scores[candidates]
+    if k < len(candidates):
+        selected = np.argpartition(-candidate_scores, k - 1)[:k]
+    else:
+        selected = np.arange(len(candidates))
+    selected = selected[np.argsort(-candidate_scores[selected], kind="stable")]
+    return candidates[selected[offset:]]
+
+
+def get_image_result(image_id, path, score):
+    return {
+        "url": "api/get_image/%d?thumbnail=1" % image_id,
+        "path": path,
+        "score": float(score),
+    }
 
 
 def search_image_by_feature(
@@ -38,6 +122,10 @@ def search_image_by_feature(
         path="",
         start_time=None,
         end_time=None,
+        top_n=None,
+        offset=0,
+        exact=False,
+        candidate_ids=None,
 ):
     """
     通过特征搜索图片
@@ -48,30 +136,139 @@ def search_image_by_feature(
     :param path: string, 视频路径
     :param start_time: int, 开始时间戳，单位秒，用于匹配modify_time
     :param end_time: int, 结束时间戳，单位秒，用于匹配modify_time
-    :return: list[dict], 搜索结果列表
+    :param top_n: int, 返回结果数量，None 表示全部
+    :param offset: int, 跳过的结果数量，用于分页
+    :param exact: bool, 是否强制精确搜索。为 False 且启用了IVF索引时，只对索引给出的候选精确打分
+    :param candidate_ids: np.ndarray, 只在这些图片中搜索，如HNSW索引给出的最近邻
+    :return: list[dict], 搜索结果列表，按分数从高到低排序
+    """
+    image_feature_store.load()  # 已加载时直接返回
+    limit = None if top_n is None else offset + top_n
+    key, patch = get_image_cache_key(
+        positive_feature, negative_feature, positive_threshold, negative_threshold, path, start_time, end_time, exact, candidate_ids
+    )
+    results = get_cached_results(key, image_feature_store, limit, patch)
+    if results is None:
+        generation, results, result_ids = _search_image_by_feature(
+            positive_feature, negative_feature, positive_threshold, negative_threshold,
+            path, start_time, end_time, limit, exact, candidate_ids,
+        )
+        result_cache.put(key, CachedResult(generation, results, result_ids, limit))
+    return results[offset:]
+
+
+def get_image_cache_key(
+        positive_feature, negative_feature, positive_threshold, negative_threshold,
+        path, start_time, end_time, exact=False, candidate_ids=None,
+):
+    """
+    :return: (图片搜索结果的缓存键, 修补缓存结果的函数)
+    """
+    key = (
+        "image", get_array_digest(positive_feature), get_array_digest(negative_feature), positive_threshold,
+        negative_threshold, path, start_time, end_time, exact, get_array_digest(candidate_ids),
+    )
+    patch = partial(
+        patch_image_results, positive_feature=positive_feature, negative_feature=negative_feature,
+        positive_threshold=positive_threshold, negative_threshold=negative_threshold,
+        path=path, start_time=start_time, end_time=end_time, candidate_ids=candidate_ids,
+    )
+    return key, patch
+
+
+def patch_image_results(
+        entry, changes, positive_feature, negative_feature, positive_threshold, negative_threshold,
+        path, start_time, end_time, candidate_ids,
+):
+    """
+    根据图片特征库的变化修补缓存的搜索结果：去掉被删除的图片，对新增的图片精确打分后合并
+    :param entry: CachedResult, 缓存的结果
+    :param changes: list, ImageFeatureStore.get_changes 返回的变化记录
+    :return: CachedResult，无法修补时返回 None
+    """
+    removed = set()
+    added = {}  # {id: (path, 修改时间, 特征)}，按顺序处理，之后又被删除的不算新增
+    for _, add, remove in changes:
+        if remove is not None:
+            ids = np.asarray(remove).tolist()
+            removed.update(ids)
+            for i in ids:
+                added.pop(i, None)
+        if add is not None:
+            ids = add[0].tolist()
+            removed.update(ids)
+            added.update(zip(ids, zip(add[1], add[2], add[3])))
+    stale = np.isin(np.asarray(entry.keys, dtype=np.int64), np.fromiter(removed, dtype=np.int64, count=len(removed)))
+    results, result_ids = [], []
+    if candidate_ids is not None:
+        candidates = set(np.asarray(candidate_ids).tolist())
+        added = {i: v for i, v in added.items() if i in candidates}
+    if added:
+        ids = np.fromiter(added.keys(), dtype=np.int64, count=len(added))
+        paths = np.asarray([v[0] for v in added.values()], dtype=object)
+        modify_times = np.asarray([v[1] for v in added.values()], dtype=np.float64)
+        features = np.stack([v[2] for v in added.values()])
+        scores = match_batch(positive_feature, negative_feature, features, positive_threshold, negative_threshold, normalized=True)
+        mask = get_path_time_mask(paths, modify_times, path, start_time, end_time)
+        if mask is not None:
+            scores = np.where(mask, scores, 0)
+        for i in np.flatnonzero(scores):
+            results.append(get_image_result(ids[i], paths[i], scores[i]))
+            result_ids.append(int(ids[i]))
+    return merge_results(entry, stale, results, result_ids, changes[-1][0])
+
+
+def _search_image_by_feature(
+        positive_feature, negative_feature, positive_threshold, negative_threshold,
+        path, start_time, end_time, top_n, exact, candidate_ids,
+):
+    """
+    在图片特征库中搜索前 top_n 个结果，参数见 search_image_by_feature
+    :return: (特征库的 generation, 结果列表, 结果对应的图片id列表)
     """
     t0 = time.time()
-    with DatabaseSession() as session:
-        ids, paths, features = get_image_id_path_features_filter_by_path_time(session, path, start_time, end_time)
+    with image_feature_store.lock:
+        generation = image_feature_store.generation
+        features, ids, paths, modify_times = image_feature_store.snapshot()
+        mask = image_feature_store.get_filter_mask(path, start_time, end_time)
+    rows = None if mask is None else np.flatnonzero(mask)  # 筛选条件统一为升序行号，打分内核只处理这些行
+    use_ivf = candidate_ids is None and not exact and positive_feature is not None and image_ivf_index in image_feature_store.indexes
+    if use_ivf and (rows is None or len(rows) > len(ids) * IVF_NPROBE / image_ivf_index.nlist):
+        # 筛选后剩下的行比IVF大约要探查的行还少时，直接对这些行精确打分
+        candidate_ids = image_ivf_index.search(positive_feature, IVF_NPROBE)
+    if candidate_ids is not None:
+        candidate_rows = get_candidate_rows(ids, candidate_ids)
+        rows = candidate_rows if mask is None else candidate_rows[mask[candidate_rows]]
+    if rows is not None:  # 只取出选中行的id和路径，特征由打分内核按行号读取，不复制
+        ids, paths = ids[rows], paths[rows]
     if len(ids) == 0:  # 没有素材，直接返回空
-        return []
-    features = np.frombuffer(b"".join(features), dtype=np.float32).reshape(len(features), -1)
-    scores = match_batch(positive_feature, negative_feature, features, positive_threshold, negative_threshold)
-    return_list = []
-    for id, path, score in zip(ids, paths, scores):
-        if not score:
-            continue
-        return_list.append({
-            "url": "api/get_image/%d?thumbnail=1" % id,
-            "path": path,
-            "score": float(score),
-        })
-    return_list = sorted(return_list, key=lambda x: x["score"], reverse=True)
+        return generation, [], []
+    quantizer = image_feature_store.quantizer
+    if quantizer is None:
+        scores = match_batch(positive_feature, negative_feature, features, positive_threshold, negative_threshold, normalized=True, rows=rows)
+    else:
+        scores = match_batch_pq(quantizer, positive_feature, negative_feature, features, positive_threshold, negative_threshold, rows=rows)
+        if PQ_RERANK_SIZE:  # 近似分数靠前的候选从数据库读取原始特征，重新精确打分
+            rerank = get_top_indexes(scores, PQ_RERANK_SIZE if top_n is None else max(PQ_RERANK_SIZE, top_n))
+            with DatabaseSession() as session:
+                exact_features = get_image_features_by_ids(session, ids[rerank].tolist())
+                encoding = get_feature_encoding(session)
+            rows = np.asarray([i for i in rerank if ids[i] in exact_features], dtype=np.int64)  # 跳过搜索期间被删除的图片
+            exact_scores = np.empty(0, dtype=np.float32)
+            if len(rows):
+                features = decode_features([exact_features[i] for i in ids[rows].tolist()], encoding)
+                exact_scores = match_batch(positive_feature, negative_feature, features, positive_threshold, negative_threshold, normalized=True)
+            if top_n is None:  # 不限数量时只重排前 PQ_RERANK_SIZE 个，其余结果保留近似分数，避免读取全部原始特征
+                scores[rerank] = 0
+                scores[rows] = exact_scores
+            else:
+                ids, paths, scores = ids[rows], paths[rows], exact_scores
+    top = get_top_indexes(scores, top_n)  # 只为排名靠前的结果生成字典
+    return_list = [get_image_result(ids[i], paths[i], scores[i]) for i in top]
     logger.info("查询使用时间：%.2f" % (time.time() - t0))
-    return return_list
+    return generation, return_list, ids[top].tolist()
 
 
-@lru_cache(maxsize=CACHE_SIZE)
 def search_image_by_text_path_time(
         positive_prompt="",
         negative_prompt="",
@@ -80,6 +277,8 @@ def search_image_by_text_path_time(
         path="",
         start_time=None,
         end_time=None,
+        top_n=None,
+        offset=0,
 ):
     """
     使用文字搜图片
@@ -90,71 +289,135 @@ def search_image_by_text_path_time(
     :param path: string, 视频路径
     :param start_time: int, 开始时间戳，单位秒，用于匹配modify_time
     :param end_time: int, 结束时间戳，单位秒，用于匹配modify_time
+    :param top_n: int, 返回结果数量，None 表示全部
+    :param offset: int, 跳过的结果数量，用于分页
     :return: list[dict], 搜索结果列表
     """
     positive_feature = process_text(positive_prompt)
     negative_feature = process_text(negative_prompt)
-    return search_image_by_feature(positive_feature, negative_feature, positive_threshold, negative_threshold, path, start_time, end_time)
+    return search_image_by_feature(
+        positive_feature, negative_feature, positive_threshold, negative_threshold, path, start_time, end_time, top_n, offset
+    )
 
 
-@lru_cache(maxsize=CACHE_SIZE)
-def search_image_by_image(img_id_or_path, threshold=IMAGE_THRESHOLD):
+def search_image_by_image(img_id_or_path, threshold=IMAGE_THRESHOLD, top_n=None, offset=0, path="", start_time=None, end_time=None):
     """
     使用图片搜图片
     :param img_id_or_path: int/string, 图片ID 或 图片路径
     :param threshold: int/float, 搜索阈值
+    :param top_n: int, 返回结果数量，None 表示全部
+    :param offset: int, 跳过的结果数量，用于分页
+    :param path: string, 图片路径需要包含的字符串
+    :param start_time: int, 开始时间戳，单位秒，用于匹配modify_time
+    :param end_time: int, 结束时间戳，单位秒，用于匹配modify_time
     :return: list[dict], 搜索结果列表
     """
     try:  # 前端点击以图搜图，通过图片id来搜图 注意：如果后面id改成str的话，需要修改这部分
         img_id = int(img_id_or_path)
         with DatabaseSession() as session:
             features = get_image_features_by_id(session, img_id)
+            encoding = get_feature_encoding(session)
         if not features:
             return []
-        features = np.frombuffer(features, dtype=np.float32).reshape(1, -1)
+        features = decode_features([features], encoding)
     except ValueError:  # 传入路径，通过上传的图片来搜图
         img_path = img_id_or_path
-        features = process_image(img_path)
-    return search_image_by_feature(features, None, threshold)
+        features = process_upload_image(img_path)
+    if features is None:
+        return []
+    candidate_ids = None
+    if top_n is not None and image_hnsw_index in image_feature_store.indexes:  # 只需要最近邻，用图索引代替全库扫描
+        with image_feature_store.lock:  # 筛选条件作为行谓词传给图索引，不符合的图片不占用最近邻的名额
+            mask = image_feature_store.get_filter_mask(path, start_time, end_time)
+            allowed_ids = None if mask is None else image_feature_store.snapshot()[1][mask]
+        # 不符合的图片仍要遍历，筛选后剩下的图片很少时图索引几乎要走遍整个图，不如对这些图片精确打分
+        if allowed_ids is None or len(allowed_ids) > HNSW_FILTER_SCAN_RATIO * max(HNSW_EF_SEARCH, offset + top_n):
+            candidate_ids = image_hnsw_index.search(features, offset + top_n, HNSW_EF_SEARCH, allowed_ids)
+    return search_image_by_feature(
+        features, None, threshold, path=path, start_time=start_time, end_time=end_time, top_n=top_n, offset=offset, candidate_ids=candidate_ids
+    )
 
 
-def get_index_pairs(scores):
+def get_video_segments(scores, frame_times, frame_end_times, offsets):
     """
-    根据每一帧的余弦相似度计算素材片段
-    :param scores: [<class 'numpy.nparray'>], 余弦相似度列表，里面每个元素的shape=(1, 1)
-    :return: 返回连续的帧序号列表，如第2-5帧、第11-13帧都符合搜索内容，则返回[(2,5),(11,13)]
+    根据全部视频帧的分数向量化地计算素材片段
+    同一视频中连续符合的帧（允许中间空1帧）为一个片段，开始时间和结束时间各向相邻帧延长0.5个间隔。
+    一行可以代表一段连续的相似帧 [frame_times, frame_end_times]，结果与把每行展开成逐帧、每帧取该行分数时相同
+    :param scores: np.ndarray, 每一行的分数，不符合阈值的为0，同一视频的行连续
+    :param frame_times: np.ndarray, 每一行第一帧的时间
+    :param frame_end_times: np.ndarray, 每一行最后一帧的时间
+    :param offsets: np.ndarray, 第 i 个视频的行为 [offsets[i], offsets[i + 1])
+    :return: (视频下标, 开始时间, 结束时间, 片段分数)，均为 np.ndarray
     """
-    indexes = []
-    for i in range(len(scores)):
-        if scores[i]:
-            indexes.append(i)
-    result = []
-    start_index = -1
-    for i in range(len(indexes)):
-        if start_index == -1:
-            start_index = indexes[i]
-        elif indexes[i] - indexes[i - 1] > 2:  # 允许中间空1帧
-            result.append((start_index, indexes[i - 1]))
-            start_index = indexes[i]
-    if start_index != -1:
-        result.append((start_index, indexes[-1]))
-    return result
+    hits = np.flatnonzero(scores)
+    if len(hits) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    frame_times = np.asarray(frame_times, dtype=np.int64)
+    frame_end_times = np.asarray(frame_end_times, dtype=np.int64)
+    videos = np.searchsorted(offsets, hits, side="right") - 1
+    # 与上一个命中行之间不止1帧（隔了2行以上，或隔的1行合并了多帧）或属于不同视频时，开始新的片段
+    gaps = np.diff(hits)
+    between = np.minimum(hits[:-1] + 1, len(frame_times) - 1)
+    is_start = np.ones(len(hits), dtype=bool)
+    is_start[1:] = (gaps > 2) | ((gaps == 2) & (frame_end_times[between] != frame_times[between])) | (np.diff(videos) != 0)
+    start_positions = np.flatnonzero(is_start)
+    starts = hits[is_start]
+    ends = hits[np.append(is_start[1:], True)]
+    segment_videos = videos[is_start]
+    segment_scores = np.maximum.reduceat(scores[hits], start_positions)
+    last_frame = len(frame_times) - 1
+    start_times = np.where(
+        starts > offsets[segment_videos],  # 不是视频的第一帧
+        (frame_times[starts] + frame_end_times[starts - 1]) // 2,
+        frame_times[starts],
+    )
+    end_times = np.where(
+        ends < offsets[segment_videos + 1] - 1,  # 不是视频的最后一帧
+        (frame_end_times[ends] + frame_times[np.minimum(ends + 1, last_frame)] + 1) // 2,
+        frame_end_times[ends],
+    )
+    return segment_videos, start_times, end_times, segment_scores
 
 
-def get_video_range(start_index, end_index, scores, frame_times):
+def get_frame_rows(offsets, mask):
     """
-    根据帧数范围，获取视频时长范围
+    把视频的筛选结果换算成帧的行号，打分时只处理这些行，不复制帧特征
+    :param offsets: np.ndarray, 每个视频的帧在特征矩阵中的起止偏移
+    :param mask: np.ndarray[bool], 每个视频是否保留
+    :return: (np.ndarray, 升序的帧行号; np.ndarray, 保留的视频在帧行号数组中的偏移)
     """
-    # 间隔小于等于2倍FRAME_INTERVAL的算为同一个素材，同时开始时间和结束时间各延长0.5个FRAME_INTERVAL
-    if start_index > 0:
-        start_time = int((frame_times[start_index] + frame_times[start_index - 1]) / 2)
-    else:
-        start_time = frame_times[start_index]
-    if end_index < len(scores) - 1:
-        end_time = int((frame_times[end_index] + frame_times[end_index + 1]) / 2 + 0.5)
-    else:
-        end_time = frame_times[end_index]
-    return start_time, end_time
+    counts = np.diff(offsets)[mask]
+    new_offsets = np.append(0, np.cumsum(counts))
+    frame_rows = np.repeat(offsets[:-1][mask] - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+    return frame_rows, new_offsets
+
+
+def match_video_segments_exact(paths, positive_feature, negative_feature, positive_threshold, negative_threshold):
+    """从数据库读取指定视频的原始帧特征，精确计算素材片段，用于PQ模式下的重排"""
+    with DatabaseSession() as session:
+        frame_paths, frame_times, frame_end_times, features = get_frame_times_features_by_paths(session, paths)
+        encoding = get_feature_encoding(session)
+    if not frame_paths:
+        return np.empty(0, dtype=object), (np.empty(0, dtype=np.int64),) * 3 + (np.empty(0, dtype=np.float32),)
+    frame_paths = np.asarray(frame_paths, dtype=object)
+    is_first = np.ones(len(frame_paths), dtype=bool)
+    is_first[1:] = frame_paths[1:] != frame_paths[:-1]
+    offsets = np.append(np.flatnonzero(is_first), len(frame_paths))
+    features = decode_features(features, encoding)
+    scores = match_batch(positive_feature, negative_feature, features, positive_threshold, negative_threshold, normalized=True)
+    return frame_paths[is_first], get_video_segments(scores, frame_times, frame_end_times, offsets)
+
+
+def get_video_result(path, start_time, end_time, score):
+    start_time, end_time = int(start_time), int(end_time)
+    return {
+        "url": "api/get_video/%s" % base64.urlsafe_b64encode(path.encode()).decode()
+               + "#t=%.1f,%.1f" % (start_time, end_time),
+        "path": path,
+        "score": float(score),
+        "start_time": start_time,
+        "end_time": end_time,
+    }
 
 
 def search_video_by_feature(
@@ -165,6 +428,8 @@ def search_video_by_feature(
         filter_path="",
         modify_time_start=None,
         modify_time_end=None,
+        top_n=None,
+        offset=0,
 ):
     """
     通过特征搜索视频
@@ -175,33 +440,136 @@ def search_video_by_feature(
     :param filter_path: string, 筛选的视频路径
     :param modify_time_start: int, 开始时间戳，单位秒，用于匹配modify_time
     :param modify_time_end: int, 结束时间戳，单位秒，用于匹配modify_time
-    :return: list[dict], 搜索结果列表
+    :param top_n: int, 返回结果数量，None 表示全部
+    :param offset: int, 跳过的结果数量，用于分页
+    :return: list[dict], 搜索结果列表，按分数从高到低排序
+    """
+    video_feature_store.load()  # 已加载时直接返回
+    limit = None if top_n is None else offset + top_n
+    key, patch = get_video_cache_key(
+        positive_feature, negative_feature, positive_threshold, negative_threshold, filter_path, modify_time_start, modify_time_end
+    )
+    results = get_cached_results(key, video_feature_store, limit, patch)
+    if results is None:
+        generation, results, result_paths = _search_video_by_feature(
+            positive_feature, negative_feature, positive_threshold, negative_threshold,
+            filter_path, modify_time_start, modify_time_end, limit,
+        )
+        result_cache.put(key, CachedResult(generation, results, result_paths, limit))
+    return results[offset:]
+
+
+def get_video_cache_key(
+        positive_feature, negative_feature, positive_threshold, negative_threshold,
+        filter_path, modify_time_start, modify_time_end,
+):
+    """
+    :return: (视频搜索结果的缓存键, 修补缓存结果的函数)
+    """
+    key = (
+        "video", get_array_digest(positive_feature), get_array_digest(negative_feature), positive_threshold,
+        negative_threshold, filter_path, modify_time_start, modify_time_end,
+    )
+    patch = partial(
+        patch_video_results, positive_feature=positive_feature, negative_feature=negative_feature,
+        positive_threshold=positive_threshold, negative_threshold=negative_threshold,
+        filter_path=filter_path, modify_time_start=modify_time_start, modify_time_end=modify_time_end,
+    )
+    return key, patch
+
+
+def patch_video_results(
+        entry, changes, positive_feature, negative_feature, positive_threshold, negative_threshold,
+        filter_path, modify_time_start, modify_time_end,
+):
+    """
+    根据视频帧特征库的变化修补缓存的搜索结果：去掉被删除或更新的视频的片段，对新增的视频精确计算片段后合并
+    :param entry: CachedResult, 缓存的结果
+    :param changes: list, VideoFeatureStore.get_changes 返回的变化记录
+    :return: CachedResult，无法修补时返回 None
+    """
+    removed = set()
+    added = {}  # {路径: (修改时间, 帧时间, 结束帧时间, 特征)}，按顺序处理，之后又被删除的不算新增
+    for _, add, remove in changes:
+        if remove is not None:
+            removed.update(remove)
+            for i in remove:
+                added.pop(i, None)
+        if add is not None:
+            removed.add(add[0])
+            added[add[0]] = add[1:]
+    stale = np.fromiter((i in removed for i in entry.keys), dtype=bool, count=len(entry.keys))
+    results, result_paths = [], []
+    paths = np.asarray(list(added.keys()), dtype=object)
+    modify_times = np.asarray([v[0] for v in added.values()], dtype=np.float64)
+    mask = get_path_time_mask(paths, modify_times, filter_path, modify_time_start, modify_time_end)
+    if mask is not None:
+        paths = paths[mask]
+    if len(paths):
+        frame_times = np.concatenate([added[i][1] for i in paths])
+        frame_end_times = np.concatenate([added[i][2] for i in paths])
+        features = np.concatenate([added[i][3] for i in paths])
+        offsets = np.append(0, np.cumsum([len(added[i][1]) for i in paths]))
+        scores = match_batch(positive_feature, negative_feature, features, positive_threshold, negative_threshold, normalized=True)
+        for video, start_time, end_time, score in zip(*get_video_segments(scores, frame_times, frame_end_times, offsets)):
+            results.append(get_video_result(paths[video], start_time, end_time, score))
+            result_paths.append(paths[video])
+    return merge_results(entry, stale, results, result_paths, changes[-1][0])
+
+
+def _search_video_by_feature(
+        positive_feature, negative_feature, positive_threshold, negative_threshold,
+        filter_path, modify_time_start, modify_time_end, top_n,
+):
+    """
+    在视频帧特征库中搜索前 top_n 个片段，参数见 search_video_by_feature
+    :return: (特征库的 generation, 结果列表, 结果对应的视频路径列表)
     """
     t0 = time.time()
-    return_list = []
-    with DatabaseSession() as session:
-        for path in get_video_paths(session, filter_path, modify_time_start, modify_time_end):  # 逐个视频比对
-            frame_times, features = get_frame_times_features_by_path(session, path)
-            features = np.frombuffer(b"".join(features), dtype=np.float32).reshape(len(features), -1)
-            scores = match_batch(positive_feature, negative_feature, features, positive_threshold, negative_threshold)
-            index_pairs = get_index_pairs(scores)
-            for start_index, end_index in index_pairs:
-                score = max(scores[start_index: end_index + 1])
-                start_time, end_time = get_video_range(start_index, end_index, scores, frame_times)
-                return_list.append({
-                    "url": "api/get_video/%s" % base64.urlsafe_b64encode(path.encode()).decode()
-                           + "#t=%.1f,%.1f" % (start_time, end_time),
-                    "path": path,
-                    "score": float(score),
-                    "start_time": start_time,
-                    "end_time": end_time,
-                })
+    with video_feature_store.lock:  # 帧和摘要取自同一时刻
+        generation = video_feature_store.generation
+        features, frame_times, frame_end_times, paths, modify_times, offsets = video_feature_store.snapshot()
+        summaries, summary_radii, summary_offsets = video_feature_store.snapshot_summaries()
+        mask = video_feature_store.get_filter_mask(filter_path, modify_time_start, modify_time_end)
+    if positive_feature is not None and len(paths):  # 先用摘要算出每个视频的分数上界，排除不可能达到阈值的视频
+        bounds = get_video_upper_bounds(positive_feature / np.linalg.norm(positive_feature), summaries, summary_radii, summary_offsets)
+        reachable = bounds >= positive_threshold / 100
+        mask = reachable if mask is None else mask & reachable
+        logger.debug(f"摘要剪枝后剩余{int(mask.sum())}/{len(paths)}个视频")
+    frame_rows = None
+    if mask is not None and not mask.all():  # 只对符合条件的视频的帧打分，并重新计算偏移
+        frame_rows, offsets = get_frame_rows(offsets, mask)
+        frame_times, frame_end_times, paths = frame_times[frame_rows], frame_end_times[frame_rows], paths[mask]
+    if len(paths) == 0:  # 没有素材，直接返回空
+        return generation, [], []
+    quantizer = video_feature_store.quantizer
+    if quantizer is None:
+        scores = match_batch(positive_feature, negative_feature, features, positive_threshold, negative_threshold, normalized=True, rows=frame_rows)
+    else:
+        scores = match_batch_pq(quantizer, positive_feature, negative_feature, features, positive_threshold, negative_threshold, rows=frame_rows)
+    segment_videos, start_times, end_times, segment_scores = get_video_segments(scores, frame_times, frame_end_times, offsets)
+    if quantizer is not None and PQ_RERANK_SIZE:  # 近似分数靠前的片段所在的视频从数据库读取原始特征，重新精确计算片段
+        top = get_top_indexes(segment_scores, PQ_RERANK_SIZE if top_n is None else max(PQ_RERANK_SIZE, top_n))
+        reranked = np.unique(segment_videos[top])
+        exact_paths, exact_segments = match_video_segments_exact(
+            paths[reranked].tolist(), positive_feature, negative_feature, positive_threshold, negative_threshold
+        )
+        if top_n is None:  # 不限数量时其余视频的片段保留近似分数，避免读取全部原始特征
+            rest = ~np.isin(segment_videos, reranked)
+            exact_videos, exact_start_times, exact_end_times, exact_scores = exact_segments
+            segment_videos = np.concatenate([exact_videos, segment_videos[rest] + len(exact_paths)])
+            start_times = np.concatenate([exact_start_times, start_times[rest]])
+            end_times = np.concatenate([exact_end_times, end_times[rest]])
+            segment_scores = np.concatenate([exact_scores, segment_scores[rest]])
+            paths = np.concatenate([exact_paths, paths])
+        else:
+            paths, (segment_videos, start_times, end_times, segment_scores) = exact_paths, exact_segments
+    top = get_top_indexes(segment_scores, top_n)  # 只为排名靠前的片段生成字典
+    return_list = [get_video_result(paths[segment_videos[i]], start_times[i], end_times[i], segment_scores[i]) for i in top]
     logger.info("查询使用时间：%.2f" % (time.time() - t0))
-    return_list = sorted(return_list, key=lambda x: x["score"], reverse=True)
-    return return_list
+    return generation, return_list, paths[segment_videos[top]].tolist()
 
 
-@lru_cache(maxsize=CACHE_SIZE)
 def search_video_by_text_path_time(
         positive_prompt="",
         negative_prompt="",
@@ -210,6 +578,8 @@ def search_video_by_text_path_time(
         path="",
         start_time=None,
         end_time=None,
+        top_n=None,
+        offset=0,
 ):
     """
     使用文字搜视频
@@ -220,19 +590,24 @@ def search_video_by_text_path_time(
     :param path: string, 视频路径
     :param start_time: int, 开始时间戳，单位秒，用于匹配modify_time
     :param end_time: int, 结束时间戳，单位秒，用于匹配modify_time
+    :param top_n: int, 返回结果数量，None 表示全部
+    :param offset: int, 跳过的结果数量，用于分页
     :return: list[dict], 搜索结果列表
     """
     positive_feature = process_text(positive_prompt)
     negative_feature = process_text(negative_prompt)
-    return search_video_by_feature(positive_feature, negative_feature, positive_threshold, negative_threshold, path, start_time, end_time)
+    return search_video_by_feature(
+        positive_feature, negative_feature, positive_threshold, negative_threshold, path, start_time, end_time, top_n, offset
+    )
 
 
-@lru_cache(maxsize=CACHE_SIZE)
-def search_video_by_image(img_id_or_path, threshold=IMAGE_THRESHOLD):
+def search_video_by_image(img_id_or_path, threshold=IMAGE_THRESHOLD, top_n=None, offset=0):
     """
     使用图片搜视频
     :param img_id_or_path: int/string, 图片ID 或 图片路径
     :param threshold: int/float, 搜索阈值
+    :param top_n: int, 返回结果数量，None 表示全部
+    :param offset: int, 跳过的结果数量，用于分页
     :return: list[dict], 搜索结果列表
     """
     features = b""
@@ -240,90 +615,338 @@ def search_video_by_image(img_id_or_path, threshold=IMAGE_THRESHOLD):
         img_id = int(img_id_or_path)
         with DatabaseSession() as session:
             features = get_image_features_by_id(session, img_id)
+            encoding = get_feature_encoding(session)
         if not features:
             return []
-        features = np.frombuffer(features, dtype=np.float32).reshape(1, -1)
+        features = decode_features([features], encoding)
     except ValueError:
         img_path = img_id_or_path
-        features = process_image(img_path)
-    return search_video_by_feature(features, None, threshold)
+        features = process_upload_image(img_path)
+    return search_video_by_feature(features, None, threshold, top_n=top_n, offset=offset)
 
 
-def search_pexels_video_by_feature(positive_feature, positive_threshold=POSITIVE_THRESHOLD):
+def search_pexels_video_by_feature(positive_feature, positive_threshold=POSITIVE_THRESHOLD, top_n=None, offset=0):
     """
     通过特征搜索pexels视频
     :param positive_feature: np.array, 正向特征向量
     :param positive_threshold: int/float, 正向阈值
+    :param top_n: int, 返回结果数量，None 表示全部
+    :param offset: int, 跳过的结果数量，用于分页
     :return: list, 搜索结果列表
     """
+    limit = None if top_n is None else offset + top_n
+    with DatabaseSessionPexelsVideo() as session:  # pexels视频库由另一个进程中的爬虫更新，库的版本变化后缓存自然不再命中
+        version = get_pexels_video_version(session)
+    key = ("pexels_video", version, get_array_digest(positive_feature), positive_threshold)
+    results = get_cached_results(key, None, limit)
+    if results is None:
+        results = _search_pexels_video_by_feature(positive_feature, positive_threshold, limit)
+        result_cache.put(key, CachedResult(0, results, [], limit))
+    return results[offset:]
+
+
+def _search_pexels_video_by_feature(positive_feature, positive_threshold, top_n):
+    """在pexels视频库中搜索前 top_n 个结果，参数见 search_pexels_video_by_feature"""
     t0 = time.time()
     with DatabaseSessionPexelsVideo() as session:
         thumbnail_feature_list, thumbnail_loc_list, content_loc_list, \
             title_list, description_list, duration_list, view_count_list = get_pexels_video_features(session)
+        encoding = get_feature_encoding(session, PexelsVideoMeta)
     if len(thumbnail_feature_list) == 0:  # 没有素材，直接返回空
         return []
-    thumbnail_features = np.frombuffer(b"".join(thumbnail_feature_list), dtype=np.float32).reshape(len(thumbnail_feature_list), -1)
-    thumbnail_scores = match_batch(positive_feature, None, thumbnail_features, positive_threshold, None)
+    thumbnail_features = decode_features(thumbnail_feature_list, encoding)
+    thumbnail_scores = match_batch(positive_feature, None, thumbnail_features, positive_threshold, None, normalized=True)
     return_list = []
-    for score, thumbnail_loc, content_loc, title, description, duration, view_count in zip(
-            thumbnail_scores, thumbnail_loc_list, content_loc_list,
-            title_list, description_list, duration_list, view_count_list
-    ):
-        if not score:
-            continue
+    for i in get_top_indexes(thumbnail_scores, top_n):
         return_list.append({
-            "thumbnail_loc": thumbnail_loc,
-            "content_loc": content_loc,
-            "title": title,
-            "description": description,
-            "duration": duration,
-            "view_count": view_count,
-            "score": float(score),
+            "thumbnail_loc": thumbnail_loc_list[i],
+            "content_loc": content_loc_list[i],
+            "title": title_list[i],
+            "description": description_list[i],
+            "duration": duration_list[i],
+            "view_count": view_count_list[i],
+            "score": float(thumbnail_scores[i]),
         })
-    return_list = sorted(return_list, key=lambda x: x["score"], reverse=True)
     logger.info("查询使用时间：%.2f" % (time.time() - t0))
     return return_list
 
 
-@lru_cache(maxsize=CACHE_SIZE)
-def search_pexels_video_by_text(positive_prompt: str, positive_threshold=POSITIVE_THRESHOLD):
+def search_pexels_video_by_text(positive_prompt: str, positive_threshold=POSITIVE_THRESHOLD, top_n=None, offset=0):
     """
     通过文字搜索pexels视频
     :param positive_prompt: 正向提示词
     :param positive_threshold: int/float, 正向阈值
+    :param top_n: int, 返回结果数量，None 表示全部
+    :param offset: int, 跳过的结果数量，用于分页
     :return:
     """
     positive_feature = process_text(positive_prompt)
-    return search_pexels_video_by_feature(positive_feature, positive_threshold)
+    return search_pexels_video_by_feature(positive_feature, positive_threshold, top_n, offset)
+
+
+def get_query_matrix(features, dim):
+    """
+    把各查询的特征拼成归一化的矩阵
+    :param features: list[np.ndarray], 各查询的特征，None 表示没有
+    :param dim: int, 特征维度
+    :return: (np.ndarray, shape=(q, dim), 没有特征的查询为全0行; np.ndarray[bool], 是否有特征)
+    """
+    matrix = np.zeros((len(features), dim), dtype=np.float32)
+    exists = np.array([i is not None for i in features], dtype=bool)
+    for row, feature in enumerate(features):
+        if feature is not None:
+            feature = np.asarray(feature, dtype=np.float32).reshape(-1)
+            matrix[row] = feature / np.linalg.norm(feature)
+    return matrix, exists
+
+
+def match_batch_queries(features, positive, has_positive, negative, has_negative, positive_thresholds, negative_thresholds, rows=None):
+    """
+    用一次矩阵乘法计算多个查询的分数，阈值规则与 match_batch 相同
+    :param features: np.ndarray, 已归一化的特征，shape=(n, d)
+    :param positive: np.ndarray, 正向特征矩阵，shape=(q, d)，见 get_query_matrix
+    :param has_positive: np.ndarray[bool], 没有正向特征的查询分数都为1
+    :param negative: np.ndarray, 反向特征矩阵，shape=(q, d)
+    :param has_negative: np.ndarray[bool], 是否有反向特征
+    :param positive_thresholds: np.ndarray, 每个查询的正向阈值
+    :param negative_thresholds: np.ndarray, 每个查询的反向阈值
+    :param rows: np.ndarray, 升序的行号，只对这些行打分，None 表示全部行
+    :return: np.ndarray, shape=(n, q)（指定 rows 时 n 为 len(rows)），不符合阈值的为0
+    """
+    q = len(positive)
+    scores = score_rows(features, np.concatenate([positive, negative]).T, rows)
+    positive_scores = np.where(has_positive, scores[:, :q], 1)
+    positive_scores = np.where(positive_scores < positive_thresholds / 100, 0, positive_scores)
+    return np.where(has_negative & (scores[:, q:] > negative_thresholds / 100), 0, positive_scores)
+
+
+def keep_top(kept, new, top_n):
+    """
+    合并两批候选并保留分数最高的 top_n 个，保持候选原来的先后顺序，使同分时的排序与一次性排序相同
+    :param kept: tuple[np.ndarray], 已保留的候选，最后一项为分数
+    :param new: tuple[np.ndarray], 新的候选
+    :param top_n: int, 保留数量，None 表示全部
+    :return: tuple[np.ndarray]
+    """
+    merged = tuple(np.concatenate([a, b]) for a, b in zip(kept, new))
+    keep = np.sort(get_top_indexes(merged[-1], top_n))
+    return tuple(i[keep] for i in merged)
+
+
+def search_image_by_features_batch(
+        positive_features,
+        negative_features,
+        positive_thresholds,
+        negative_thresholds,
+        path="",
+        start_time=None,
+        end_time=None,
+        top_n=None,
+):
+    """
+    通过多组特征批量精确搜索图片，每次对一块图片特征和全部查询做一次矩阵乘法，分数矩阵不超过 BATCH_SCORE_SIZE 个元素
+    :param positive_features: list[np.ndarray], 各查询的正向特征，None 表示没有
+    :param negative_features: list[np.ndarray], 各查询的反向特征，None 表示没有
+    :param positive_thresholds: list[int/float], 各查询的正向阈值
+    :param negative_thresholds: list[int/float], 各查询的反向阈值
+    :param path: string, 图片路径
+    :param start_time: int, 开始时间戳，单位秒，用于匹配modify_time
+    :param end_time: int, 结束时间戳，单位秒，用于匹配modify_time
+    :param top_n: int, 每个查询返回的结果数量，None 表示全部
+    :return: (特征库的 generation, list[list[dict]] 各查询的结果, list[list[int]] 各查询结果对应的图片id)
+    """
+    t0 = time.time()
+    with image_feature_store.lock:
+        generation = image_feature_store.generation
+        features, ids, paths, modify_times = image_feature_store.snapshot()
+        mask = image_feature_store.get_filter_mask(path, start_time, end_time)
+    rows = np.arange(len(ids)) if mask is None else np.flatnonzero(mask)
+    ids, paths = ids[rows], paths[rows]
+    q = len(positive_features)
+    if len(ids) == 0:
+        return generation, [[] for _ in range(q)], [[] for _ in range(q)]
+    positive, has_positive = get_query_matrix(positive_features, features.shape[1])
+    negative, has_negative = get_query_matrix(negative_features, features.shape[1])
+    positive_thresholds = np.asarray(positive_thresholds, dtype=np.float64)
+    negative_thresholds = np.asarray(negative_thresholds, dtype=np.float64)
+    tops = [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))] * q
+    block_size = max(1, BATCH_SCORE_SIZE // (2 * q))
+    for start in range(0, len(ids), block_size):
+        scores = match_batch_queries(
+            features, positive, has_positive, negative, has_negative, positive_thresholds, negative_thresholds, rows[start:start + block_size]
+        )
+        for i in range(q):
+            top = np.sort(get_top_indexes(scores[:, i], top_n))
+            tops[i] = keep_top(tops[i], (top + start, scores[top, i]), top_n)
+    return_lists, id_lists = [], []
+    for indexes, scores in tops:
+        top = get_top_indexes(scores, top_n)
+        return_lists.append([get_image_result(ids[indexes[i]], paths[indexes[i]], scores[i]) for i in top])
+        id_lists.append(ids[indexes[top]].tolist())
+    logger.info("批量查询%d条使用时间：%.2f" % (q, time.time() - t0))
+    return generation, return_lists, id_lists
+
+
+def search_video_by_features_batch(
+        positive_features,
+        negative_features,
+        positive_thresholds,
+        negative_thresholds,
+        filter_path="",
+        modify_time_start=None,
+        modify_time_end=None,
+        top_n=None,
+):
+    """
+    通过多组特征批量搜索视频，按视频边界把帧特征分块，每块和全部查询做一次矩阵乘法，参数见 search_image_by_features_batch
+    :return: (特征库的 generation, list[list[dict]] 各查询的结果, list[list[str]] 各查询结果对应的视频路径)
+    """
+    t0 = time.time()
+    with video_feature_store.lock:
+        generation = video_feature_store.generation
+        features, frame_times, frame_end_times, paths, modify_times, offsets = video_feature_store.snapshot()
+        mask = video_feature_store.get_filter_mask(filter_path, modify_time_start, modify_time_end)
+    if mask is not None and not mask.all():
+        frame_rows, offsets = get_frame_rows(offsets, mask)
+        frame_times, frame_end_times, paths = frame_times[frame_rows], frame_end_times[frame_rows], paths[mask]
+    else:
+        frame_rows = np.arange(len(frame_times))
+    q = len(positive_features)
+    if len(paths) == 0:
+        return generation, [[] for _ in range(q)], [[] for _ in range(q)]
+    positive, has_positive = get_query_matrix(positive_features, features.shape[1])
+    negative, has_negative = get_query_matrix(negative_features, features.shape[1])
+    positive_thresholds = np.asarray(positive_thresholds, dtype=np.float64)
+    negative_thresholds = np.asarray(negative_thresholds, dtype=np.float64)
+    empty = (np.empty(0, dtype=np.int64),) * 3 + (np.empty(0, dtype=np.float32),)
+    tops = [empty] * q
+    block_size = max(1, BATCH_SCORE_SIZE // (2 * q))
+    video = 0
+    while video < len(paths):  # 每块至少包含一个完整的视频，片段不会跨块
+        end = max(video + 1, int(np.searchsorted(offsets, offsets[video] + block_size, side="right")) - 1)
+        block_offsets = offsets[video:end + 1] - offsets[video]
+        block_frames = slice(offsets[video], offsets[end])
+        scores = match_batch_queries(
+            features, positive, has_positive, negative, has_negative, positive_thresholds, negative_thresholds, frame_rows[block_frames]
+        )
+        for i in range(q):
+            segment_videos, start_times, end_times, segment_scores = get_video_segments(
+                scores[:, i], frame_times[block_frames], frame_end_times[block_frames], block_offsets
+            )
+            tops[i] = keep_top(tops[i], (segment_videos + video, start_times, end_times, segment_scores), top_n)
+        video = end
+    return_lists, path_lists = [], []
+    for segment_videos, start_times, end_times, segment_scores in tops:
+        top = get_top_indexes(segment_scores, top_n)
+        return_lists.append([
+            get_video_result(paths[segment_videos[i]], start_times[i], end_times[i], segment_scores[i]) for i in top
+        ])
+        path_lists.append(paths[segment_videos[top]].tolist())
+    logger.info("批量查询%d条使用时间：%.2f" % (q, time.time() - t0))
+    return generation, return_lists, path_lists
+
+
+def search_batch(
+        queries,
+        search_type="image",
+        positive_threshold=POSITIVE_THRESHOLD,
+        negative_threshold=NEGATIVE_THRESHOLD,
+        image_threshold=IMAGE_THRESHOLD,
+        path="",
+        start_time=None,
+        end_time=None,
+        top_n=None,
+):
+    """
+    批量搜索图片或视频：全部提示词一次批量编码，已缓存的查询直接返回，其余查询一起打分
+    :param queries: list[dict], 每个查询为 {"positive": 正向提示词, "negative": 反向提示词} 或 {"img_id": 图片id}
+    :param search_type: string, "image" 搜图片，"video" 搜视频
+    :param positive_threshold: int/float, 文字查询的正向阈值
+    :param negative_threshold: int/float, 文字查询的反向阈值
+    :param image_threshold: int/float, 以图搜索的阈值
+    :param path: string, 路径需要包含的字符串
+    :param start_time: int, 开始时间戳，单位秒，用于匹配modify_time
+    :param end_time: int, 结束时间戳，单位秒，用于匹配modify_time
+    :param top_n: int, 每个查询返回的结果数量，None 表示全部
+    :return: list[list[dict]], 与 queries 一一对应的搜索结果列表
+    """
+    if search_type not in ("image", "video"):
+        raise ValueError(f"不支持的批量搜索类型：{search_type}")
+    store = image_feature_store if search_type == "image" else video_feature_store
+    store.load()  # 已加载时直接返回
+    texts = [query.get(key) or "" for query in queries for key in ("positive", "negative")]
+    text_features = process_texts(texts)
+    img_ids = [int(query["img_id"]) for query in queries if query.get("img_id") is not None]
+    image_features = {}
+    if img_ids:
+        with DatabaseSession() as session:
+            image_features = get_image_features_by_ids(session, img_ids)
+            encoding = get_feature_encoding(session)
+        image_features = {i: decode_features([v], encoding) for i, v in image_features.items()}
+    results = [[] for _ in queries]
+    pending = []  # [(查询下标, 正向特征, 反向特征, 正向阈值, 反向阈值, 缓存键)]
+    for i, query in enumerate(queries):
+        if query.get("img_id") is not None:
+            positive_feature = image_features.get(int(query["img_id"]))
+            if positive_feature is None:  # 图片不存在
+                continue
+            negative_feature, thresholds = None, (image_threshold, NEGATIVE_THRESHOLD)
+        else:
+            positive_feature, negative_feature = text_features[2 * i], text_features[2 * i + 1]
+            thresholds = (positive_threshold, negative_threshold)
+        if search_type == "image":
+            key, patch = get_image_cache_key(positive_feature, negative_feature, *thresholds, path, start_time, end_time, exact=True)
+        else:
+            key, patch = get_video_cache_key(positive_feature, negative_feature, *thresholds, path, start_time, end_time)
+        cached = get_cached_results(key, store, top_n, patch)
+        if cached is not None:
+            results[i] = cached
+        else:
+            pending.append((i, positive_feature, negative_feature) + thresholds + (key,))
+    if not pending:
+        return results
+    if store.quantizer is not None:  # PQ模式下各查询的距离表不同，逐条搜索
+        for i, positive_feature, negative_feature, positive, negative, _ in pending:
+            if search_type == "image":
+                results[i] = search_image_by_feature(positive_feature, negative_feature, positive, negative, path, start_time, end_time, top_n, exact=True)
+            else:
+                results[i] = search_video_by_feature(positive_feature, negative_feature, positive, negative, path, start_time, end_time, top_n)
+        return results
+    search_function = search_image_by_features_batch if search_type == "image" else search_video_by_features_batch
+    generation, return_lists, key_lists = search_function(
+        *[list(i) for i in zip(*pending)][1:5], path, start_time, end_time, top_n
+    )
+    for (i, *_, key), return_list, keys in zip(pending, return_lists, key_lists):
+        results[i] = return_list
+        result_cache.put(key, CachedResult(generation, return_list, keys, top_n))
+    return results
 
 
 if __name__ == '__main__':
     import argparse
-    from utils import format_seconds
+    import json
+    import sys
 
-    parser = argparse.ArgumentParser(description='Search local photos and videos through natural language.')
+    parser = argparse.ArgumentParser(description='Batch search local photos and videos through natural language.')
     parser.add_argument('search_type', metavar='<type>', choices=['image', 'video'], help='search type (image or video).')
-    parser.add_argument('positive_prompt', metavar='<positive_prompt>')
+    parser.add_argument('input', metavar='<input>', nargs='?', default='-',
+                        help='file with one query per line, "-" for stdin. A line is a JSON object like '
+                             '{"positive": "...", "negative": "..."} or {"img_id": 1}, or a plain positive prompt.')
+    parser.add_argument('--top-n', type=int, default=5, help='results per query.')
+    parser.add_argument('--positive-threshold', type=int, default=POSITIVE_THRESHOLD)
+    parser.add_argument('--negative-threshold', type=int, default=NEGATIVE_THRESHOLD)
+    parser.add_argument('--image-threshold', type=int, default=IMAGE_THRESHOLD)
+    parser.add_argument('--path', default='', help='only search paths containing this string.')
     args = parser.parse_args()
-    positive_prompt = args.positive_prompt
-    if args.search_type == 'image':
-        results = search_image_by_text_path_time(positive_prompt)
-        print(positive_prompt)
-        print(f'results count: {len(results)}')
-        print('-' * 30)
-        for item in results[:5]:
-            print(f'path  : {item["path"]}')
-            print(f'score: {item["score"]:.3f}')
-            print('-' * 30)
-    elif args.search_type == 'video':
-        results = search_video_by_text_path_time(positive_prompt)
-        print(positive_prompt)
-        print(f'results count: {len(results)}')
-        print('-' * 30)
-        for item in results[:5]:
-            start_time = format_seconds(item["start_time"])
-            end_time = format_seconds(item["end_time"])
-            print(f'path  : {item["path"]}')
-            print(f'range: {start_time} ~ {end_time}')
-            print(f'score: {item["score"]:.3f}')
-            print('-' * 30)
+    lines = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+    queries = []
+    for line in lines:
+        line = line.strip()
+        if line:
+            queries.append(json.loads(line) if line.startswith('{') else {"positive": line})
+    results = search_batch(
+        queries, args.search_type, args.positive_threshold, args.negative_threshold, args.image_threshold,
+        args.path, top_n=args.top_n,
+    )
+    for query, items in zip(queries, results):  # 每行输出一个查询的结果，便于离线任务处理
+        print(json.dumps({"query": query, "results": items}, ensure_ascii=False))
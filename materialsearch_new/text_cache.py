@@ -0,0 +1,141 @@
+# 文字特征缓存：按 (模型, 规范化后的提示词) 缓存文字特征，内存中按LRU淘汰，并保存到磁盘，重启或切换回原模型后仍然有效
+import atexit
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from config import *
+
+logger = logging.getLogger(__name__)
+
+SAVE_INTERVAL = 32  # 每新增多少条保存一次磁盘
+
+
+def normalize_prompt(prompt):
+    """
+    规范化提示词，只做分词器本身就会忽略的变换（合并空白、转小写），保证规范化前后的文字特征相同
+    :param prompt: string, 提示词
+    :return: string
+    """
+    return " ".join(prompt.split()).lower()
+
+
+class TextFeatureCache:
+    """
+    文字特征缓存
+    内存中用 OrderedDict 按最近使用排序，超过 max_size 时淘汰最久未使用的；
+    磁盘上保存为 npz（模型、提示词、特征长度、拼接后的 float32 特征），保存时与其它进程写入的条目合并。
+    """
+
+    def __init__(self, path, max_size=TEXT_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.features = OrderedDict()  # {(模型, 提示词): 特征}
+        self.loaded = False
+        self.unsaved = 0
+
+    def get(self, model_id, prompt):
+        """
+        获取缓存的文字特征
+        :param model_id: string, 模型标识
+        :param prompt: string, 提示词
+        :return: np.ndarray, shape=(1, d)，未命中时返回 None
+        """
+        if self.max_size <= 0:
+            return None
+        key = (model_id, normalize_prompt(prompt))
+        with self.lock:
+            self._load()
+            feature = self.features.get(key)
+            if feature is None:
+                return None
+            self.features.move_to_end(key)
+        return feature.reshape(1, -1).copy()
+
+    def put(self, model_id, prompt, feature):
+        """
+        缓存文字特征，每新增 SAVE_INTERVAL 条保存一次磁盘
+        :param model_id: string, 模型标识
+        :param prompt: string, 提示词
+        :param feature: np.ndarray, 文字特征
+        """
+        if self.max_size <= 0 or feature is None:
+            return
+        key = (model_id, normalize_prompt(prompt))
+        with self.lock:
+            self._load()
+            self.features[key] = np.asarray(feature, dtype=np.float32).reshape(-1).copy()
+            self.features.move_to_end(key)
+            while len(self.features) > self.max_size:
+                self.features.popitem(last=False)
+            self.unsaved += 1
+            need_save = self.unsaved >= SAVE_INTERVAL
+        if need_save:
+            self.save()
+
+    def _load(self):
+        """第一次使用时从磁盘加载，调用时需持有锁"""
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            for key, feature in _read_entries(self.path)[-self.max_size:]:
+                self.features[key] = feature
+        except Exception as e:
+            logger.warning(f"读取文字特征缓存失败，将重新建立：{repr(e)}")
+            return
+        if self.features:
+            logger.info(f"文字特征缓存加载完成，共{len(self.features)}条")
+
+    def save(self):
+        """保存到磁盘，与磁盘上其它进程写入的条目合并，最近使用的排在最后"""
+        with self.lock:
+            if not self.unsaved:
+                return
+            entries = list(self.features.items())
+            self.unsaved = 0
+        try:
+            disk_entries = _read_entries(self.path)
+        except Exception:
+            disk_entries = []
+        keys = set(key for key, _ in entries)
+        merged = [i for i in disk_entries if i[0] not in keys] + entries
+        try:
+            _write_entries(self.path, merged[-self.max_size:])
+        except Exception as e:
+            logger.warning(f"保存文字特征缓存失败：{repr(e)}")
+
+
+def _read_entries(path):
+    """读取磁盘上的缓存，返回 [((模型, 提示词), 特征)]"""
+    if not os.path.isfile(path):
+        return []
+    with np.load(path, allow_pickle=False) as data:
+        model_ids, prompts, lengths, values = data["model_ids"], data["prompts"], data["lengths"], data["features"]
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    return [
+        ((str(model_id), str(prompt)), values[offsets[i]:offsets[i + 1]])
+        for i, (model_id, prompt) in enumerate(zip(model_ids, prompts))
+    ]
+
+
+def _write_entries(path, entries):
+    """先写临时文件再替换，避免其它进程读到写了一半的文件"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(
+        tmp_path,
+        model_ids=np.asarray([key[0] for key, _ in entries], dtype=str),
+        prompts=np.asarray([key[1] for key, _ in entries], dtype=str),
+        lengths=np.asarray([len(feature) for _, feature in entries], dtype=np.int64),
+        features=np.concatenate([feature for _, feature in entries]) if entries else np.empty(0, dtype=np.float32),
+    )
+    os.replace(tmp_path, path)
+
+
+text_feature_cache = TextFeatureCache(TEXT_CACHE_PATH)
+atexit.register(text_feature_cache.save)
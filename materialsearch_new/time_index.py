@@ -0,0 +1,58 @@
+# 修改时间索引：按修改时间排好序的键数组，时间范围筛选用二分查找得到一段连续的键，而不是逐行比较全部修改时间
+import numpy as np
+
+
+class TimeIndex:
+    """
+    修改时间的有序索引
+    times 为升序排列的修改时间戳（没有修改时间的NaN排在最后），keys 为对应的键（图片id或视频序号）。调用方需持有特征库的锁。
+    """
+
+    def __init__(self):
+        self.times = np.empty(0, dtype=np.float64)
+        self.keys = np.empty(0, dtype=np.int64)
+
+    def build(self, keys, times):
+        """
+        用全部修改时间重建索引
+        :param keys: np.ndarray, 每行的键
+        :param times: np.ndarray, 修改时间戳
+        """
+        times = np.asarray(times, dtype=np.float64)
+        order = np.argsort(times, kind="stable")
+        self.times = times[order]
+        self.keys = np.asarray(keys, dtype=np.int64)[order]
+
+    def add(self, keys, times):
+        """
+        插入新的键，只移动一次现有数组
+        :param keys: list[int], 每行的键
+        :param times: list[float], 修改时间戳
+        """
+        times = np.asarray(times, dtype=np.float64)
+        order = np.argsort(times, kind="stable")
+        times = times[order]
+        positions = np.searchsorted(self.times, times, side="right")
+        self.times = np.insert(self.times, positions, times)
+        self.keys = np.insert(self.keys, positions, np.asarray(keys, dtype=np.int64)[order])
+
+    def remove(self, keys):
+        """
+        删除键
+        :param keys: list[int], 要删除的键
+        """
+        if len(keys) == 0:
+            return
+        keep = ~np.isin(self.keys, np.asarray(keys, dtype=np.int64))
+        self.times, self.keys = self.times[keep], self.keys[keep]
+
+    def get_range(self, start_time=None, end_time=None):
+        """
+        二分查找修改时间在 [start_time, end_time] 内的一段
+        :param start_time: int, 开始时间戳，单位秒，None 表示不限
+        :param end_time: int, 结束时间戳，单位秒，None 表示不限
+        :return: (开始位置, 结束位置)，对应的键为 keys[开始位置:结束位置]
+        """
+        start = np.searchsorted(self.times, start_time, side="left") if start_time else 0
+        end = np.searchsorted(self.times, end_time, side="right") if end_time else np.searchsorted(self.times, np.inf, side="right")
+        return int(start), int(max(start, end))
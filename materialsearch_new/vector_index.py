@@ -0,0 +1,529 @@
+# 图片特征的近似最近邻索引，图库很大时先用索引缩小候选范围，再对候选做精确计算
+import heapq
+import logging
+import os
+import pickle
+import threading
+import time
+
+import numpy as np
+
+from config import *
+
+logger = logging.getLogger(__name__)
+
+
+def spherical_kmeans(features, k, iterations=20, sample_size=None, seed=0):
+    """
+    对归一化特征做球面k-means（用余弦相似度分配，聚类中心重新归一化）
+    :param features: np.ndarray, 归一化特征，shape=(n, d)
+    :param k: int, 聚类数量
+    :param iterations: int, 迭代次数
+    :param sample_size: int, 训练时采样的数量，None 表示全部
+    :param seed: int, 随机种子
+    :return: np.ndarray, 聚类中心，shape=(k, d)
+    """
+    rng = np.random.default_rng(seed)
+    if sample_size and len(features) > sample_size:
+        features = features[np.sort(rng.choice(len(features), sample_size, replace=False))]
+    k = min(k, len(features))
+    centroids = features[rng.choice(len(features), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = assign_nearest(features, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, features)
+        counts = np.bincount(assignments, minlength=k)
+        empty = counts == 0
+        if empty.any():  # 空聚类重新随机选点
+            sums[empty] = features[rng.choice(len(features), int(empty.sum()), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = (sums / np.maximum(norms, 1e-12)).astype(np.float32)
+    return centroids
+
+
+def assign_nearest(features, centroids, chunk_size=65536):
+    """
+    分块计算每个特征最近的聚类中心，避免一次生成 n*k 的大矩阵
+    :return: np.ndarray[int], 每行对应的聚类编号
+    """
+    assignments = np.empty(len(features), dtype=np.int64)
+    for i in range(0, len(features), chunk_size):
+        assignments[i:i + chunk_size] = np.argmax(features[i:i + chunk_size] @ centroids.T, axis=1)
+    return assignments
+
+
+def get_video_summary(features, k, iterations=10):
+    """
+    计算视频的摘要向量：第0行为全部帧的均值，其余为帧的球面k-means聚类中心（大致对应镜头）。
+    每个摘要向量记录覆盖半径，即分配给它的帧到它的最大欧氏距离。对任意单位查询向量 q 和分配给中心 c 的帧 f，
+    f·q = c·q + (f - c)·q <= c·q + ||f - c||，因此 c·q + 半径 是这些帧分数的上界。
+    :param features: np.ndarray, 一个视频的归一化帧特征，shape=(n, d)
+    :param k: int, 聚类中心数量，不超过帧数
+    :return: (摘要向量 shape=(k + 1, d), 覆盖半径 shape=(k + 1, ))，均为 float32
+    """
+    features = np.asarray(features, dtype=np.float32)
+    mean = features.mean(axis=0, keepdims=True)
+    mean_radius = np.linalg.norm(features - mean, axis=1).max()
+    centroids = spherical_kmeans(features, k, iterations) if k > 0 else features[:0]
+    radii = np.zeros(len(centroids), dtype=np.float32)
+    if len(centroids):
+        assignments = assign_nearest(features, centroids)
+        np.maximum.at(radii, assignments, np.linalg.norm(features - centroids[assignments], axis=1))
+    radii += 1e-3  # 留出特征编码（float16/int8）的误差余量
+    return np.concatenate([mean, centroids]).astype(np.float32), np.concatenate([[mean_radius + 1e-3], radii]).astype(np.float32)
+
+
+def get_video_upper_bounds(query, summaries, radii, summary_offsets):
+    """
+    根据摘要计算每个视频中帧分数的上界：均值的上界与各聚类中心上界的最大值，两者取较小的
+    :param query: np.ndarray, 归一化查询特征
+    :param summaries: np.ndarray, 全部视频的摘要向量
+    :param radii: np.ndarray, 覆盖半径
+    :param summary_offsets: np.ndarray, 第 i 个视频的摘要为 [summary_offsets[i], summary_offsets[i + 1])
+    :return: np.ndarray, 每个视频的上界
+    """
+    if len(summary_offsets) <= 1:
+        return np.empty(0, dtype=np.float32)
+    bounds = summaries @ np.asarray(query, dtype=np.float32).reshape(-1) + radii
+    first = summary_offsets[:-1]
+    mean_bounds = bounds[first]
+    bounds[first] = -np.inf
+    centroid_bounds = np.maximum.reduceat(bounds, first)
+    centroid_bounds[np.diff(summary_offsets) == 1] = np.inf  # 只有均值的视频
+    return np.minimum(mean_bounds, centroid_bounds)
+
+
+def get_candidate_rows(ids, candidate_ids):
+    """
+    将索引返回的图片id转换为特征库中的行号
+    :param ids: np.ndarray, 特征库的id数组，升序
+    :param candidate_ids: np.ndarray, 候选图片id
+    :return: np.ndarray, 升序的行号，特征库中已不存在的id会被忽略
+    """
+    if len(ids) == 0 or len(candidate_ids) == 0:
+        return np.empty(0, dtype=np.int64)
+    rows = np.minimum(np.searchsorted(ids, candidate_ids), len(ids) - 1)
+    rows = rows[ids[rows] == candidate_ids]
+    return np.sort(rows)
+
+
+class IVFIndex:
+    """
+    倒排文件索引（IVF）
+    用k-means聚类中心把特征空间分成 nlist 个桶，每个桶保存属于它的图片id（倒排列表）。
+    搜索时只取与查询最接近的 nprobe 个桶中的图片作为候选，候选再用原始特征精确打分。
+    """
+
+    def __init__(self, path, nlist=IVF_NLIST):
+        self.path = path
+        self.nlist = nlist
+        self.lock = threading.RLock()
+        self.centroids = None
+        self.lists = []  # 每个桶的图片id数组
+        self.dirty = False
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def __len__(self):
+        return sum(len(i) for i in self.lists)
+
+    def train(self, features, iterations=20):
+        """
+        训练聚类中心并清空倒排列表
+        :param features: np.ndarray, 归一化特征
+        """
+        t0 = time.time()
+        centroids = spherical_kmeans(features, self.nlist, iterations, sample_size=self.nlist * 256)
+        with self.lock:
+            self.centroids = centroids
+            self.lists = [np.empty(0, dtype=np.int64) for _ in range(len(centroids))]
+            self.dirty = True
+        logger.info(f"IVF聚类训练完成，聚类数量{len(centroids)}，用时{time.time() - t0:.2f}秒")
+
+    def add(self, ids, features):
+        """
+        添加图片到倒排列表
+        :param ids: np.ndarray, 图片id
+        :param features: np.ndarray, 归一化特征
+        """
+        if not self.trained or len(ids) == 0:
+            return
+        ids = np.asarray(ids, dtype=np.int64)
+        assignments = assign_nearest(np.asarray(features, dtype=np.float32).reshape(len(ids), -1), self.centroids)
+        with self.lock:
+            for list_no in np.unique(assignments):
+                self.lists[list_no] = np.concatenate([self.lists[list_no], ids[assignments == list_no]])
+            self.dirty = True
+
+    def remove(self, ids):
+        """
+        从倒排列表删除图片
+        :param ids: np.ndarray, 图片id
+        """
+        if not self.trained or len(ids) == 0:
+            return
+        ids = np.asarray(ids, dtype=np.int64)
+        with self.lock:
+            for list_no, list_ids in enumerate(self.lists):
+                keep = ~np.isin(list_ids, ids)
+                if not keep.all():
+                    self.lists[list_no] = list_ids[keep]
+            self.dirty = True
+
+    def sync(self, ids, features):
+        """
+        和特征库对齐：添加索引中缺少的图片，删除特征库中已不存在的图片。用于加载磁盘上可能过期的索引后。
+        :param ids: np.ndarray, 特征库的id数组
+        :param features: np.ndarray, 特征库的特征矩阵
+        """
+        if not self.trained:
+            return
+        indexed_ids = np.concatenate(self.lists) if self.lists else np.empty(0, dtype=np.int64)
+        self.remove(np.setdiff1d(indexed_ids, ids))
+        missing = np.isin(ids, indexed_ids, invert=True)
+        if missing.any():
+            self.add(ids[missing], features[missing])
+            logger.info(f"IVF索引补充{int(missing.sum())}张图片")
+
+    def search(self, query, nprobe=IVF_NPROBE):
+        """
+        返回查询向量附近的候选图片id
+        :param query: np.ndarray, 查询特征，shape=(1, d) 或 (d, )
+        :param nprobe: int, 探查的桶数量
+        :return: np.ndarray, 候选图片id
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        with self.lock:
+            nprobe = min(nprobe, len(self.centroids))
+            probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+            lists = [self.lists[i] for i in probe]
+        return np.concatenate(lists) if lists else np.empty(0, dtype=np.int64)
+
+    def save(self):
+        """保存到磁盘，倒排列表拼接成一个数组加偏移量保存"""
+        with self.lock:
+            if not self.trained:
+                return
+            offsets = np.cumsum([0] + [len(i) for i in self.lists])
+            ids = np.concatenate(self.lists) if self.lists else np.empty(0, dtype=np.int64)
+            tmp_path = self.path + ".tmp.npz"
+            np.savez(tmp_path, centroids=self.centroids, ids=ids, offsets=offsets)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        logger.info(f"IVF索引已保存：{self.path}")
+
+    def load(self):
+        """
+        从磁盘加载，文件不存在时保持未训练状态
+        :return: bool, 是否加载成功
+        """
+        if not os.path.isfile(self.path):
+            logger.warning(f"IVF索引文件不存在：{self.path}，请先执行 python vector_index.py build")
+            return False
+        with np.load(self.path) as data:
+            centroids, ids, offsets = data["centroids"], data["ids"], data["offsets"]
+        with self.lock:
+            self.centroids = centroids
+            self.nlist = len(centroids)
+            self.lists = [ids[offsets[i]:offsets[i + 1]] for i in range(len(centroids))]
+            self.dirty = False
+        logger.info(f"IVF索引加载完成，聚类数量{len(centroids)}，图片数量{len(ids)}")
+        return True
+
+
+class HNSWIndex:
+    """
+    分层可导航小世界图索引（HNSW），纯Python/NumPy实现，适合以图搜图这类只要最近邻的查询
+    每个节点随机分配一个层数，高层稀疏、低层稠密；搜索从最高层入口贪心下降到第0层，再在第0层用大小为 ef 的候选集做最佳优先搜索。
+    删除采用墓碑标记：被删除的节点仍参与图的遍历，但不会出现在结果中。
+    搜索时可以传入允许的图片id（路径、时间等筛选条件），不允许的节点同样只参与遍历，不占用结果集。
+    """
+
+    def __init__(self, path, m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, ef_search=HNSW_EF_SEARCH, seed=0):
+        self.path = path
+        self.m = m  # 每层的邻居数量，第0层为 2*m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.level_mult = 1 / np.log(m)
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.RLock()
+        self.dirty = False
+        self._reset()
+
+    def _reset(self):
+        self.count = 0
+        self.vectors = np.empty((0, 0), dtype=np.float32)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.graph = []  # graph[level] = {节点: 邻居节点列表}
+        self.node_of_id = {}
+        self.deleted = set()  # 墓碑
+        self.entry_point = None
+        self.max_level = -1
+
+    def __len__(self):
+        return self.count - len(self.deleted)
+
+    def add(self, ids, features):
+        """
+        逐个插入图片
+        :param ids: np.ndarray, 图片id
+        :param features: np.ndarray, 归一化特征
+        """
+        features = np.asarray(features, dtype=np.float32).reshape(len(ids), -1)
+        with self.lock:
+            for id, vector in zip(np.asarray(ids, dtype=np.int64).tolist(), features):
+                if id in self.node_of_id:  # SQLite 可能复用被删除的最大id，旧节点标记删除后插入新节点
+                    self.deleted.add(self.node_of_id[id])
+                self._insert(id, vector)
+            self.dirty = True
+
+    def remove(self, ids):
+        """
+        标记删除图片
+        :param ids: np.ndarray, 图片id
+        """
+        with self.lock:
+            for id in np.asarray(ids, dtype=np.int64).tolist():
+                node = self.node_of_id.get(id)
+                if node is not None:
+                    self.deleted.add(node)
+                    self.dirty = True
+
+    def sync(self, ids, features):
+        """
+        和特征库对齐：添加缺少的图片，标记删除特征库中已不存在的图片
+        :param ids: np.ndarray, 特征库的id数组
+        :param features: np.ndarray, 特征库的特征矩阵
+        """
+        with self.lock:
+            alive_ids = np.asarray([id for id, node in self.node_of_id.items() if node not in self.deleted], dtype=np.int64)
+        self.remove(np.setdiff1d(alive_ids, ids))
+        missing = np.isin(ids, alive_ids, invert=True)
+        if missing.any():
+            t0 = time.time()
+            self.add(ids[missing], features[missing])
+            logger.info(f"HNSW索引补充{int(missing.sum())}张图片，用时{time.time() - t0:.2f}秒")
+
+    def search(self, query, k, ef=None, allowed_ids=None):
+        """
+        搜索最近邻
+        :param query: np.ndarray, 查询特征，shape=(1, d) 或 (d, )
+        :param k: int, 返回数量
+        :param ef: int, 搜索时候选集大小，越大召回率越高，速度越慢，默认为 HNSW_EF_SEARCH
+        :param allowed_ids: np.ndarray, 只返回这些图片，None 表示不限制
+        :return: np.ndarray, 按相似度从高到低排列的图片id
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        with self.lock:
+            if self.entry_point is None or k <= 0:
+                return np.empty(0, dtype=np.int64)
+            allowed = None
+            if allowed_ids is not None:
+                allowed = np.isin(self.ids[:self.count], allowed_ids)
+                if not allowed.any():
+                    return np.empty(0, dtype=np.int64)
+            entry_points = [self.entry_point]
+            for level in range(self.max_level, 0, -1):
+                entry_points = [max(self._search_layer(query, entry_points, 1, level))[1]]
+            results = self._search_layer(query, entry_points, max(ef or self.ef_search, k), 0, allowed)
+            nodes = [node for score, node in sorted(results, reverse=True) if node not in self.deleted][:k]
+            return self.ids[nodes]
+
+    def _search_layer(self, query, entry_points, ef, level, allowed=None):
+        """
+        在某一层做最佳优先搜索
+        :param allowed: np.ndarray[bool], 每个节点能否进入结果，不允许的节点只用于遍历，None 表示都允许
+        :return: list[(相似度, 节点)], 最多 ef 个
+        """
+        layer = self.graph[level]
+        visited = set(entry_points)
+        scores = (self.vectors[entry_points] @ query).tolist()
+        candidates = [(-score, node) for score, node in zip(scores, entry_points)]  # 相似度最大的先出队
+        results = [(score, node) for score, node in zip(scores, entry_points) if allowed is None or allowed[node]]  # 小顶堆，保留相似度最大的 ef 个
+        heapq.heapify(candidates)
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+        while candidates:
+            negative_score, node = heapq.heappop(candidates)
+            if len(results) >= ef and -negative_score < results[0][0]:
+                break
+            neighbors = [i for i in layer[node] if i not in visited]
+            if not neighbors:
+                continue
+            visited.update(neighbors)
+            for score, neighbor in zip((self.vectors[neighbors] @ query).tolist(), neighbors):
+                if len(results) < ef or score > results[0][0]:
+                    heapq.heappush(candidates, (-score, neighbor))
+                    if allowed is None or allowed[neighbor]:
+                        heapq.heappush(results, (score, neighbor))
+                        if len(results) > ef:
+                            heapq.heappop(results)
+        return results
+
+    def _insert(self, id, vector):
+        """插入一个节点"""
+        node = self.count
+        if node >= len(self.ids):  # 按倍数扩容
+            capacity = max(1024, len(self.ids) * 2)
+            vectors = np.empty((capacity, len(vector)), dtype=np.float32)
+            if node:
+                vectors[:node] = self.vectors[:node]
+            ids = np.empty(capacity, dtype=np.int64)
+            ids[:node] = self.ids[:node]
+            self.vectors, self.ids = vectors, ids
+        self.vectors[node] = vector
+        self.ids[node] = id
+        self.node_of_id[id] = node
+        self.count += 1
+
+        level = int(-np.log(1 - self.rng.random()) * self.level_mult)
+        while len(self.graph) <= level:
+            self.graph.append({})
+        for i in range(level + 1):
+            self.graph[i][node] = []
+        if self.entry_point is None:
+            self.entry_point, self.max_level = node, level
+            return
+
+        entry_points = [self.entry_point]
+        for i in range(self.max_level, level, -1):  # 高层只贪心找最近的点
+            entry_points = [max(self._search_layer(vector, entry_points, 1, i))[1]]
+        for i in range(min(level, self.max_level), -1, -1):
+            results = self._search_layer(vector, entry_points, self.ef_construction, i)
+            max_links = self.m * 2 if i == 0 else self.m
+            neighbors = [n for score, n in heapq.nlargest(self.m, results)]
+            self.graph[i][node] = neighbors
+            for neighbor in neighbors:  # 反向连边，超过上限时只保留最相似的
+                links = self.graph[i][neighbor]
+                links.append(node)
+                if len(links) > max_links:
+                    scores = self.vectors[links] @ self.vectors[neighbor]
+                    self.graph[i][neighbor] = [links[j] for j in np.argpartition(-scores, max_links - 1)[:max_links]]
+            entry_points = [n for score, n in results]
+        if level > self.max_level:
+            self.entry_point, self.max_level = node, level
+
+    def save(self):
+        """保存到磁盘"""
+        with self.lock:
+            data = {
+                "m": self.m,
+                "vectors": self.vectors[:self.count],
+                "ids": self.ids[:self.count],
+                "graph": self.graph,
+                "deleted": self.deleted,
+                "entry_point": self.entry_point,
+                "max_level": self.max_level,
+            }
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        logger.info(f"HNSW索引已保存：{self.path}")
+
+    def load(self):
+        """
+        从磁盘加载
+        :return: bool, 是否加载成功
+        """
+        if not os.path.isfile(self.path):
+            logger.warning(f"HNSW索引文件不存在：{self.path}，请先执行 python vector_index.py build --type hnsw")
+            return False
+        with open(self.path, "rb") as f:
+            data = pickle.load(f)
+        with self.lock:
+            self._reset()
+            self.m = data["m"]
+            self.level_mult = 1 / np.log(self.m)
+            self.vectors = data["vectors"]
+            self.ids = data["ids"]
+            self.count = len(self.ids)
+            self.graph = data["graph"]
+            self.deleted = data["deleted"]
+            self.entry_point = data["entry_point"]
+            self.max_level = data["max_level"]
+            self.node_of_id = {id: node for node, id in enumerate(self.ids.tolist())}
+            self.dirty = False
+        logger.info(f"HNSW索引加载完成，图片数量{len(self)}，已删除{len(self.deleted)}")
+        return True
+
+
+image_ivf_index = IVFIndex(os.path.join(INDEX_PATH, "image_ivf.npz"))
+image_hnsw_index = HNSWIndex(os.path.join(INDEX_PATH, "image_hnsw.pickle"))
+
+
+def exact_top_ids(features, ids, query, k):
+    """精确计算与查询最相似的 k 张图片id，用于评估召回率"""
+    scores = features @ query.reshape(-1)
+    k = min(k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    return ids[top]
+
+
+def approximate_top_ids(candidate_ids, features, ids, query, k):
+    """对索引给出的候选精确计算，返回其中最相似的 k 张图片id"""
+    rows = get_candidate_rows(ids, candidate_ids)
+    if len(rows) == 0:
+        return ids[:0]
+    return exact_top_ids(features[rows], ids[rows], query, k)
+
+
+if __name__ == '__main__':
+    import argparse
+    from feature_store import image_feature_store
+
+    parser = argparse.ArgumentParser(description='Build or evaluate the vector index of image features.')
+    parser.add_argument('command', metavar='<command>', choices=['build', 'evaluate'], help='build: build and save the index; evaluate: compare recall with exact search.')
+    parser.add_argument('--type', choices=['ivf', 'hnsw'], default='ivf', help='index type.')
+    parser.add_argument('--nlist', type=int, default=IVF_NLIST, help='number of IVF clusters when building.')
+    parser.add_argument('--nprobe', type=int, default=IVF_NPROBE, help='number of probed IVF clusters when evaluating.')
+    parser.add_argument('--ef', type=int, default=HNSW_EF_SEARCH, help='HNSW ef_search when evaluating.')
+    parser.add_argument('--queries', type=int, default=100, help='number of sampled queries when evaluating.')
+    parser.add_argument('--top-k', type=int, default=50, help='k of recall@k when evaluating.')
+    args = parser.parse_args()
+
+    image_feature_store.load()
+    features, ids, paths, modify_times = image_feature_store.snapshot()
+    if len(ids) == 0:
+        print("数据库中没有图片，请先扫描")
+        exit(1)
+    if image_feature_store.quantizer is not None:  # PQ模式下特征库中是编码，解码为近似特征
+        features = image_feature_store.quantizer.decode(features)
+    index = image_ivf_index if args.type == 'ivf' else image_hnsw_index
+    if args.command == 'build':
+        if args.type == 'ivf':
+            index.nlist = args.nlist
+            index.train(features)
+        else:
+            index._reset()
+        t0 = time.time()
+        index.add(ids, features)
+        logger.info(f"索引建立完成，用时{time.time() - t0:.2f}秒")
+        index.save()
+    elif args.command == 'evaluate':
+        if not index.load():
+            exit(1)
+        index.sync(ids, features)
+        rng = np.random.default_rng(0)
+        query_rows = rng.choice(len(ids), min(args.queries, len(ids)), replace=False)
+        recalls, exact_time, index_time = [], 0, 0
+        for row in query_rows:
+            t0 = time.time()
+            exact = exact_top_ids(features, ids, features[row], args.top_k)
+            t1 = time.time()
+            if args.type == 'ivf':
+                candidate_ids = index.search(features[row], args.nprobe)
+            else:
+                candidate_ids = index.search(features[row], args.top_k, args.ef)
+            approximate = approximate_top_ids(candidate_ids, features, ids, features[row], args.top_k)
+            t2 = time.time()
+            exact_time += t1 - t0
+            index_time += t2 - t1
+            recalls.append(len(np.intersect1d(exact, approximate)) / len(exact))
+        print(f'images: {len(ids)}  type: {args.type}  nprobe: {args.nprobe}  ef: {args.ef}')
+        print(f'recall@{args.top_k}: {np.mean(recalls):.4f}')
+        print(f'exact: {exact_time / len(query_rows) * 1000:.2f}ms/query  {args.type}: {index_time / len(query_rows) * 1000:.2f}ms/query')
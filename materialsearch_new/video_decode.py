@@ -0,0 +1,374 @@
+# 视频抽帧：每隔 FRAME_INTERVAL 秒取一帧，按文件的GOP结构和抽帧密度在三种方式中选择解码量最少的一种：
+# grab 顺序读取并跳过中间的帧；seek 按帧号跳转，每次从前一个关键帧解码到目标帧；keyframe 用 ffmpeg 只解码关键帧（-skip_frame nokey）。
+# 每帧解码后立即缩放裁剪为模型输入尺寸的 uint8 RGB 像素，写入预先分配的整批数组，内存占用与视频分辨率无关。
+# 开启 VIDEO_DEDUP 时由 FrameRows 跳过重复帧、合并相似帧。
+# 扫描时在工作进程中运行 decode_video，需要推理的帧写入共享内存环形缓冲区，经消息队列按顺序通知主进程。本模块不加载模型。
+import logging
+import platform
+import re
+import shutil
+import subprocess
+import threading
+import time
+from queue import Queue
+
+import cv2
+import numpy as np
+from tqdm import trange
+
+from config import (
+    FRAME_INTERVAL, SCAN_PROCESS_BATCH_SIZE, VIDEO_FRAME_SAMPLING, VIDEO_DEDUP_PIXEL_THRESHOLD, VIDEO_DEDUP_FEATURE_EPSILON,
+)
+from image_decode import PixelRing, get_image_pixels
+
+logger = logging.getLogger(__name__)
+
+FFMPEG = "ffmpeg.exe" if platform.system() == "Windows" else "ffmpeg"
+FFPROBE = "ffprobe.exe" if platform.system() == "Windows" else "ffprobe"
+SAMPLING_STRATEGIES = ("grab", "seek", "keyframe")
+GOP_PROBE_SECONDS = 60  # 探测GOP结构时读取开头多少秒的数据包，只解析封装不解码
+SEEK_COST_FRAMES = 8  # 一次跳转除了从关键帧解码到目标帧之外的固定开销（清空解码器、重新定位等），折算成解码帧数
+CHUNK_SIZE = 32  # 工作进程每次发送的帧数，较小时多个视频的帧能更均匀地拼在一起
+THUMBNAIL_SIZE = 16  # 比较重复帧时缩小到的边长
+SHOWINFO_PATTERN = re.compile(rb"\bpts_time:\s*(\S+).*?\bs:(\d+)x(\d+)")
+
+_worker = {}  # 工作进程中的环形缓冲区、空闲槽位和消息队列等，由 init_worker 设置
+
+
+def get_keyframe_interval(path):
+    """
+    用 ffprobe 读取视频开头 GOP_PROBE_SECONDS 秒的数据包（不解码），估算关键帧的平均间隔
+    :param path: string, 视频路径
+    :return: float, 关键帧间隔，单位秒；没有 ffprobe、读取失败或关键帧不足两个时返回 None
+    """
+    if shutil.which(FFPROBE) is None:
+        return None
+    command = [
+        FFPROBE, "-v", "error", "-select_streams", "v:0", "-read_intervals", f"%+{GOP_PROBE_SECONDS}",
+        "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", path,
+    ]
+    try:
+        output = subprocess.run(command, capture_output=True, timeout=60).stdout.decode(errors="ignore")
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"探测关键帧间隔失败：{path} {repr(e)}")
+        return None
+    times = []
+    for line in output.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" not in flags:
+            continue
+        try:
+            times.append(float(pts_time))
+        except ValueError:  # N/A
+            continue
+    if len(times) < 2:
+        return None
+    times.sort()
+    return (times[-1] - times[0]) / (len(times) - 1)
+
+
+def choose_frame_sampling(frame_rate, keyframe_interval):
+    """
+    估算每取一帧需要解码的帧数，选择开销最小的抽帧方式
+    grab：每取一帧解码 FRAME_INTERVAL 秒内的全部帧；
+    seek：从前一个关键帧解码到目标帧，平均约半个GOP，另加固定开销；
+    keyframe：只解码关键帧，平均每个抽帧间隔解码 间隔/GOP 个关键帧。只有关键帧间隔不大于抽帧间隔时才使用，否则取到的帧会比设定的稀疏。
+    不知道GOP结构时使用 grab，与原来的行为一致
+    :param frame_rate: int, 帧率
+    :param keyframe_interval: float, 关键帧间隔，单位秒，None 表示未知
+    :return: (string, 抽帧方式; dict, 各方式估算的每取一帧需要解码的帧数)
+    """
+    step = FRAME_INTERVAL * frame_rate
+    costs = {"grab": float(step)}
+    if keyframe_interval is not None:
+        gop_frames = max(1.0, keyframe_interval * frame_rate)
+        costs["seek"] = gop_frames / 2 + SEEK_COST_FRAMES
+        if keyframe_interval <= FRAME_INTERVAL and shutil.which(FFMPEG):
+            costs["keyframe"] = max(1.0, step / gop_frames)
+    return min(costs, key=costs.get), costs
+
+
+def read_frames_grab(video, frame_rate, total_frames):
+    """
+    顺序读取，每隔 FRAME_INTERVAL * frame_rate 帧取一帧，中间的帧用 grab 跳过
+    :return: 生成器，每次返回 (帧编号, BGR帧像素)
+    """
+    step = FRAME_INTERVAL * frame_rate
+    for current_frame in trange(0, total_frames, step, desc="当前进度", unit="frame"):
+        ret, frame = video.read()
+        if not ret:
+            break
+        yield current_frame // frame_rate, frame
+        for _ in range(step - 1):
+            video.grab()  # 跳帧
+
+
+def read_frames_seek(video, frame_rate, total_frames):
+    """
+    按帧号跳转到每个要取的帧，取到的帧与 grab 相同
+    :return: 生成器，每次返回 (帧编号, BGR帧像素)
+    """
+    step = FRAME_INTERVAL * frame_rate
+    for current_frame in trange(0, total_frames, step, desc="当前进度", unit="frame"):
+        if current_frame:
+            video.set(cv2.CAP_PROP_POS_FRAMES, current_frame)
+        ret, frame = video.read()
+        if not ret:
+            break
+        yield current_frame // frame_rate, frame
+
+
+def read_frames_keyframe(path):
+    """
+    用 ffmpeg 只解码关键帧，并用 select 过滤器保证相邻两帧至少相隔 FRAME_INTERVAL 秒，通过管道读取BGR像素。
+    每帧的时间和尺寸由 showinfo 过滤器输出到 stderr，在单独的线程中读取，避免管道写满后互相等待
+    :param path: string, 视频路径
+    :return: 生成器，每次返回 (帧编号（秒）, BGR帧像素)
+    """
+    command = [
+        FFMPEG, "-hide_banner", "-nostdin", "-skip_frame", "nokey", "-i", path, "-map", "0:v:0", "-an", "-sn",
+        "-vf", f"select='isnan(prev_selected_t)+gte(t-prev_selected_t,{FRAME_INTERVAL})',showinfo",
+        "-vsync", "0", "-f", "rawvideo", "-pix_fmt", "bgr24", "pipe:1",
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    infos = Queue()
+
+    def read_infos():
+        for line in process.stderr:
+            match = SHOWINFO_PATTERN.search(line)
+            if match:
+                infos.put(match.groups())
+        infos.put(None)
+
+    thread = threading.Thread(target=read_infos, daemon=True)
+    thread.start()
+    try:
+        while True:
+            info = infos.get()
+            if info is None:
+                break
+            pts_time, width, height = info
+            width, height = int(width), int(height)
+            data = process.stdout.read(width * height * 3)
+            if len(data) < width * height * 3:
+                break
+            try:
+                frame_id = int(float(pts_time))
+            except ValueError:  # NOPTS
+                continue
+            yield frame_id, np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3)
+    finally:
+        process.kill()
+        process.wait()
+        thread.join()
+
+
+def read_frames(path, video, strategy, frame_rate, total_frames, on_fallback=None):
+    """
+    按指定的抽帧方式逐帧读取，ffmpeg 一帧都没有取到时（如不支持的封装格式）改用 grab
+    :param on_fallback: 改用 grab 时调用 on_fallback("grab")
+    :return: 生成器，每次返回 (帧编号, BGR帧像素)
+    """
+    if strategy == "seek":
+        yield from read_frames_seek(video, frame_rate, total_frames)
+        return
+    if strategy == "keyframe":
+        count = 0
+        for item in read_frames_keyframe(path):
+            count += 1
+            yield item
+        if count:
+            return
+        logger.warning(f"ffmpeg 没有取到关键帧，改用 grab 抽帧：{path}")
+        if on_fallback:
+            on_fallback("grab")
+    yield from read_frames_grab(video, frame_rate, total_frames)
+
+
+def resize_frame(image_processor, frame):
+    """
+    把解码出的BGR帧缩放裁剪为模型输入尺寸的RGB像素。缩放按通道独立进行，先缩放再交换通道，结果与先转RGB相同，只需处理小图
+    :param image_processor: processor.image_processor
+    :param frame: np.ndarray[uint8], BGR帧像素，shape=(H, W, 3)
+    :return: np.ndarray[uint8], RGB像素，shape=(h, w, 3)
+    """
+    return get_image_pixels(image_processor, frame)[:, :, ::-1]
+
+
+def get_frames(path, image_processor, shape, batch_size=SCAN_PROCESS_BATCH_SIZE, on_start=None, on_fallback=None):
+    """
+    获取视频的帧数据，按 VIDEO_FRAME_SAMPLING 选择抽帧方式，auto 时逐个文件选择
+    :param path: string, 视频路径
+    :param image_processor: processor.image_processor，每帧解码后立即缩放裁剪
+    :param shape: tuple, 模型输入的 uint8 像素尺寸 (h, w, 3)
+    :param batch_size: int, 每批最多的帧数
+    :param on_start: 选定抽帧方式后调用 on_start(抽帧方式, 预计抽取的帧数)，用于汇报进度
+    :param on_fallback: keyframe 没有取到帧、改用 grab 时调用 on_fallback("grab")
+    :return: 生成器，每次返回 (list[int], np.ndarray[uint8]) (帧编号列表, RGB像素，shape=(n, h, w, 3)) 元组。
+             像素是预先分配的数组的视图，取下一批时会被覆盖
+    """
+    video = cv2.VideoCapture(path)
+    if not video.isOpened():
+        logger.error(f"无法打开视频文件: {path}")
+        return
+    try:
+        frame_rate = round(video.get(cv2.CAP_PROP_FPS))
+        total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        if frame_rate <= 0:
+            logger.error(f"无法获取视频帧率: {path}")
+            return
+        keyframe_interval = None
+        if VIDEO_FRAME_SAMPLING == "auto":
+            keyframe_interval = get_keyframe_interval(path)
+            strategy, costs = choose_frame_sampling(frame_rate, keyframe_interval)
+        elif VIDEO_FRAME_SAMPLING in SAMPLING_STRATEGIES:
+            strategy, costs = VIDEO_FRAME_SAMPLING, {}
+        else:
+            logger.warning(f"未知的抽帧方式 {VIDEO_FRAME_SAMPLING}，使用 grab")
+            strategy, costs = "grab", {}
+        if strategy == "keyframe" and shutil.which(FFMPEG) is None:
+            logger.warning("没有找到 ffmpeg，使用 grab 抽帧")
+            strategy = "grab"
+        if on_start:
+            on_start(strategy, len(range(0, max(total_frames, 0), FRAME_INTERVAL * frame_rate)))
+        logger.info(
+            f"抽帧方式：{strategy} fps: {frame_rate} total: {total_frames} 关键帧间隔: {keyframe_interval} "
+            f"估算每取一帧解码帧数: { {k: round(v, 1) for k, v in costs.items()} }"
+        )
+        batch = np.empty((batch_size, *shape), dtype=np.uint8)
+        ids = []
+        for frame_id, frame in read_frames(path, video, strategy, frame_rate, total_frames, on_fallback):
+            batch[len(ids)] = resize_frame(image_processor, frame)
+            ids.append(frame_id)
+            if len(ids) == batch_size:
+                yield ids, batch
+                ids = []
+        if ids:
+            yield ids, batch[:len(ids)]
+    finally:
+        video.release()
+
+
+def get_frame_thumbnails(pixels):
+    """
+    把一批帧缩小为 THUMBNAIL_SIZE 见方的灰度图，用于低成本地比较相邻帧是否重复
+    :param pixels: np.ndarray[uint8], RGB像素，shape=(n, h, w, 3)
+    :return: np.ndarray[int16], shape=(n, THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+    """
+    return np.stack([
+        cv2.resize(cv2.cvtColor(np.ascontiguousarray(i), cv2.COLOR_RGB2GRAY), (THUMBNAIL_SIZE, THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA)
+        for i in pixels
+    ]).astype(np.int16)
+
+
+class FrameRows:
+    """
+    把一个视频按时间顺序抽出的帧合并为若干行 (开始时间, 结束时间, 特征)
+    select 找出与上一个推理过的帧像素几乎相同的帧，这些帧不做推理，直接并入当前行；
+    add 把推理过的帧与当前行第一帧的特征比较，余弦距离不超过 feature_epsilon 时并入当前行，否则开始新的一行。
+    用法：keep = select(pixels)，只对 pixels[keep] 推理，再 add(ids, keep, features) 得到已经结束的行，全部帧处理完后 flush() 得到最后一行。
+    """
+
+    def __init__(self, pixel_threshold=VIDEO_DEDUP_PIXEL_THRESHOLD, feature_epsilon=VIDEO_DEDUP_FEATURE_EPSILON):
+        self.pixel_threshold = pixel_threshold
+        self.feature_epsilon = feature_epsilon
+        self.last_thumbnail = None  # 上一个推理过的帧的缩略图
+        self.row = None  # 当前行 [开始时间, 结束时间, 特征]
+
+    def select(self, pixels):
+        """
+        :param pixels: np.ndarray[uint8], 一批帧的RGB像素，shape=(n, h, w, 3)
+        :return: np.ndarray[bool], 需要推理的帧
+        """
+        keep = np.ones(len(pixels), dtype=bool)
+        for i, thumbnail in enumerate(get_frame_thumbnails(pixels)):
+            if self.last_thumbnail is not None and np.abs(thumbnail - self.last_thumbnail).mean() <= self.pixel_threshold:
+                keep[i] = False
+            else:
+                self.last_thumbnail = thumbnail
+        return keep
+
+    def add(self, ids, keep, features):
+        """
+        :param ids: list[int], 一批帧的时间
+        :param keep: np.ndarray[bool], select 的结果
+        :param features: np.ndarray, 推理过的帧的归一化特征，与 ids[keep] 逐行对应
+        :return: list[tuple], 已经结束的行 (开始时间, 结束时间, 特征)
+        """
+        rows = []
+        features = iter(features)
+        for frame_id, kept in zip(ids, keep):
+            if not kept:
+                if self.row is not None:
+                    self.row[1] = frame_id
+                continue
+            feature = next(features)
+            if self.row is not None and np.dot(self.row[2], feature) >= 1 - self.feature_epsilon:
+                self.row[1] = frame_id
+                continue
+            if self.row is not None:
+                rows.append(tuple(self.row))
+            self.row = [frame_id, frame_id, feature]
+        return rows
+
+    def flush(self):
+        """
+        结束当前行，之后的帧重新开始比较，用于视频结束或中间一批推理失败时
+        :return: list[tuple], 最后一行，没有时为空列表
+        """
+        row, self.row, self.last_thumbnail = self.row, None, None
+        return [] if row is None else [tuple(row)]
+
+
+def init_worker(ring_name, slots, shape, image_processor, free_slots, messages, stop_event):
+    """工作进程初始化：打开环形缓冲区，保存空闲槽位队列、消息队列和停止标志"""
+    _worker["ring"] = PixelRing(slots, shape, ring_name)
+    _worker["shape"] = tuple(shape)
+    _worker["image_processor"] = image_processor
+    _worker["free_slots"] = free_slots
+    _worker["messages"] = messages
+    _worker["stop_event"] = stop_event
+
+
+def decode_video(key, path, dedup=False):
+    """
+    在工作进程中按块抽帧，需要推理的帧逐张写入空闲槽位（没有空闲槽位时等待，即背压），按顺序发送消息：
+    ("start", key, 抽帧方式, 预计帧数)、若干个 ("chunk", key, 帧时间列表, 是否推理的掩码, 槽位列表, 解码耗时)，
+    最后一定发送 ("end", key, 是否出错, 是否因停止扫描而中断, 实际使用的抽帧方式)。keyframe 改用 grab 时结束标记中为 grab，主进程据此统计
+    :param key: int, 主进程中视频的编号
+    :param path: string, 视频路径
+    :param dedup: bool, 是否跳过与上一个推理过的帧像素几乎相同的帧
+    """
+    ring, free_slots, messages = _worker["ring"], _worker["free_slots"], _worker["messages"]
+    frame_rows = FrameRows() if dedup else None
+    failed = cancelled = False
+    strategy = None  # 实际使用的抽帧方式，没有打开视频时为 None
+
+    def on_start(chosen, expected):
+        nonlocal strategy
+        strategy = chosen
+        messages.put(("start", key, chosen, expected))
+
+    def on_fallback(fallback):
+        nonlocal strategy
+        strategy = fallback
+
+    try:
+        t0 = time.time()
+        for ids, pixels in get_frames(path, _worker["image_processor"], _worker["shape"], CHUNK_SIZE, on_start, on_fallback):
+            if _worker["stop_event"].is_set():
+                cancelled = True
+                break
+            keep = frame_rows.select(pixels) if frame_rows else np.ones(len(ids), dtype=bool)
+            seconds = time.time() - t0
+            slots = []
+            for pixel in pixels[keep]:
+                slot = free_slots.get()
+                ring.array[slot] = pixel
+                slots.append(slot)
+            messages.put(("chunk", key, ids, keep, slots, seconds))
+            t0 = time.time()
+    except Exception as e:
+        logger.error(f"解码视频失败：{path} {repr(e)}")
+        failed = True
+    messages.put(("end", key, failed, cancelled, strategy))
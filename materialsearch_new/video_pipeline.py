@@ -0,0 +1,301 @@
+# 视频入库流水线：多个视频同时解码抽帧 → 跨视频组批 → 模型推理 → 写入数据库。
+# 解码在进程池中进行，不受GIL限制；工作进程把需要推理的帧写入共享内存环形缓冲区，经消息队列按顺序通知推理线程，空闲槽位用完时工作进程等待。
+# 短视频每个只有几帧，逐个视频推理时模型总是处理很小的批次；这里把多个视频的帧块拼成满批，每个视频仍按顺序记录自己的帧块，
+# 全部帧块都得到特征后才把整个视频交给唯一的写入线程，由 add_video 一次提交。
+import logging
+import multiprocessing
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from queue import Queue
+
+import numpy as np
+
+from config import *
+from image_decode import PixelRing
+from image_pipeline import StageStats
+from process_assets import get_image_processor, get_pixel_features, get_pixel_shape, preprocess_pixels
+from video_decode import CHUNK_SIZE, FrameRows, decode_video, init_worker
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("decode", "batch", "model", "write")
+
+sampling_counts = Counter()  # 各抽帧方式实际使用的次数，按工作进程的结束标记在推理线程中统计
+
+
+class VideoState:
+    """
+    一个视频在主进程中的入库状态：按时间顺序排队等待特征的帧块，以及已经合并好的行。只在推理线程中修改
+    """
+
+    def __init__(self, key, path, info):
+        self.key = key
+        self.path = path
+        self.info = info
+        self.frame_rows = FrameRows() if VIDEO_DEDUP else None
+        self.chunks = deque()  # 还没有合并为行的帧块，按时间顺序
+        self.rows = []  # (帧时间, 结束帧时间, 特征)
+        self.started = False  # 工作进程已开始抽帧
+        self.expected_frames = 0  # 预计抽取的帧数
+        self.frames = 0  # 已抽取的帧数
+        self.ended = False  # 已收到结束标记
+        self.failed = False  # 解码或推理出错，不写入特征
+        self.cancelled = False  # 停止扫描时取消或中断，不写入，下次扫描时重新处理
+
+    def add(self, chunk):
+        """帧块的特征全部得到后，按顺序合并为行"""
+        features = np.concatenate(chunk.features) if chunk.features else []
+        if self.frame_rows:
+            self.rows += self.frame_rows.add(chunk.ids, chunk.keep, features)
+        else:
+            self.rows += [(i, i, feature) for i, feature in zip(chunk.ids, features)]
+
+    def finish(self):
+        """
+        :return: list[tuple], 视频的全部行
+        """
+        if self.frame_rows:
+            self.rows += self.frame_rows.flush()
+        return self.rows
+
+
+class FrameChunk:
+    """
+    一个视频中连续的一段帧，需要推理的帧可能被拆到相邻的两批中，特征按批次陆续填入
+    """
+
+    def __init__(self, video, ids, keep, slots):
+        self.video = video
+        self.ids = ids
+        self.keep = keep  # 需要推理的帧，其余为重复帧
+        self.slots = slots  # 需要推理的帧所在的槽位，拷入批次后归还
+        self.remaining = len(slots)  # 还没有得到特征的帧数
+        self.features = []
+
+
+class VideoPipeline:
+    """
+    视频入库流水线
+    start() 后逐个 put(path, info)，全部放入后 close() 等待流水线处理完毕。
+    write(path, info, rows) 在唯一的写入线程中被调用，每次一个视频：rows 为 (帧时间, 结束帧时间, 特征) 列表，解码或提取特征出错时为 None。
+    is_running 返回 False 后 put 不再接收视频，close 取消还没开始解码的视频，正在解码的视频中断且不写入。
+    """
+
+    def __init__(self, write, batch_size=SCAN_PROCESS_BATCH_SIZE, decode_workers=SCAN_VIDEO_WORKERS, is_running=None):
+        self.write = write
+        self.batch_size = max(1, batch_size)
+        self.decode_workers = max(1, decode_workers)
+        self.is_running = is_running or (lambda: True)
+        self.slots = 2 * CHUNK_SIZE * self.decode_workers  # 推理线程拷入批次后立即归还槽位，每个工作进程两块即可
+        self.decode_slots = threading.Semaphore(2 * self.decode_workers)  # 已放入还没解码完的视频数量上限
+        self.result_queue = None
+        self.stats = {name: StageStats() for name in STAGES}
+        self.videos = {}  # {编号: VideoState}，还没有写入的视频
+        self.next_key = 0
+        self.queued_files = 0  # 放入的视频数量
+        self.written_files = 0  # 写入的视频数量，包括出错的
+        self.failed_files = 0  # 解码或提取特征出错的视频数量
+        self.ring = None
+        self.free_slots = None
+        self.messages = None
+        self.stop_event = None
+        self.pixels = None  # 预先分配的一批 uint8 像素，跨视频拼批
+        self.pixel_values = None  # 预先分配的模型输入，每批复用
+        self.pool = None
+        self.threads = []
+        self.start_time = 0
+
+    def start(self):
+        """创建环形缓冲区和解码进程池，启动推理和写入线程"""
+        self.start_time = time.time()
+        shape = get_pixel_shape()
+        self.ring = PixelRing(self.slots, shape)
+        self.free_slots = multiprocessing.Queue()
+        for slot in range(self.slots):
+            self.free_slots.put(slot)
+        self.messages = multiprocessing.Queue()
+        self.stop_event = multiprocessing.Event()
+        self.result_queue = Queue(maxsize=self.decode_workers)
+        self.pixels = np.empty((self.batch_size, *shape), dtype=np.uint8)
+        self.pixel_values = np.empty((self.batch_size, 3, *shape[:2]), dtype=np.float32)
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.decode_workers, initializer=init_worker,
+            initargs=(self.ring.name, self.slots, shape, get_image_processor(), self.free_slots, self.messages, self.stop_event),
+        )
+        self.threads = [threading.Thread(target=target, daemon=True) for target in (self.infer, self.write_results)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, path, info=None):
+        """
+        放入一个视频，正在解码的视频过多时等待
+        :param path: string, 视频路径
+        :param info: 附带的信息，原样传给 write
+        :return: bool, 流水线已停止时不再接收，返回 False
+        """
+        if not self.is_running():
+            return False
+        self.decode_slots.acquire()
+        key = self.next_key
+        self.next_key += 1
+        self.videos[key] = VideoState(key, path, info)
+        self.queued_files += 1
+        future = self.pool.submit(decode_video, key, path, VIDEO_DEDUP)
+        future.add_done_callback(partial(self.on_decoded, key, path))
+        return True
+
+    def on_decoded(self, key, path, future):
+        """工作进程完成一个视频的回调：取消或工作进程异常退出时，由主进程代为发送结束标记"""
+        self.decode_slots.release()
+        if future.cancelled():
+            self.messages.put(("end", key, False, True, None))
+        elif future.exception() is not None:
+            logger.error(f"解码视频失败：{path} {repr(future.exception())}")
+            self.messages.put(("end", key, True, False, None))
+
+    def close(self):
+        """不再放入视频，等待已放入的视频全部写入；已停止时中断正在解码的视频并取消还没开始解码的视频"""
+        if not self.is_running():
+            self.stop_event.set()
+        self.pool.shutdown(wait=True, cancel_futures=not self.is_running())
+        self.messages.put(None)  # 工作进程的消息可能晚于此标记到达，推理线程等全部视频结束后才退出
+        for thread in self.threads:
+            thread.join()
+        self.ring.close(unlink=True)
+        logger.info(f"视频流水线完成，用时{time.time() - self.start_time:.2f}秒，各阶段：{self.get_stats()}")
+
+    def get_stats(self):
+        """
+        :return: dict, 各阶段的处理数量（解码、组批、推理为帧数，写入为视频数）、工作时间和吞吐量
+        """
+        return {name: stats.to_dict() for name, stats in self.stats.items()}
+
+    def get_progress(self):
+        """
+        :return: dict, 按文件和按帧的进度，以及正在解码的视频各自的帧数
+        """
+        videos = list(self.videos.values())
+        current = [i for i in videos if i.started and not i.ended]
+        return {
+            "queued_files": self.queued_files,
+            "decoding_files": len(current),
+            "written_files": self.written_files,
+            "failed_files": self.failed_files,
+            "decoded_frames": self.stats["decode"].count,
+            "embedded_frames": self.stats["model"].count,
+            "current": [{"path": i.path, "frames": i.frames, "expected_frames": i.expected_frames} for i in current],
+        }
+
+    def infer(self):
+        """
+        组批和推理阶段：按消息顺序把各视频的帧从槽位拷入预先分配的批次并归还槽位，凑满一批做一次前向计算；
+        收到关闭标记且全部视频都已结束后处理最后不满的一批
+        """
+        n, pending = 0, []  # 当前批次的帧数，以及 (帧块, 帧数) 列表
+        closing = False
+        while not (closing and all(i.ended for i in self.videos.values())):
+            message = self.messages.get()
+            if message is None:
+                closing = True
+                continue
+            kind, key = message[:2]
+            video = self.videos.get(key)
+            if kind == "chunk" and (video is None or video.ended):  # 主进程已代为结束的视频，只归还槽位
+                for slot in message[4]:
+                    self.free_slots.put(slot)
+                continue
+            if video is None or video.ended:
+                continue
+            if kind == "start":
+                video.started = True
+                video.expected_frames = message[3]
+            elif kind == "end":
+                video.ended = True
+                video.failed |= message[2]
+                video.cancelled = message[3]
+                if message[4]:
+                    sampling_counts[message[4]] += 1
+                self.drain(key)
+            else:
+                _, _, ids, keep, slots, seconds = message
+                self.stats["decode"].add(len(ids), seconds)
+                video.frames += len(ids)
+                chunk = FrameChunk(video, ids, keep, slots)
+                video.chunks.append(chunk)
+                t0 = time.time()
+                count = 0  # 这个帧块放入当前批次的帧数
+                for slot in slots:
+                    self.pixels[n] = self.ring.array[slot]
+                    self.free_slots.put(slot)
+                    n += 1
+                    count += 1
+                    if n == self.batch_size:
+                        pending.append((chunk, count))
+                        self.stats["batch"].add(n, time.time() - t0)
+                        self.run_batch(n, pending)
+                        n, pending, count = 0, [], 0
+                        t0 = time.time()
+                if count:
+                    pending.append((chunk, count))
+                self.stats["batch"].add(0, time.time() - t0)
+                self.drain(key)  # 全部是重复帧的帧块不需要推理
+        if n:
+            self.run_batch(n, pending)
+        for key in list(self.videos):
+            self.drain(key)
+        self.result_queue.put(None)
+
+    def run_batch(self, n, pending):
+        """对当前批次做一次前向计算，把特征分给各个帧块，出错时涉及的视频都视为失败"""
+        t0 = time.time()
+        try:
+            features = get_pixel_features(preprocess_pixels(self.pixels[:n], self.pixel_values[:n]))
+        except Exception as e:
+            logger.error(f"批量提取视频帧特征失败：{repr(e)}")
+            features = None
+        self.stats["model"].add(n, time.time() - t0)
+        start = 0
+        for chunk, count in pending:
+            if features is None:
+                chunk.video.failed = True
+            else:
+                chunk.features.append(features[start:start + count])
+            chunk.remaining -= count
+            start += count
+        for key in dict.fromkeys(chunk.video.key for chunk, _ in pending):
+            self.drain(key)
+
+    def drain(self, key):
+        """按顺序合并已经得到全部特征的帧块，视频已结束且没有等待的帧块时交给写入阶段"""
+        video = self.videos[key]
+        while video.chunks and video.chunks[0].remaining == 0:
+            chunk = video.chunks.popleft()
+            if not video.failed:
+                video.add(chunk)
+        if not (video.ended and not video.chunks):
+            return
+        del self.videos[key]
+        if video.cancelled:
+            return
+        self.result_queue.put((video.path, video.info, None if video.failed else video.finish()))
+
+    def write_results(self):
+        """写入阶段：唯一的数据库写入线程，逐个视频调用 write，出错只记录日志，不影响后续视频"""
+        while True:
+            item = self.result_queue.get()
+            if item is None:
+                break
+            path, info, rows = item
+            t0 = time.time()
+            try:
+                self.write(path, info, rows)
+            except Exception as e:
+                logger.error(f"写入视频失败：{path} {repr(e)}")
+                logger.exception("Detailed error:")
+            if rows is None:
+                self.failed_files += 1
+            self.written_files += 1
+            self.stats["write"].add(1, time.time() - t0)